@@ -1,22 +1,96 @@
 from django.contrib import admin
+from django.db.models import F
 
 from .models import Customer, Task, Transaction, User
+from .pagination import EstimatedCountPaginator
 
 
-class TransactionAdmin(admin.ModelAdmin):
-	list_display = ("id", "collector", "amount", "timestamp")
+class LargeTableAdmin(admin.ModelAdmin):
+	"""
+	The changelists of the tables growing with the business (tasks and the ledger): the related rows shown
+	are joined, pages are counted with `EstimatedCountPaginator`, the total of the unfiltered table isn't
+	counted again, and foreign keys are picked with autocompletes instead of dropdowns of every row.
+	"""
+
+	paginator = EstimatedCountPaginator
+	show_full_result_count = False
+
+	def get_queryset(self, request):
+		# joined with the rest, instead of one query per row for `collector_balance`
+		return super().get_queryset(request).annotate(collector_balance=F("collector__balance__amount"))
+
+	@admin.display(description="Collector balance", ordering="collector_balance")
+	def collector_balance(self, obj):
+		return obj.collector_balance
+
+
+class TransactionAdmin(LargeTableAdmin):
+	list_display = ("id", "collector", "collector_balance", "task", "amount", "timestamp")
+	# a task's name includes its customer's
+	list_select_related = ("collector", "task__customer")
+	autocomplete_fields = ("collector", "task")
+	date_hierarchy = "timestamp"
+
+	# the ledger is append-only, and the balances follow from it: transactions are recorded by the API only
+	def has_add_permission(self, request):
+		return False
+
+	def has_change_permission(self, request, obj=None):
+		return False
+
+	def has_delete_permission(self, request, obj=None):
+		return False
 
 
 class UserAdmin(admin.ModelAdmin):
 	list_display = ("id", "username", "is_manager", "is_frozen")
+	list_select_related = ("balance",)
+	search_fields = ("username",)
+
+	actions = ("rotate_auth_token",)
+
+	@admin.display(boolean=True)
+	def is_frozen(self, obj):
+		return obj.is_frozen
+
+	@admin.action(description="Rotate the auth token of the selected users")
+	def rotate_auth_token(self, request, queryset):
+		# only the hash is stored, this is the only chance to see the new tokens
+		for user in queryset:
+			self.message_user(request, f"New auth token of {user.username}: {user.rotate_auth_token()}")
+
+	def get_search_results(self, request, queryset, search_term):
+		queryset, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+		# the autocompletes of a manager or collector field only offer managers or collectors
+		field_name = request.GET.get("field_name")
+		if field_name == "manager":
+			queryset = queryset.filter(is_manager=True)
+		if field_name == "collector":
+			queryset = queryset.filter(is_manager=False)
+		return queryset, may_have_duplicates
 
 
 class CustomerAdmin(admin.ModelAdmin):
 	list_display = ("id", "name", "address", "phone", "email")
+	search_fields = ("name", "phone", "email")
+
 
+class TaskAdmin(LargeTableAdmin):
+	list_display = ("id", "collector", "collector_balance", "customer", "amount_due", "amount_due_at")
+	list_select_related = ("collector", "customer")
+	autocomplete_fields = ("manager", "collector", "customer")
+	# searched by id only, see `get_search_results`; the autocompletes of task fields need search fields
+	search_fields = ("=id",)
+	date_hierarchy = "amount_due_at"
 
-class TaskAdmin(admin.ModelAdmin):
-	list_display = ("id", "collector", "customer", "amount_due")
+	def get_search_results(self, request, queryset, search_term):
+		# looked up by primary key: Django's search would compare the text of every id (`UPPER(id::text)`)
+		search_term = search_term.strip()
+		if not search_term:
+			return queryset, False
+		if not search_term.isdigit():
+			return queryset.none(), False
+		return queryset.filter(pk=int(search_term)), False
 
 	def formfield_for_foreignkey(self, db_field, request, **kwargs):
 		if db_field.name == "manager":
@@ -27,7 +101,7 @@ class TaskAdmin(admin.ModelAdmin):
 		return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
-admin.site.register(User)
-admin.site.register(Customer)
+admin.site.register(User, UserAdmin)
+admin.site.register(Customer, CustomerAdmin)
 admin.site.register(Task, TaskAdmin)
 admin.site.register(Transaction, TransactionAdmin)
@@ -1,109 +1,387 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from typing import Optional
+from functools import partial
+from typing import Annotated, Literal, Optional
 
+from django.db.models import OuterRef, Subquery
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from ninja import NinjaAPI, Schema
-from ninja.security import HttpBearer
+from ninja import Field, File, NinjaAPI, Query, Schema, UploadedFile
+from ninja.errors import HttpError
 
-from .models import Task, Transaction, User
+from . import assignment, dashboard, etags, export, ingest
+from .auth import BearerAuth, ManagerAuth
+from .idempotency import idempotent
+from .models import BalanceHistory, CollectorBalance, CollectorDailyRollup, Task, Transaction
+from .pagination import paginate, stream_json_list
+from .renderers import ORJSONParser, ORJSONRenderer
 
+# the most (collector, timestamp) pairs a manager can ask about in one call
+MAX_STATUS_QUERIES = 10_000
+# the most tasks in a page of /tasks
+MAX_TASKS_PAGE = 5_000
+# the most operations a collector can sync in one call
+MAX_SYNC_OPERATIONS = 500
+# the most collectors in a page of /manager/collectors
+MAX_COLLECTORS_PAGE = 5_000
+# the most days /manager/daily reports on at once
+MAX_REPORT_DAYS = 366
 
-class BearerAuth(HttpBearer):
-	def authenticate(self, request, token):
-		try:
-			return User.objects.get(auth_token=token)
-		except User.DoesNotExist:
-			return None
+
+# an amount of money sent by a client, exact to the cent like the Transaction.amount column
+Amount = Annotated[Decimal, Field(max_digits=10, decimal_places=2)]
 
 
 class TaskSchema(Schema):
 	id: int
 	collector: int
 	customer: int
-	amount_due: float
+	amount_due: Decimal
 	amount_due_at: datetime
 	is_collected: bool
-	related_transaction: int
+	related_transaction: Optional[int]
 
 
 class CollectSchema(Schema):
 	task_id: int
-	amount: float
+	amount: Amount
 	timestamp: datetime
 
 
 class PaySchema(Schema):
 	task_id: int
-	amount: float
+	amount: Amount
+	timestamp: datetime
+
+
+class SyncOperationSchema(Schema):
+	type: Literal["collect", "pay"]
+	task_id: int
+	amount: Amount
 	timestamp: datetime
 
 
-api = NinjaAPI(version="1.0.0", urls_namespace="cash_collector")
+class SyncResultSchema(Schema):
+	success: bool
+	transaction_id: Optional[int] = None
+	error: Optional[str] = None
+
+
+class StatusSchema(Schema):
+	collector: int
+	at: datetime
+	balance: Decimal
+	is_frozen: bool
+	frozen_at: Optional[datetime]
+
+
+class StatusQuerySchema(Schema):
+	collector: int
+	at: datetime
+
+
+class CollectorSummarySchema(Schema):
+	id: int
+	username: str
+	manager: Optional[int]
+	at: datetime
+	balance: Decimal
+	is_frozen: bool
+	frozen_at: Optional[datetime]
+	open_tasks: int
+	overdue_tasks: int
+	overdue_amount: Decimal
+
+
+class DailyRollupSchema(Schema):
+	collector: int
+	day: date
+	collected: Decimal
+	paid: Decimal
+	transactions: int
+	closing_balance: Decimal
+	peak_balance: Decimal
+
+
+class ImportErrorSchema(Schema):
+	line: int
+	error: str
+
+
+class TaskImportSchema(Schema):
+	created: int
+	failed: int
+	# the first MAX_REPORTED_ERRORS of them
+	errors: list[ImportErrorSchema]
+
+
+class AssignmentSchema(Schema):
+	assigned: int
+	skipped: int
+
+
+class DashboardSummarySchema(Schema):
+	at: datetime
+	collectors: int
+	frozen_collectors: int
+	collectors_over_threshold: int
+	total_balance: Decimal
+	open_tasks: int
+	overdue_tasks: int
+	overdue_amount: Decimal
+
+
+# the Task columns behind TaskSchema
+TASK_FIELDS = ("id", "collector_id", "customer_id", "amount_due", "amount_due_at", "is_collected")
+
+
+def task_row(values):
+	"""TaskSchema fields from a `Task.objects.values(*TASK_FIELDS, "related_transaction")` row."""
+	return {
+		"id": values["id"],
+		"collector": values["collector_id"],
+		"customer": values["customer_id"],
+		"amount_due": values["amount_due"],
+		"amount_due_at": values["amount_due_at"],
+		"is_collected": values["is_collected"],
+		"related_transaction": values["related_transaction"],
+	}
+
+
+def check_tasks_limit(limit):
+	if not 0 < limit <= MAX_TASKS_PAGE:
+		raise HttpError(400, f"The limit should be between 1 and {MAX_TASKS_PAGE}.")
+
+
+def done_tasks(collector):
+	return Task.objects.filter(collector=collector, is_collected=True)
+
+
+def with_related_transaction(tasks):
+	"""Annotates the tasks with the id of their first transaction."""
+	return tasks.annotate(
+		related_transaction=Subquery(
+			Transaction.objects.filter(task=OuterRef("pk")).order_by("id").values("id")[:1]
+		)
+	)
+
+
+def next_task(collector):
+	"""
+	The next task of the collector and the amount collected for it so far, as a `.values()` queryset to
+	take the first row of. It's read in one statement, walking the `task_open_by_due_idx` partial index.
+	"""
+	tasks = Task.objects.filter(collector=collector, is_collected=False).order_by("amount_due_at", "id")
+	return (
+		with_related_transaction(tasks)
+		.annotate(collected=Task.collected_amount())
+		.values(*TASK_FIELDS, "collected", "related_transaction")
+	)
 
 
-@api.get("/tasks", response={200: Optional[list[TaskSchema]]}, auth=BearerAuth())
-def get_tasks(request):
-	tasks = Task.objects.filter(collector=request.auth, is_collected=True)
+def next_task_row(task):
+	"""TaskSchema fields from a `next_task` row, the amount due is what's left to collect."""
+	return task_row({**task, "amount_due": task["amount_due"] - task["collected"]})
+
+
+def create_transaction(collector, task_id, amount, timestamp):
+	"""Writes a collect (positive `amount`) or pay transaction of the collector for one of his/her tasks."""
+	task = get_object_or_404(Task, id=task_id, collector=collector)
+	transaction = Transaction.objects.create(
+		collector=collector, task=task, amount=amount, timestamp=timestamp
+	)
+	return {"message": f"Transaction created with id {transaction.id}"}
+
+
+api = NinjaAPI(
+	version="1.0.0", urls_namespace="cash_collector", renderer=ORJSONRenderer(), parser=ORJSONParser()
+)
+
+
+@api.get("/tasks", response={200: list[TaskSchema]}, auth=BearerAuth())
+def get_tasks(request, cursor: Optional[str] = None, limit: int = 100):
+	"""
+	Tasks the cash collector has done, by due date. The response is paginated, when there are more tasks
+	the `X-Next-Cursor` header holds the `cursor` to get the next page with.
+	"""
+	check_tasks_limit(limit)
+	etag = etags.collector_etag(request.auth.id, etags.version_of(request.auth))
+	if (not_modified := etags.not_modified(request, etag)) is not None:
+		return not_modified
+	page, next_cursor = paginate(done_tasks(request.auth), "amount_due_at", cursor, limit)
+	rows = with_related_transaction(page).values(*TASK_FIELDS, "related_transaction")
+	response = StreamingHttpResponse(
+		stream_json_list(task_row(row) for row in rows.iterator(chunk_size=1_000)),
+		content_type="application/json",
+	)
+	response["ETag"] = etag
+	if next_cursor:
+		response["X-Next-Cursor"] = next_cursor
+	return response
+
+
+@api.get("/next_task", response={200: Optional[TaskSchema]}, auth=BearerAuth())
+def get_next_task(request, response: HttpResponse):
+	"""The task the cash collector should do now, with the amount that's left to collect."""
+	etag = etags.collector_etag(request.auth.id, etags.version_of(request.auth))
+	if (not_modified := etags.not_modified(request, etag)) is not None:
+		return not_modified
+	response["ETag"] = etag
+	task = next_task(request.auth).first()
+	if task is None:
+		return None
+	return next_task_row(task)
+
+
+@api.get("/status", response={200: StatusSchema}, auth=BearerAuth())
+def status(request, response: HttpResponse, at: Optional[datetime] = None):
+	"""Status of the cash collector now, or at the time given by `at`."""
+	balance = CollectorBalance.for_collector(request.auth)
+	etag = etags.status_etag(balance, at)
+	if (not_modified := etags.not_modified(request, etag)) is not None:
+		return not_modified
+	response["ETag"] = etag
+	return balance.get_status(at)
+
+
+@api.post("/manager/status", response={200: list[StatusSchema]}, auth=ManagerAuth())
+def collectors_status(request, payload: list[StatusQuerySchema]):
+	"""Status of many cash collectors, each at the time given with it."""
+	if len(payload) > MAX_STATUS_QUERIES:
+		raise HttpError(400, f"At most {MAX_STATUS_QUERIES} statuses can be queried at once.")
+	return BalanceHistory.statuses_at([(query.collector, query.at) for query in payload])
+
+
+@api.get("/manager/collectors", response={200: list[CollectorSummarySchema]}, auth=ManagerAuth())
+def collectors_summary(request, response: HttpResponse, cursor: Optional[int] = None, limit: int = 1_000):
+	"""
+	Balance, frozen state, open tasks and overdue amount of the cash collectors, by id. When there are more,
+	the `X-Next-Cursor` header holds the `cursor` to get the next page with. The figures may be a few seconds
+	old, `at` tells when they were computed.
+	"""
+	if not 0 < limit <= MAX_COLLECTORS_PAGE:
+		raise HttpError(400, f"The limit should be between 1 and {MAX_COLLECTORS_PAGE}.")
+	rows, next_cursor = dashboard.collectors_page(cursor, limit)
+	if next_cursor is not None:
+		response["X-Next-Cursor"] = str(next_cursor)
+	return rows
+
+
+@api.get("/manager/summary", response={200: DashboardSummarySchema}, auth=ManagerAuth())
+def dashboard_summary(request):
+	"""Totals over all the cash collectors, they may be a few seconds old, see `at`."""
+	return dashboard.summary()
+
+
+@api.get("/manager/daily", response={200: list[DailyRollupSchema]}, auth=ManagerAuth())
+def daily_report(request, since: date, until: date, collector: Query[list[int]] = None):
+	"""
+	Per day from `since` to `until` (both included): the amounts collected and paid by each cash collector,
+	his/her number of transactions, balance at the end of the day and highest balance during the day. Only
+	days with transactions are listed, all collectors or the `collector` ids given.
+	"""
+	if not timedelta(0) <= until - since < timedelta(days=MAX_REPORT_DAYS):
+		raise HttpError(400, f"The report covers 1 to {MAX_REPORT_DAYS} days, from `since` to `until`.")
+	rollups = CollectorDailyRollup.objects.filter(day__gte=since, day__lte=until).order_by(
+		"collector_id", "day"
+	)
+	if collector:
+		rollups = rollups.filter(collector_id__in=collector)
 	return [
-		{
-			"id": task.id,
-			"collector": task.collector.id,
-			"customer": task.customer.id,
-			"amount_due": task.amount_due,
-			"amount_due_at": task.amount_due_at,
-			"is_collected": task.is_collected,
-			"related_transaction": Transaction.objects.filter(task=task).id,
-		}
-		for task in tasks
+		{**rollup, "collector": rollup["collector_id"]}
+		for rollup in rollups.values(
+			"collector_id", "day", "collected", "paid", "transactions", "closing_balance", "peak_balance"
+		)
 	]
 
 
-@api.get("/next_task", response={200: Optional[TaskSchema]}, auth=BearerAuth())
-def get_next_task(request):
-	task = Task.objects.filter(collector=request.auth, is_collected=False).order_by("amount_due_at").first()
-	related_transaction = Transaction.objects.filter(task=task)
-	if task:
-		return {
-			"id": task.id,
-			"collector": task.collector.id,
-			"customer": task.customer.id,
-			"amount_due": task.remaining_amount(),
-			"amount_due_at": task.amount_due_at,
-			"is_collected": task.is_collected,
-			"related_transaction": related_transaction,
-		}
+@api.get("/manager/status/export", auth=ManagerAuth())
+def export_status(request, collector: Query[list[int]] = None):
+	"""
+	Status of the cash collectors over time as CSV: each transaction with the balance after it, and the
+	instants collectors got frozen or unfrozen. All collectors, or only the `collector` ids given.
+	"""
+	response = StreamingHttpResponse(
+		export.stream_csv(export.status_timeline(export.ledger(collector))), content_type="text/csv"
+	)
+	response["Content-Disposition"] = 'attachment; filename="status.csv"'
+	return response
+
 
-	return None
+@api.post("/manager/tasks/import", response={200: TaskImportSchema}, auth=ManagerAuth())
+def import_tasks(request, file: File[UploadedFile], format: Optional[Literal["csv", "jsonl"]] = None):
+	"""
+	Creates the tasks of a CSV file, with a header row of `collector`, `manager`, `customer`, `amount_due` and
+	`amount_due_at`, or of a JSONL file with those keys. The format is taken from the file name unless given.
+	Tasks without a manager are the authenticated manager's. Invalid rows are skipped and reported by line.
+	"""
+	return ingest.import_tasks(file.file, format or ingest.format_of(file.name), request.auth.id)
 
 
-@api.get("/status", auth=BearerAuth())
-def status(request):
-	return {"is_frozen": request.auth.is_frozen}
+@api.post("/manager/tasks/assign", response={200: AssignmentSchema}, auth=ManagerAuth())
+def assign_tasks(request, capacity: Optional[int] = None, limit: Optional[int] = None):
+	"""
+	Assigns the manager's unassigned tasks to his/her collectors, spreading them by open tasks and due times.
+	With `capacity`, collectors get no more than that many open tasks; with `limit`, only that many tasks,
+	the ones due first, are assigned.
+	"""
+	return assignment.assign(manager_ids=[request.auth.id], capacity=capacity, limit=limit)
 
 
 @api.post("/collect", auth=BearerAuth())
-def collect(request, payload: CollectSchema):
-	"""Cash collector collects the amount of money from the customer."""
-	task = get_object_or_404(Task, id=payload.task_id, collector=request.auth)
-	# create a transaction
-	transaction = Transaction.objects.create(
-		collector=request.auth,
-		task=task,
-		amount=Decimal(payload.amount),
-		timestamp=payload.timestamp,
+def collect(request, response: HttpResponse, payload: CollectSchema):
+	"""
+	Cash collector collects the amount of money from the customer. A retry sent with the same
+	`Idempotency-Key` header as the first request gets its response back.
+	"""
+	return idempotent(
+		request,
+		response,
+		"collect",
+		payload,
+		partial(create_transaction, request.auth, payload.task_id, payload.amount, payload.timestamp),
 	)
-	return {"message": f"Transaction created with id {transaction.id}"}
 
 
 @api.post("/pay", auth=BearerAuth())
-def pay(request, payload: PaySchema):
-	"""Cash collector pays the amount of money to the manager."""
-	task = get_object_or_404(Task, id=payload.task_id, collector=request.auth)
-	transaction = Transaction.objects.create(
-		collector=request.auth,
-		task=task,
-		amount=-Decimal(payload.amount),
-		timestamp=payload.timestamp,
+def pay(request, response: HttpResponse, payload: PaySchema):
+	"""
+	Cash collector pays the amount of money to the manager. A retry sent with the same `Idempotency-Key`
+	header as the first request gets its response back.
+	"""
+	return idempotent(
+		request,
+		response,
+		"pay",
+		payload,
+		partial(create_transaction, request.auth, payload.task_id, -payload.amount, payload.timestamp),
 	)
-	return {"message": f"Transaction created with id {transaction.id}"}
+
+
+@api.post("/sync", response={200: list[SyncResultSchema]}, auth=BearerAuth())
+def sync(request, response: HttpResponse, payload: list[SyncOperationSchema]):
+	"""
+	Cash collector uploads the collections and payments he/she recorded while offline, in the order they
+	happened. Each operation succeeds or fails on its own, the results are in the same order. A retried batch
+	sent with the same `Idempotency-Key` header as the first request gets its results back.
+	"""
+	if len(payload) > MAX_SYNC_OPERATIONS:
+		raise HttpError(400, f"At most {MAX_SYNC_OPERATIONS} operations can be synced at once.")
+	return idempotent(request, response, "sync", payload, partial(sync_operations, request.auth, payload))
+
+
+def sync_operations(collector, payload):
+	"""Records the `/sync` operations of `payload` for `collector`, returns their results."""
+	results = Transaction.sync(
+		collector,
+		[
+			(operation.type == "collect", operation.task_id, operation.amount, operation.timestamp)
+			for operation in payload
+		],
+	)
+	return [
+		{"success": True, "transaction_id": result.id}
+		if isinstance(result, Transaction)
+		else {"success": False, "error": result}
+		for result in results
+	]
@@ -0,0 +1,115 @@
+"""
+Automatic assignment of the unassigned tasks (`Task.collector` is null) to collectors, see the `assign_tasks`
+management command and `POST /manager/tasks/assign`.
+
+A task goes to a collector of its manager. The tasks are taken by due date, and each one goes to the
+manager's collector with the fewest open tasks; among those, to the one whose earliest open task is due the
+latest, who has the most time to spare. Frozen and inactive collectors get nothing. The collectors of each
+manager are kept in a heap keyed that way, so a batch of N tasks over M collectors is spread in
+O(N log M) in memory, after one query for the tasks and two for the collectors, and the assignments are
+written in bulk.
+"""
+
+import heapq
+from collections import defaultdict
+from itertools import islice
+
+from django.db import connection, transaction
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from .models import CollectorBalance, Task, User
+
+# assignments written per statement
+WRITE_BATCH_SIZE = 5_000
+
+
+def candidates(manager_ids, at):
+	"""
+	{manager_id: heap of [open tasks, -earliest due timestamp, collector_id]} of the active collectors of
+	the managers who aren't frozen at `at`. Collectors without open tasks have all the time in the world.
+	"""
+	collectors = (
+		User.objects.filter(is_manager=False, is_active=True, manager_id__in=manager_ids)
+		.exclude(balance__frozen_at__lte=at)
+		.values_list("id", "manager_id")
+	)
+	teams = dict(collectors.iterator(chunk_size=10_000))
+	loads = (
+		Task.objects.filter(is_collected=False, collector_id__in=teams)
+		.values("collector_id")
+		.annotate(open_tasks=Count("id"), earliest_due=Min("amount_due_at"))
+		.order_by()
+		.values_list("collector_id", "open_tasks", "earliest_due")
+	)
+	loads = {collector_id: (open_tasks, earliest_due) for collector_id, open_tasks, earliest_due in loads}
+
+	heaps = defaultdict(list)
+	for collector_id, manager_id in teams.items():
+		open_tasks, earliest_due = loads.get(collector_id, (0, None))
+		slack = -earliest_due.timestamp() if earliest_due is not None else float("-inf")
+		heaps[manager_id].append([open_tasks, slack, collector_id])
+	for heap in heaps.values():
+		heapq.heapify(heap)
+	return heaps
+
+
+def plan(tasks, heaps, capacity=None):
+	"""
+	Yields the (task_id, collector_id) assignments of the (id, manager_id, amount_due_at) `tasks`, given by
+	due date, updating the `candidates` heaps as it goes. With `capacity`, collectors get no more than that
+	many open tasks.
+	"""
+	for task_id, manager_id, amount_due_at in tasks:
+		heap = heaps.get(manager_id)
+		if not heap or (capacity is not None and heap[0][0] >= capacity):
+			continue
+		open_tasks, slack, collector_id = heap[0]
+		heapq.heapreplace(heap, [open_tasks + 1, max(slack, -amount_due_at.timestamp()), collector_id])
+		yield task_id, collector_id
+
+
+def assign(manager_ids=None, capacity=None, limit=None, at=None):
+	"""
+	Assigns the unassigned open tasks (of `manager_ids` if given, the `limit` due first if given) to the
+	collectors of their managers, in one transaction. Returns {"assigned", "skipped"}: how many tasks were
+	assigned, and how many were left unassigned, for lack of a collector with room for them.
+	"""
+	at = at or timezone.now()
+	with transaction.atomic():
+		tasks = Task.objects.filter(collector__isnull=True, is_collected=False).order_by(
+			"amount_due_at", "id"
+		)
+		if manager_ids is not None:
+			tasks = tasks.filter(manager_id__in=manager_ids)
+		# tasks being assigned by another run are skipped, not waited for
+		tasks = list(
+			tasks.select_for_update(skip_locked=True).values_list("id", "manager_id", "amount_due_at")[:limit]
+		)
+		heaps = candidates({manager_id for _, manager_id, _ in tasks}, at)
+		assignments = list(plan(tasks, heaps, capacity))
+		write(assignments)
+		CollectorBalance.bump_versions({collector_id for _, collector_id in assignments})
+	return {"assigned": len(assignments), "skipped": len(tasks) - len(assignments)}
+
+
+def write(assignments):
+	"""Sets the collector of the tasks of the (task_id, collector_id) `assignments`, in batches."""
+	iterator = iter(assignments)
+	while batch := list(islice(iterator, WRITE_BATCH_SIZE)):
+		if connection.vendor == "postgresql":
+			# one UPDATE joined to the assignments, instead of bulk_update's CASE over the whole batch
+			table = connection.ops.quote_name(Task._meta.db_table)
+			column = connection.ops.quote_name(Task._meta.get_field("collector").column)
+			values = ", ".join(["(%s, %s)"] * len(batch))
+			with connection.cursor() as cursor:
+				cursor.execute(
+					f"UPDATE {table} SET {column} = v.collector_id "  # noqa: S608
+					f"FROM (VALUES {values}) AS v(id, collector_id) WHERE {table}.id = v.id",
+					[value for assignment in batch for value in assignment],
+				)
+		else:
+			Task.objects.bulk_update(
+				[Task(id=task_id, collector_id=collector_id) for task_id, collector_id in batch],
+				["collector"],
+			)
@@ -0,0 +1,103 @@
+"""
+Async versions of the cash collector endpoints, for ASGI deployments where one worker serves many slow
+mobile connections. They're the same as in `api.py`, reads go through Django's async ORM and each write
+runs in one worker thread, since Django has no async transactions.
+"""
+
+from datetime import datetime
+from functools import partial
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from ninja import NinjaAPI
+
+from . import etags
+from .api import (
+	TASK_FIELDS,
+	CollectSchema,
+	PaySchema,
+	StatusSchema,
+	TaskSchema,
+	check_tasks_limit,
+	create_transaction,
+	done_tasks,
+	next_task,
+	next_task_row,
+	task_row,
+	with_related_transaction,
+)
+from .auth import AsyncBearerAuth
+from .idempotency import idempotent
+from .models import CollectorBalance
+from .pagination import apaginate
+from .renderers import ORJSONParser, ORJSONRenderer
+
+api = NinjaAPI(
+	version="1.0.0",
+	urls_namespace="cash_collector_async",
+	renderer=ORJSONRenderer(),
+	parser=ORJSONParser(),
+)
+
+
+@api.get("/tasks", response={200: list[TaskSchema]}, auth=AsyncBearerAuth())
+async def get_tasks(request, response: HttpResponse, cursor: Optional[str] = None, limit: int = 100):
+	"""
+	Tasks the cash collector has done, by due date. The response is paginated, when there are more tasks
+	the `X-Next-Cursor` header holds the `cursor` to get the next page with.
+	"""
+	check_tasks_limit(limit)
+	etag = etags.collector_etag(request.auth.id, await etags.aversion_of(request.auth))
+	if (not_modified := etags.not_modified(request, etag)) is not None:
+		return not_modified
+	response["ETag"] = etag
+	page, next_cursor = await apaginate(done_tasks(request.auth), "amount_due_at", cursor, limit)
+	rows = with_related_transaction(page).values(*TASK_FIELDS, "related_transaction")
+	if next_cursor:
+		response["X-Next-Cursor"] = next_cursor
+	return [task_row(row) async for row in rows]
+
+
+@api.get("/next_task", response={200: Optional[TaskSchema]}, auth=AsyncBearerAuth())
+async def get_next_task(request, response: HttpResponse):
+	"""The task the cash collector should do now, with the amount that's left to collect."""
+	etag = etags.collector_etag(request.auth.id, await etags.aversion_of(request.auth))
+	if (not_modified := etags.not_modified(request, etag)) is not None:
+		return not_modified
+	response["ETag"] = etag
+	task = await next_task(request.auth).afirst()
+	if task is None:
+		return None
+	return next_task_row(task)
+
+
+@api.get("/status", response={200: StatusSchema}, auth=AsyncBearerAuth())
+async def status(request, response: HttpResponse, at: Optional[datetime] = None):
+	"""Status of the cash collector now, or at the time given by `at`."""
+	balance = await CollectorBalance.afor_collector(request.auth)
+	etag = etags.status_etag(balance, at)
+	if (not_modified := etags.not_modified(request, etag)) is not None:
+		return not_modified
+	response["ETag"] = etag
+	return await balance.aget_status(at)
+
+
+@api.post("/collect", auth=AsyncBearerAuth())
+async def collect(request, response: HttpResponse, payload: CollectSchema):
+	"""
+	Cash collector collects the amount of money from the customer. A retry sent with the same
+	`Idempotency-Key` header as the first request gets its response back.
+	"""
+	write = partial(create_transaction, request.auth, payload.task_id, payload.amount, payload.timestamp)
+	return await sync_to_async(idempotent)(request, response, "collect", payload, write)
+
+
+@api.post("/pay", auth=AsyncBearerAuth())
+async def pay(request, response: HttpResponse, payload: PaySchema):
+	"""
+	Cash collector pays the amount of money to the manager. A retry sent with the same `Idempotency-Key`
+	header as the first request gets its response back.
+	"""
+	write = partial(create_transaction, request.auth, payload.task_id, -payload.amount, payload.timestamp)
+	return await sync_to_async(idempotent)(request, response, "pay", payload, write)
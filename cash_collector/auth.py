@@ -0,0 +1,39 @@
+from ninja.security import HttpBearer
+
+from .models import User
+from .token_cache import token_cache
+
+
+class BearerAuth(HttpBearer):
+	def authenticate(self, request, token):
+		token_hash = User.hash_auth_token(token)
+		user = token_cache.get(token_hash)
+		if user is None:
+			user = User.objects.filter(auth_token_hash=token_hash, is_active=True).first()
+			if user is not None:
+				token_cache.set(token_hash, user)
+		return user
+
+
+class ManagerAuth(BearerAuth):
+	def authenticate(self, request, token):
+		user = super().authenticate(request, token)
+		if user is not None and user.is_manager:
+			return user
+		return None
+
+
+class AsyncBearerAuth(HttpBearer):
+	"""Same as `BearerAuth`, for async views."""
+
+	# tells ninja to await the result
+	is_async = True
+
+	async def authenticate(self, request, token):
+		token_hash = User.hash_auth_token(token)
+		user = token_cache.get(token_hash)
+		if user is None:
+			user = await User.objects.filter(auth_token_hash=token_hash, is_active=True).afirst()
+			if user is not None:
+				token_cache.set(token_hash, user)
+		return user
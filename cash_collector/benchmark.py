@@ -0,0 +1,169 @@
+"""
+Drives the API endpoints and measures latency, throughput and SQL queries, see the `benchmark` management
+command. Requests go either through Django's test client in this process, or over HTTP to a running server.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+
+import httpx
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from ninja.responses import NinjaJSONEncoder
+
+from .api import MAX_TASKS_PAGE, TASK_FIELDS, task_row, with_related_transaction
+from .models import Task
+from .pagination import stream_json_list
+
+ENDPOINTS = ("tasks", "next_task", "status", "collect")
+
+
+class InProcessClient:
+	"""
+	Calls the API through Django's test client, so the whole request cycle (URL resolving, middleware) is
+	measured, and counts the SQL queries of each call.
+	"""
+
+	mode = "in-process"
+	counts_queries = True
+
+	def __init__(self, prefix="/api/"):
+		self.prefix = prefix
+		self.client = Client(raise_request_exception=False, HTTP_HOST=get_allowed_host())
+
+	def request(self, method, path, token, json=None):
+		"""Returns (status code, body, number of queries)."""
+		headers = {"Authorization": f"Bearer {token}"}
+		with CaptureQueriesContext(connection) as queries:
+			if method == "GET":
+				response = self.client.get(self.prefix + path, headers=headers)
+			else:
+				response = self.client.post(
+					self.prefix + path, json, content_type="application/json", headers=headers
+				)
+			# /tasks streams its rows, they are only queried while the content is consumed
+			content = b"".join(response.streaming_content) if response.streaming else response.content
+		body = loads(content) if response.status_code == 200 else None
+		return response.status_code, body, len(queries)
+
+
+def get_allowed_host():
+	"""A host name the `ALLOWED_HOSTS` setting lets through."""
+	for host in settings.ALLOWED_HOSTS:
+		if host == "*":
+			break
+		return "example" + host if host.startswith(".") else host
+	return "localhost"
+
+
+class HttpClient:
+	"""Calls a running server over HTTP, queries can't be counted from here."""
+
+	mode = "http"
+	counts_queries = False
+
+	def __init__(self, base_url):
+		self.client = httpx.Client(base_url=base_url.rstrip("/") + "/", timeout=30)
+
+	def request(self, method, path, token, json=None):
+		response = self.client.request(method, path, json=json, headers={"Authorization": f"Bearer {token}"})
+		body = response.json() if response.status_code == 200 else None
+		return response.status_code, body, None
+
+
+def call_endpoint(client, endpoint, token):
+	"""Calls `endpoint` once, returns (ok, seconds, queries). Only the endpoint's own request is timed."""
+	json = None
+	method, path = "GET", endpoint
+	if endpoint == "collect":
+		# collect the whole amount of the collector's next task, like the mobile app does
+		_, task, _ = client.request("GET", "next_task", token)
+		if task is None:
+			return False, 0, None
+		method = "POST"
+		json = {"task_id": task["id"], "amount": task["amount_due"], "timestamp": timezone.now().isoformat()}
+
+	started = time.perf_counter()
+	status_code, _, queries = client.request(method, path, token, json=json)
+	return status_code == 200, time.perf_counter() - started, queries
+
+
+def run_endpoint(client, endpoint, tokens, requests, concurrency=1):
+	"""Calls `endpoint` `requests` times, going round the collectors' `tokens`, and summarizes the calls."""
+
+	def worker(offset):
+		return [
+			call_endpoint(client, endpoint, tokens[i % len(tokens)])
+			for i in range(offset, requests, concurrency)
+		]
+
+	started = time.perf_counter()
+	if concurrency == 1:
+		calls = worker(0)
+	else:
+		with ThreadPoolExecutor(max_workers=concurrency) as executor:
+			calls = [call for calls in executor.map(worker, range(concurrency)) for call in calls]
+	return summarize(calls, time.perf_counter() - started)
+
+
+def summarize(calls, elapsed):
+	latencies = sorted(seconds * 1_000 for ok, seconds, _ in calls if ok)
+	queries = [count for ok, _, count in calls if ok and count is not None]
+	return {
+		"requests": len(calls),
+		"errors": sum(1 for ok, _, _ in calls if not ok),
+		"throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+		"mean_ms": round(sum(latencies) / len(latencies), 3) if latencies else None,
+		"p50_ms": percentile(latencies, 50),
+		"p95_ms": percentile(latencies, 95),
+		"p99_ms": percentile(latencies, 99),
+		"queries_per_request": round(sum(queries) / len(queries), 2) if queries else None,
+	}
+
+
+def percentile(values, p):
+	"""Nearest-rank percentile of sorted `values`."""
+	if not values:
+		return None
+	return round(values[min(len(values) - 1, max(0, -(-len(values) * p // 100) - 1))], 3)
+
+
+def compare(previous, current):
+	"""Yields (endpoint, metric, previous, current, change in %) for the metrics of both result sets."""
+	for endpoint, results in current["endpoints"].items():
+		for metric in ("throughput", "p50_ms", "p95_ms", "p99_ms", "queries_per_request"):
+			before = previous.get("endpoints", {}).get(endpoint, {}).get(metric)
+			after = results.get(metric)
+			if before is None or after is None:
+				continue
+			change = round((after - before) / before * 100, 1) if before else None
+			yield endpoint, metric, before, after, change
+
+
+def serialization(rows=MAX_TASKS_PAGE, repeat=5):
+	"""
+	Times the rendering of a /tasks page of `rows` done tasks, with the standard library's json (how Ninja
+	renders by default) and with orjson as /tasks streams it. Returns the best of `repeat` runs of each.
+	"""
+	tasks = Task.objects.filter(is_collected=True).order_by("amount_due_at", "pk")[:rows]
+	page = [
+		task_row(row) for row in with_related_transaction(tasks).values(*TASK_FIELDS, "related_transaction")
+	]
+	renderers = {
+		"json": lambda: dumps(page, cls=NinjaJSONEncoder).encode(),
+		"orjson": lambda: b"".join(stream_json_list(page)),
+	}
+	results = {"rows": len(page)}
+	for name, render in renderers.items():
+		timings = []
+		for _ in range(repeat):
+			started = time.perf_counter()
+			body = render()
+			timings.append(time.perf_counter() - started)
+		results[f"{name}_ms"] = round(min(timings) * 1_000, 3)
+		results[f"{name}_bytes"] = len(body)
+	return results
@@ -0,0 +1,115 @@
+"""
+Figures of the manager dashboard, computed a page of collectors at a time with grouped queries and cached for
+`MANAGER_DASHBOARD_CACHE_TTL` seconds, so a dashboard refreshing every few seconds doesn't recompute them.
+
+A task can only be collected in full, so the amount left on an open task is its `amount_due` and the open
+tasks are summed without reading the ledger.
+"""
+
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+from .models import CollectorBalance, Task, User
+
+CACHE_PREFIX = "manager-dashboard"
+
+
+def cached(key, compute):
+	"""`compute()`, cached under `key` for `MANAGER_DASHBOARD_CACHE_TTL` seconds (not at all if it's 0)."""
+	ttl = settings.MANAGER_DASHBOARD_CACHE_TTL
+	if not ttl:
+		return compute()
+	return cache.get_or_set(f"{CACHE_PREFIX}:{key}", compute, ttl)
+
+
+def collectors_page(cursor, limit):
+	"""
+	Returns (rows, next_cursor): the figures of `limit` collectors by id, after the collector `cursor`, and
+	the id to continue from (None on the last page). Two queries: the collectors with their balance, then
+	their open tasks grouped by collector.
+	"""
+	return cached(f"collectors:{cursor}:{limit}", lambda: compute_collectors_page(cursor, limit))
+
+
+def compute_collectors_page(cursor, limit):
+	at = timezone.now()
+	collectors = User.objects.filter(is_manager=False).order_by("id")
+	if cursor is not None:
+		collectors = collectors.filter(id__gt=cursor)
+	fields = ("id", "username", "manager_id", "balance__amount", "balance__frozen_at")
+	collectors = list(collectors.values(*fields)[: limit + 1])
+	next_cursor = collectors[limit - 1]["id"] if len(collectors) > limit else None
+	collectors = collectors[:limit]
+
+	tasks = {
+		row["collector_id"]: row
+		for row in open_tasks(at).filter(collector_id__in=[collector["id"] for collector in collectors])
+	}
+	rows = []
+	for collector in collectors:
+		frozen_at = collector["balance__frozen_at"]
+		collector_tasks = tasks.get(collector["id"], {})
+		rows.append(
+			{
+				"id": collector["id"],
+				"username": collector["username"],
+				"manager": collector["manager_id"],
+				"at": at,
+				"balance": collector["balance__amount"] or Decimal(0),
+				"is_frozen": frozen_at is not None and at >= frozen_at,
+				"frozen_at": frozen_at,
+				"open_tasks": collector_tasks.get("open_tasks", 0),
+				"overdue_tasks": collector_tasks.get("overdue_tasks", 0),
+				"overdue_amount": collector_tasks.get("overdue_amount") or Decimal(0),
+			}
+		)
+	return rows, next_cursor
+
+
+def open_tasks(at):
+	"""Open tasks grouped by collector: their count, and the count and amount of those due before `at`."""
+	overdue = Q(amount_due_at__lt=at)
+	return (
+		Task.objects.filter(is_collected=False)
+		.values("collector_id")
+		.annotate(
+			open_tasks=Count("id"),
+			overdue_tasks=Count("id", filter=overdue),
+			overdue_amount=Sum("amount_due", filter=overdue),
+		)
+		.order_by()
+	)
+
+
+def summary():
+	"""Totals over all the collectors, from the balances and the open tasks."""
+	return cached("summary", compute_summary)
+
+
+def compute_summary():
+	at = timezone.now()
+	balances = CollectorBalance.objects.filter(collector__is_manager=False).aggregate(
+		total_balance=Sum("amount"),
+		frozen_collectors=Count("pk", filter=Q(frozen_at__lte=at)),
+		collectors_over_threshold=Count("pk", filter=Q(amount__gte=settings.USD_THRESHOLD)),
+	)
+	overdue = Q(amount_due_at__lt=at)
+	tasks = Task.objects.filter(is_collected=False).aggregate(
+		open_tasks=Count("id"),
+		overdue_tasks=Count("id", filter=overdue),
+		overdue_amount=Sum("amount_due", filter=overdue),
+	)
+	return {
+		"at": at,
+		"collectors": User.objects.filter(is_manager=False).count(),
+		"frozen_collectors": balances["frozen_collectors"],
+		"collectors_over_threshold": balances["collectors_over_threshold"],
+		"total_balance": balances["total_balance"] or Decimal(0),
+		"open_tasks": tasks["open_tasks"],
+		"overdue_tasks": tasks["overdue_tasks"],
+		"overdue_amount": tasks["overdue_amount"] or Decimal(0),
+	}
@@ -0,0 +1,56 @@
+"""
+Conditional GETs of the collectors' read endpoints. Their ETags derive from `CollectorBalance.version`, which
+is bumped whenever the collector's tasks or transactions change, so a client polling with `If-None-Match`
+gets a 304 after a single primary key lookup, without the endpoint reading its data.
+
+The version is read before the data: a write in between gets the client newer data under an older ETag, and
+a full response again on its next poll, never stale data under a newer ETag.
+"""
+
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.http import parse_etags
+
+from . import freeze
+from .models import CollectorBalance
+
+
+def collector_etag(collector_id, version, *parts, weak=False):
+	"""The ETag of a collector's data at `version`, `parts` tell apart what else the response depends on."""
+	tag = ".".join(map(str, (collector_id, version, *parts)))
+	return f'W/"{tag}"' if weak else f'"{tag}"'
+
+
+def status_etag(balance, at=None):
+	"""
+	The ETag of the status from `balance`, at `at` (default: now). It's weak, the status also tells when it
+	was computed, and tells apart the statuses before and after the freeze deadline passes.
+	"""
+	is_frozen = freeze.is_frozen(balance.frozen_at, at or timezone.now())
+	return collector_etag(balance.collector_id, balance.version, int(is_frozen), weak=True)
+
+
+def version_of(collector):
+	"""The collector's `CollectorBalance.version`, 0 if he/she has no balance yet."""
+	return CollectorBalance.objects.filter(collector=collector).values_list("version", flat=True).first() or 0
+
+
+async def aversion_of(collector):
+	"""Async version of `version_of`."""
+	version = (
+		await CollectorBalance.objects.filter(collector=collector).values_list("version", flat=True).afirst()
+	)
+	return version or 0
+
+
+def not_modified(request, etag):
+	"""A 304 response if the `If-None-Match` header of `request` matches `etag` (weakly), None otherwise."""
+	header = request.headers.get("If-None-Match")
+	if header is None:
+		return None
+	etags = {tag.removeprefix("W/") for tag in parse_etags(header)}
+	if "*" not in etags and etag.removeprefix("W/") not in etags:
+		return None
+	response = HttpResponseNotModified()
+	response["ETag"] = etag
+	return response
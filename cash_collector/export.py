@@ -0,0 +1,96 @@
+"""
+CSV export of the collectors' status over time: every transaction with the running balance after it, and the
+instants collectors got frozen and unfrozen. The ledger is read through a server-side cursor and replayed
+collector by collector, so the memory used doesn't grow with the ledger.
+"""
+
+import csv
+from itertools import groupby
+from operator import itemgetter
+
+from django.utils import timezone
+
+from . import freeze
+from .models import Transaction
+
+COLUMNS = ("collector", "timestamp", "event", "transaction", "task", "amount", "balance", "is_frozen")
+
+CHUNK_SIZE = 2_000
+
+
+def ledger(collector_ids=None, chunk_size=CHUNK_SIZE):
+	"""The (id, collector_id, task_id, amount, timestamp) rows of the ledger by collector and timestamp."""
+	transactions = Transaction.objects.order_by("collector_id", "timestamp", "id")
+	if collector_ids:
+		transactions = transactions.filter(collector_id__in=collector_ids)
+	return transactions.values_list("id", "collector_id", "task_id", "amount", "timestamp").iterator(
+		chunk_size=chunk_size
+	)
+
+
+def status_timeline(transactions, until=None):
+	"""
+	Yields the timeline rows (dicts of COLUMNS) of the `ledger` rows `transactions`: a "transaction" row
+	for each of them with the status right after it, a "frozen" row when a collector's freeze deadline
+	passes and an "unfrozen" row when a transaction brings a frozen collector under the threshold.
+	Deadlines are followed up to `until` (default: now).
+	"""
+	until = until or timezone.now()
+	for collector_id, rows in groupby(transactions, key=itemgetter(1)):
+		state, frozen = freeze.INITIAL_STATE, False
+		for transaction_id, _, task_id, amount, timestamp in rows:
+			if not frozen and freeze.is_frozen(state.frozen_at, timestamp):
+				frozen = True
+				yield event_row(collector_id, state.frozen_at, "frozen", state)
+
+			state = freeze.apply_transaction(state, amount, timestamp)
+			is_frozen = freeze.is_frozen(state.frozen_at, timestamp)
+			yield {
+				**event_row(collector_id, timestamp, "transaction", state),
+				"transaction": transaction_id,
+				"task": task_id,
+				"amount": amount,
+			}
+			if frozen and not is_frozen:
+				frozen = False
+				yield event_row(collector_id, timestamp, "unfrozen", state)
+			elif not frozen and is_frozen:
+				# with DAYS_THRESHOLD = 0 the collector is frozen as soon as he/she reaches the threshold
+				frozen = True
+				yield event_row(collector_id, state.frozen_at, "frozen", state)
+
+		if not frozen and freeze.is_frozen(state.frozen_at, until):
+			yield event_row(collector_id, state.frozen_at, "frozen", state)
+
+
+def event_row(collector_id, at, event, state):
+	return {
+		"collector": collector_id,
+		"timestamp": at.isoformat(),
+		"event": event,
+		"transaction": None,
+		"task": None,
+		"amount": None,
+		"balance": state.balance,
+		"is_frozen": freeze.is_frozen(state.frozen_at, at),
+	}
+
+
+class Echo:
+	"""A file-like object handing back what's written to it, for `csv.writer` to format single lines."""
+
+	def write(self, value):
+		return value
+
+
+def stream_csv(rows, chunk_size=CHUNK_SIZE):
+	"""Yields the `rows` (dicts of COLUMNS) as CSV with a header, `chunk_size` lines at a time."""
+	writer = csv.DictWriter(Echo(), fieldnames=COLUMNS)
+	yield writer.writeheader()
+	chunk = []
+	for row in rows:
+		chunk.append(writer.writerow(row))
+		if len(chunk) == chunk_size:
+			yield "".join(chunk)
+			chunk = []
+	yield "".join(chunk)
@@ -0,0 +1,58 @@
+"""
+The freeze rule, see REQUIREMENTS.md:
+
+	A collector is frozen once he/she has held a balance of USD_THRESHOLD or more for DAYS_THRESHOLD days.
+
+The rule only depends on the instant the balance reached the threshold, so instead of looking back over the
+ledger we carry that instant forward transaction by transaction, and the freeze deadline follows from it.
+"""
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Iterable, NamedTuple, Optional
+
+from django.conf import settings
+
+
+class FreezeState(NamedTuple):
+	balance: Decimal
+	threshold_reached_at: Optional[datetime]
+	last_transaction_at: Optional[datetime]
+
+	@property
+	def frozen_at(self) -> Optional[datetime]:
+		return get_frozen_at(self.threshold_reached_at)
+
+
+INITIAL_STATE = FreezeState(Decimal(0), None, None)
+
+
+def get_frozen_at(threshold_reached_at: Optional[datetime]) -> Optional[datetime]:
+	"""Returns the instant the collector becomes frozen if his/her balance stays above the threshold."""
+	if threshold_reached_at is None:
+		return None
+	return threshold_reached_at + timedelta(days=settings.DAYS_THRESHOLD)
+
+
+def is_frozen(frozen_at: Optional[datetime], at: datetime) -> bool:
+	return frozen_at is not None and at >= frozen_at
+
+
+def apply_transaction(state: FreezeState, amount: Decimal, timestamp: datetime) -> FreezeState:
+	"""Returns the state after a transaction, transactions must be applied in timestamp order."""
+	balance = state.balance + amount
+	if balance < settings.USD_THRESHOLD:
+		threshold_reached_at = None
+	else:
+		# the balance may go up and down while above the threshold, the clock only starts when it gets there
+		threshold_reached_at = state.threshold_reached_at or timestamp
+	return FreezeState(balance, threshold_reached_at, timestamp)
+
+
+def replay(
+	transactions: Iterable[tuple[Decimal, datetime]], state: FreezeState = INITIAL_STATE
+) -> FreezeState:
+	"""Applies (amount, timestamp) pairs, ordered by timestamp, on top of `state`."""
+	for amount, timestamp in transactions:
+		state = apply_transaction(state, amount, timestamp)
+	return state
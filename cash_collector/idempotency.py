@@ -0,0 +1,72 @@
+"""
+Idempotency keys: a client sends a unique `Idempotency-Key` header with a write and reuses it when retrying,
+the first successful response is stored and the retries get it back without running the write again.
+"""
+
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from ninja.errors import HttpError
+from pydantic_core import to_json
+
+from .models import IdempotencyKey
+
+MAX_KEY_LENGTH = 255
+
+
+def idempotent(request, response, endpoint, payload, write):
+	"""
+	Returns `write()`, or the response stored for the request's `Idempotency-Key` header if it was already
+	used with the same `endpoint` and `payload`. The key is reserved in the same database transaction as the
+	write, so a concurrent retry waits for the first request and then replays its response, and a failed
+	write leaves the key free. Replayed responses have an `Idempotent-Replayed` header.
+	"""
+	key = request.headers.get("Idempotency-Key")
+	if key is None:
+		return write()
+	if not key or len(key) > MAX_KEY_LENGTH:
+		raise HttpError(400, f"The Idempotency-Key header must be 1 to {MAX_KEY_LENGTH} characters long.")
+	# the payload is a schema, or a list of them for /sync
+	fingerprint = hashlib.sha256(f"{endpoint}\n".encode() + to_json(payload)).hexdigest()
+
+	with transaction.atomic():
+		record, reserved = reserve(request.auth, key, fingerprint)
+		if not reserved:
+			if record.fingerprint != fingerprint:
+				raise HttpError(422, "The Idempotency-Key was already used for another request.")
+			response["Idempotent-Replayed"] = "true"
+			return record.response
+
+		body = write()
+		record.response = body
+		record.save(update_fields=["response"])
+	return body
+
+
+def reserve(user, key, fingerprint):
+	"""
+	Returns (record, reserved): the existing record of the key, locked, or a new one. An expired record is
+	reserved again.
+	"""
+	now = timezone.now()
+	expires_at = now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+	record = IdempotencyKey.objects.select_for_update().filter(user=user, key=key).first()
+	if record is None:
+		try:
+			with transaction.atomic():
+				record = IdempotencyKey.objects.create(
+					user=user, key=key, fingerprint=fingerprint, expires_at=expires_at
+				)
+			return record, True
+		except IntegrityError:
+			# a concurrent request reserved the key first, its record is readable once it commits
+			record = IdempotencyKey.objects.select_for_update().get(user=user, key=key)
+
+	if record.expires_at <= now:
+		record.fingerprint, record.response, record.expires_at = fingerprint, None, expires_at
+		record.save(update_fields=["fingerprint", "response", "expires_at"])
+		return record, True
+	return record, False
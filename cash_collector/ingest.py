@@ -0,0 +1,215 @@
+"""
+Bulk import of tasks from CSV or JSONL files, for the loads of the operations team (see the
+`import_tasks` management command and `POST /manager/tasks/import`).
+
+The file is parsed as a stream and handled `BATCH_SIZE` rows at a time: the rows are validated, their
+collectors, managers and customers are looked up in one query per batch (the ids found are cached for the
+next batches), and the valid rows are written at once, with `COPY` on PostgreSQL. Invalid rows are reported
+by line and skipped, the rest of the file is still loaded. Memory use depends on the batch size, not on the
+size of the file.
+"""
+
+import csv
+import io
+from decimal import Decimal
+from itertools import islice
+from typing import Optional
+
+import orjson
+from django.db import DatabaseError, connection, transaction
+from pydantic import AwareDatetime, BaseModel, Field, ValidationError
+
+from .models import CollectorBalance, Customer, Task, User
+
+FORMATS = ("csv", "jsonl")
+
+COLUMNS = ("collector", "manager", "customer", "amount_due", "amount_due_at")
+
+BATCH_SIZE = 5_000
+
+# errors beyond this many are counted, not listed
+MAX_REPORTED_ERRORS = 1_000
+
+# the Task columns written, in the order of COPY
+TASK_FIELDS = ("manager", "collector", "customer", "amount_due", "amount_due_at", "is_collected")
+
+
+class TaskRow(BaseModel):
+	# unassigned when it's not given, see `cash_collector.assignment`
+	collector: Optional[int] = None
+	# the manager importing the file when it's not given
+	manager: Optional[int] = None
+	customer: int
+	amount_due: Decimal = Field(gt=0, max_digits=10, decimal_places=2)
+	amount_due_at: AwareDatetime
+
+
+def format_of(name):
+	"""The format of a file from its name: JSONL for .jsonl and .ndjson files, CSV otherwise."""
+	return "jsonl" if name.lower().endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def read_rows(file, file_format):
+	"""Yields the (line number, row dict or None, error or None) of the binary `file`, one line at a time."""
+	text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+	if file_format == "csv":
+		reader = csv.DictReader(text)
+		for row in reader:
+			# empty cells are missing values, extra cells (under the None key) are ignored
+			yield reader.line_num, {key: value for key, value in row.items() if key and value}, None
+		return
+
+	for line_number, line in enumerate(text, 1):
+		if not line.strip():
+			continue
+		try:
+			row = orjson.loads(line)
+		except orjson.JSONDecodeError as e:
+			yield line_number, None, f"Invalid JSON: {e}"
+			continue
+		if isinstance(row, dict):
+			yield line_number, row, None
+		else:
+			yield line_number, None, "A line should be a JSON object."
+
+
+def batched(iterable, size):
+	iterator = iter(iterable)
+	while batch := list(islice(iterator, size)):
+		yield batch
+
+
+class Lookup:
+	"""
+	Which ids of the rows of `queryset` exist, looked up a batch of ids at a time and cached. None is accepted
+	when `nullable`.
+	"""
+
+	def __init__(self, queryset, nullable=False):
+		self.queryset = queryset
+		self.nullable = nullable
+		self.found = set()
+		self.missing = set()
+
+	def load(self, ids):
+		unknown = set(ids) - self.found - self.missing - {None}
+		if unknown:
+			found = set(self.queryset.filter(pk__in=unknown).values_list("pk", flat=True))
+			self.found |= found
+			self.missing |= unknown - found
+
+	def __contains__(self, pk):
+		return pk in self.found or (pk is None and self.nullable)
+
+
+class Report:
+	"""How many tasks were created, and the errors of the rows that were not."""
+
+	def __init__(self):
+		self.created = 0
+		self.failed = 0
+		self.errors = []
+
+	def error(self, line, message):
+		self.failed += 1
+		if len(self.errors) < MAX_REPORTED_ERRORS:
+			self.errors.append({"line": line, "error": message})
+
+	def as_dict(self):
+		return {"created": self.created, "failed": self.failed, "errors": self.errors}
+
+
+def import_tasks(file, file_format, manager_id=None, batch_size=BATCH_SIZE):
+	"""
+	Creates the tasks of the binary `file` (CSV with a header row of COLUMNS, or one JSON object per line),
+	assigned by `manager_id` unless their row has a manager. Returns the `Report` as a dict.
+	"""
+	lookups = {
+		"collector": Lookup(User.objects.filter(is_manager=False), nullable=True),
+		"manager": Lookup(User.objects.filter(is_manager=True)),
+		"customer": Lookup(Customer.objects.all()),
+	}
+	report = Report()
+	for batch in batched(read_rows(file, file_format), batch_size):
+		rows = []
+		for line, data, error in batch:
+			if error is None:
+				try:
+					row = TaskRow.model_validate(data)
+				except ValidationError as e:
+					error = "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())
+				else:
+					row.manager = row.manager or manager_id
+					rows.append((line, row))
+			if error is not None:
+				report.error(line, error)
+
+		for name, lookup in lookups.items():
+			lookup.load(getattr(row, name) for _, row in rows)
+		tasks, lines = [], []
+		for line, row in rows:
+			unknown = [name for name, lookup in lookups.items() if getattr(row, name) not in lookup]
+			if unknown:
+				report.error(line, " ".join(missing_message(name, getattr(row, name)) for name in unknown))
+				continue
+			tasks.append(
+				Task(
+					collector_id=row.collector,
+					manager_id=row.manager,
+					customer_id=row.customer,
+					amount_due=row.amount_due,
+					amount_due_at=row.amount_due_at,
+				)
+			)
+			lines.append(line)
+
+		try:
+			write_tasks(tasks)
+		except DatabaseError as e:
+			for line in lines:
+				report.error(line, f"The batch of this row could not be written: {e}")
+		else:
+			report.created += len(tasks)
+	return report.as_dict()
+
+
+def missing_message(name, pk):
+	return f"Missing {name}." if pk is None else f"Unknown {name} {pk}."
+
+
+def write_tasks(tasks):
+	"""Writes the `tasks` in one transaction, and bumps their collectors' versions."""
+	if not tasks:
+		return
+	with transaction.atomic():
+		if connection.vendor == "postgresql":
+			copy_tasks(tasks)
+		else:
+			Task.objects.bulk_create(tasks, batch_size=1_000)
+		# no post_save is sent, the versions are bumped here
+		CollectorBalance.bump_versions({task.collector_id for task in tasks})
+
+
+def copy_tasks(tasks):
+	"""Writes the `tasks` with PostgreSQL's COPY, through an in-memory CSV of the batch."""
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	for task in tasks:
+		writer.writerow(
+			(
+				task.manager_id,
+				task.collector_id,
+				task.customer_id,
+				task.amount_due,
+				task.amount_due_at.isoformat(),
+				task.is_collected,
+			)
+		)
+	buffer.seek(0)
+	qn = connection.ops.quote_name
+	columns = ", ".join(qn(Task._meta.get_field(name).column) for name in TASK_FIELDS)
+	with connection.cursor() as cursor:
+		# the psycopg2 cursor under Django's wrapper
+		cursor.cursor.copy_expert(
+			f"COPY {qn(Task._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer
+		)
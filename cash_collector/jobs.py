@@ -0,0 +1,139 @@
+"""
+A job queue in the database, for the work on a collector's data that doesn't have to happen in the request,
+see `Job` and the `run_workers` management command. It needs no other service than the database.
+
+A job is queued in the transaction of the write it follows, so it exists if and only if that write is
+committed, and the pending job of a collector is widened by the next writes instead of queuing more: a busy
+collector's rollups are rewritten once per run of the workers, not once per transaction.
+
+Workers claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers take different jobs
+without waiting for each other. A claimed job is no longer pending, writes meanwhile queue a new job which
+runs after it. A job is deleted once done. One that fails, or whose worker died (claimed for more than
+JOBS_CLAIM_TIMEOUT seconds), is retried with an exponential backoff, merged into the collector's pending job
+if there's one (which then carries the attempts and the backoff), until it has failed JOBS_MAX_ATTEMPTS
+times.
+"""
+
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, connections, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import CollectorBalance, CollectorDailyRollup, Job
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+# seconds before the first retry of a failed job, doubled on each attempt, and at most
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 60 * 60
+
+
+def rewrite_rollups(job):
+	CollectorDailyRollup.rewrite(job.collector_id, since=job.since)
+
+
+HANDLERS = {Job.ROLLUPS: rewrite_rollups}
+
+
+def claim(limit=BATCH_SIZE, at=None):
+	"""Claims up to `limit` due jobs, skipping those other workers are claiming, and returns them."""
+	at = at or timezone.now()
+	with transaction.atomic():
+		ids = list(
+			Job.objects.filter(claimed_at__isnull=True, run_after__lte=at)
+			.order_by("run_after", "id")
+			.select_for_update(skip_locked=True)
+			.values_list("id", flat=True)[:limit]
+		)
+		Job.objects.filter(id__in=ids).update(claimed_at=at, attempts=F("attempts") + 1)
+	return list(Job.objects.filter(id__in=ids).order_by("run_after", "id"))
+
+
+def run(job):
+	"""Runs a claimed job, deletes it once done or schedules its retry. Returns whether it was done."""
+	try:
+		with transaction.atomic():
+			# serialized with the collector's writes, and with another worker on the same collector's data
+			CollectorBalance.lock(job.collector_id)
+			HANDLERS[job.kind](job)
+			job.delete()
+	except Exception as e:
+		logger.exception("%s failed", job)
+		retry(job, f"{type(e).__name__}: {e}")
+		return False
+	return True
+
+
+def retry(job, error, at=None):
+	"""Schedules the retry of a claimed `job`, or marks it failed after JOBS_MAX_ATTEMPTS attempts."""
+	at = at or timezone.now()
+	with transaction.atomic():
+		# the lock serializes this with the jobs being queued for the collector, see `Job.enqueue`
+		CollectorBalance.lock(job.collector_id)
+		job = Job.objects.select_for_update().filter(pk=job.pk, failed_at__isnull=True).first()
+		if job is None:
+			return
+		if job.attempts >= settings.JOBS_MAX_ATTEMPTS:
+			Job.objects.filter(pk=job.pk).update(failed_at=at, last_error=error)
+			return
+		delay = min(RETRY_DELAY * 2 ** (job.attempts - 1), MAX_RETRY_DELAY)
+		run_after = at + timedelta(seconds=delay)
+		# the job queued since covers this one's work too, it takes over its attempts and backoff
+		merged = Job.widen(
+			job.kind,
+			job.collector_id,
+			job.since,
+			attempts=Greatest("attempts", Value(job.attempts)),
+			run_after=Greatest("run_after", Value(run_after)),
+			last_error=Value(error),
+		)
+		if merged:
+			job.delete()
+		else:
+			Job.objects.filter(pk=job.pk).update(claimed_at=None, run_after=run_after, last_error=error)
+
+
+def recover(at=None):
+	"""
+	Retries the jobs claimed for more than JOBS_CLAIM_TIMEOUT seconds, by workers that died. Returns how many.
+	"""
+	at = at or timezone.now()
+	stale = Job.objects.filter(
+		claimed_at__lt=at - timedelta(seconds=settings.JOBS_CLAIM_TIMEOUT), failed_at__isnull=True
+	)
+	jobs = list(stale)
+	for job in jobs:
+		retry(job, "Claimed by a worker that stopped.", at)
+	return len(jobs)
+
+
+def run_pending(limit=BATCH_SIZE):
+	"""Claims and runs up to `limit` due jobs, returns how many were claimed."""
+	jobs = claim(limit)
+	for job in jobs:
+		run(job)
+	return len(jobs)
+
+
+def work(stop, batch_size=BATCH_SIZE, poll_interval=1.0):
+	"""A worker: runs the due jobs until the `stop` event is set, polling every `poll_interval` seconds."""
+	try:
+		while not stop.is_set():
+			try:
+				if run_pending(batch_size):
+					continue
+				recover()
+			except DatabaseError:
+				logger.exception("The job queue can't be read")
+				# the connection may be broken, the next query opens another one
+				connections.close_all()
+			stop.wait(poll_interval)
+	finally:
+		# a thread's connections aren't closed with it
+		connections.close_all()
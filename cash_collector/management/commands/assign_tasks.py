@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from cash_collector import assignment
+
+
+class Command(BaseCommand):
+	help = (
+		"Assigns the unassigned open tasks to the collectors of their managers, by open tasks and due times. "
+		"Frozen and inactive collectors are left out."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--manager", type=int, action="append", help="Only assign this manager's tasks, can be repeated."
+		)
+		parser.add_argument("--capacity", type=int, help="The most open tasks a collector can be given.")
+		parser.add_argument("--limit", type=int, help="Only assign this many tasks, the ones due first.")
+
+	def handle(self, *args, **options):
+		result = assignment.assign(
+			manager_ids=options["manager"], capacity=options["capacity"], limit=options["limit"]
+		)
+		self.stdout.write(json.dumps(result))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from cash_collector.models import CollectorDailyRollup
+
+
+class Command(BaseCommand):
+	help = "Rebuilds the daily rollups of the collectors from the transaction ledger."
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--collector", type=int, action="append", help="Only this collector, can be repeated."
+		)
+
+	def handle(self, *args, **options):
+		with transaction.atomic():
+			written = CollectorDailyRollup.backfill(options["collector"])
+		self.stdout.write(self.style.SUCCESS(f"Wrote {written} daily rollup(s)."))
@@ -0,0 +1,81 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from cash_collector import benchmark
+from cash_collector.models import User
+
+
+class Command(BaseCommand):
+	help = (
+		"Benchmarks the API endpoints against the data made by `generate_data`, in process or over HTTP, "
+		"and reports throughput, latency percentiles and SQL queries per request as JSON."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--endpoint", action="append", choices=benchmark.ENDPOINTS, help="Defaults to all of them."
+		)
+		parser.add_argument("--requests", type=int, default=1_000, help="Requests per endpoint.")
+		parser.add_argument("--collectors", type=int, default=100, help="How many collectors to go round.")
+		parser.add_argument("--url", help="Base URL of a running API, e.g. http://localhost:8000/api/")
+		parser.add_argument("--concurrency", type=int, default=1, help="Concurrent clients, over HTTP only.")
+		parser.add_argument("--label", default="", help="Stored with the results, e.g. the version.")
+		parser.add_argument("--output", help="Writes the results to this JSON file.")
+		parser.add_argument("--compare", help="Results of a previous run (JSON file) to compare with.")
+		parser.add_argument(
+			"--serialization-rows",
+			type=int,
+			default=benchmark.MAX_TASKS_PAGE,
+			help="Also times rendering a /tasks page of that many rows with json and orjson, 0 to skip.",
+		)
+
+	def handle(self, *args, **options):
+		if options["url"]:
+			client = benchmark.HttpClient(options["url"])
+		elif options["concurrency"] != 1:
+			raise CommandError(
+				"--concurrency needs --url, in process the queries are counted one call at a time."
+			)
+		else:
+			client = benchmark.InProcessClient()
+
+		# the tokens aren't stored, the ones of the generated collectors follow from their usernames
+		tokens = list(
+			User.objects.filter(username__startswith="bench-collector-", is_manager=False)
+			.order_by("id")
+			.values_list("username", flat=True)[: options["collectors"]]
+		)
+		if not tokens:
+			raise CommandError("No generated collectors, run `manage.py generate_data` first.")
+
+		results = {
+			"label": options["label"],
+			"mode": client.mode,
+			"started_at": timezone.now().isoformat(),
+			"requests": options["requests"],
+			"collectors": len(tokens),
+			"concurrency": options["concurrency"],
+			"endpoints": {},
+		}
+		for endpoint in options["endpoint"] or benchmark.ENDPOINTS:
+			results["endpoints"][endpoint] = summary = benchmark.run_endpoint(
+				client, endpoint, tokens, options["requests"], options["concurrency"]
+			)
+			self.stdout.write(f"{endpoint}: {json.dumps(summary)}")
+
+		if options["serialization_rows"]:
+			results["serialization"] = benchmark.serialization(options["serialization_rows"])
+			self.stdout.write(f"serialization: {json.dumps(results['serialization'])}")
+
+		if options["output"]:
+			Path(options["output"]).write_text(json.dumps(results, indent=2))
+			self.stdout.write(self.style.SUCCESS(f"Results written to {options['output']}"))
+
+		if options["compare"]:
+			previous = json.loads(Path(options["compare"]).read_text())
+			for endpoint, metric, before, after, change in benchmark.compare(previous, results):
+				change = "n/a" if change is None else f"{change:+}%"
+				self.stdout.write(f"{endpoint} {metric}: {before} -> {after} ({change})")
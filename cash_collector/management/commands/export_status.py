@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from cash_collector import export
+
+
+class Command(BaseCommand):
+	help = (
+		"Exports the status of the collectors over time as CSV: each transaction with the balance after it, "
+		"and the instants collectors got frozen or unfrozen. The ledger is streamed, memory use stays flat."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--output", help="CSV file to write, default: standard output.")
+		parser.add_argument(
+			"--collector", type=int, action="append", help="Only export this collector, can be repeated."
+		)
+		parser.add_argument(
+			"--chunk-size",
+			type=int,
+			default=export.CHUNK_SIZE,
+			help="Rows fetched from the database at once.",
+		)
+
+	def handle(self, *args, **options):
+		rows = export.status_timeline(export.ledger(options["collector"], chunk_size=options["chunk_size"]))
+		lines = export.stream_csv(rows, chunk_size=options["chunk_size"])
+		if not options["output"]:
+			self.stdout.ending = ""
+			for chunk in lines:
+				self.stdout.write(chunk)
+			return
+
+		with open(options["output"], "w", newline="") as file:
+			file.writelines(lines)
+		self.stderr.write(self.style.SUCCESS(f"Status exported to {options['output']}"))
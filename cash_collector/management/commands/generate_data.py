@@ -0,0 +1,135 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from cash_collector import freeze
+from cash_collector.models import (
+	BalanceHistory,
+	CollectorBalance,
+	CollectorDailyRollup,
+	Customer,
+	Task,
+	Transaction,
+	User,
+)
+
+
+class Command(BaseCommand):
+	help = (
+		"Generates synthetic managers, collectors, customers, tasks and transactions for load testing. "
+		"Collector N authenticates with the token `bench-collector-N`, manager N with `bench-manager-N`."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--managers", type=int, default=10)
+		parser.add_argument("--collectors", type=int, default=100)
+		parser.add_argument("--customers", type=int, default=1_000)
+		parser.add_argument("--tasks-per-collector", type=int, default=100)
+		parser.add_argument(
+			"--collected-ratio", type=float, default=0.8, help="Share of the tasks already collected."
+		)
+		parser.add_argument(
+			"--pay-probability",
+			type=float,
+			default=0.2,
+			help="Chance that a collector pays his/her whole balance after a collection.",
+		)
+		parser.add_argument(
+			"--days", type=int, default=365, help="The tasks are due over the last DAYS days."
+		)
+		parser.add_argument("--batch-size", type=int, default=100, help="Collectors written per transaction.")
+		parser.add_argument("--seed", type=int, default=0)
+
+	def handle(self, *args, **options):
+		self.random = random.Random(options["seed"])
+		self.options = options
+		self.now = timezone.now()
+
+		managers = self.create_users("manager", options["managers"], is_manager=True)
+		collectors = self.create_users("collector", options["collectors"], managers=managers)
+		customers = Customer.objects.bulk_create(
+			[Customer(name=f"bench-customer-{i}") for i in range(options["customers"])], batch_size=10_000
+		)
+
+		transactions = 0
+		for start in range(0, len(collectors), options["batch_size"]):
+			with transaction.atomic():
+				for collector in collectors[start : start + options["batch_size"]]:
+					transactions += self.create_ledger(collector, customers)
+			self.stdout.write(
+				f"{min(start + options['batch_size'], len(collectors))}/{len(collectors)} collectors"
+			)
+
+		self.stdout.write(
+			self.style.SUCCESS(
+				f"Generated {len(managers)} managers, {len(collectors)} collectors, {len(customers)} "
+				f"customers, {len(collectors) * options['tasks_per_collector']} tasks and {transactions} "
+				"transactions."
+			)
+		)
+
+	def create_users(self, kind, count, is_manager=False, managers=()):
+		first = User.objects.filter(username__startswith=f"bench-{kind}-").count()
+		users = [
+			User(
+				username=f"bench-{kind}-{i}",
+				auth_token=f"bench-{kind}-{i}",
+				is_manager=is_manager,
+				manager=self.random.choice(managers) if managers else None,
+			)
+			for i in range(first, first + count)
+		]
+		return User.objects.bulk_create(users, batch_size=10_000)
+
+	def create_ledger(self, collector, customers):
+		"""
+		Creates the tasks of the collector, collects the first ones in due order and now and then pays the
+		balance. The balance, its history and the daily rollups are built along, as `Transaction.save` would.
+		"""
+		options = self.options
+		period = timezone.timedelta(days=options["days"])
+		due_dates = sorted(
+			self.now - period + period * self.random.random() for _ in range(options["tasks_per_collector"])
+		)
+		collected_count = int(len(due_dates) * options["collected_ratio"])
+		tasks = Task.objects.bulk_create(
+			[
+				Task(
+					manager_id=collector.manager_id,
+					collector=collector,
+					customer=self.random.choice(customers),
+					amount_due=self.random.randint(10, 2_000),
+					amount_due_at=due_at,
+					is_collected=i < collected_count,
+				)
+				for i, due_at in enumerate(due_dates)
+			]
+		)
+
+		transactions, history = [], []
+		state = freeze.INITIAL_STATE
+		for task in tasks[:collected_count]:
+			timestamp = task.amount_due_at + timezone.timedelta(minutes=self.random.randint(0, 120))
+			amounts = [task.amount_due]
+			if self.random.random() < options["pay_probability"]:
+				amounts.append(-(state.balance + task.amount_due))
+			for amount in amounts:
+				state = freeze.apply_transaction(state, amount, timestamp)
+				transactions.append(
+					Transaction(collector=collector, task=task, amount=amount, timestamp=timestamp)
+				)
+				history.append(BalanceHistory.from_state(collector.id, state))
+				timestamp += timezone.timedelta(minutes=1)
+
+		Transaction.objects.bulk_create(transactions, batch_size=10_000)
+		BalanceHistory.objects.bulk_create(history, batch_size=10_000)
+		rollups = CollectorDailyRollup.roll_up(
+			collector.id, 0, [(row.amount, row.timestamp) for row in transactions]
+		)
+		CollectorDailyRollup.objects.bulk_create(rollups.values(), batch_size=10_000)
+		balance = CollectorBalance(collector=collector)
+		balance.set_state(state)
+		balance.save()
+		return len(transactions)
@@ -0,0 +1,39 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cash_collector import ingest
+from cash_collector.models import User
+
+
+class Command(BaseCommand):
+	help = (
+		"Creates tasks from a CSV file (with a header row of collector, manager, customer, amount_due, "
+		"amount_due_at) or a JSONL file, in batches. Invalid rows are reported and skipped."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("path", help="The file to import, - for standard input.")
+		parser.add_argument("--format", choices=ingest.FORMATS, help="Default: from the file extension.")
+		parser.add_argument("--manager", type=int, help="Manager of the tasks whose row has none.")
+		parser.add_argument("--batch-size", type=int, default=ingest.BATCH_SIZE, help="Rows written at once.")
+
+	def handle(self, *args, **options):
+		if (
+			options["manager"] is not None
+			and not User.objects.filter(id=options["manager"], is_manager=True).exists()
+		):
+			raise CommandError(f"No manager with id {options['manager']}.")
+		file_format = options["format"] or ingest.format_of(options["path"])
+		if options["path"] == "-":
+			report = ingest.import_tasks(
+				sys.stdin.buffer, file_format, options["manager"], options["batch_size"]
+			)
+		else:
+			with open(options["path"], "rb") as file:
+				report = ingest.import_tasks(file, file_format, options["manager"], options["batch_size"])
+
+		for error in report["errors"]:
+			self.stderr.write(f"Line {error['line']}: {error['error']}")
+		self.stdout.write(json.dumps({"created": report["created"], "failed": report["failed"]}))
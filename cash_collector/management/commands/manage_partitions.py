@@ -0,0 +1,62 @@
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from cash_collector import partitions
+
+
+class Command(BaseCommand):
+	help = (
+		"Manages the monthly partitions of the transaction table (PostgreSQL): creates the ones of the next "
+		"months, meant to run periodically, and detaches or drops old ones. Detached months are no longer "
+		"part of the ledger, `rebuild_balances` would then only see the remaining transactions."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--convert", action="store_true", help="Partition the transaction table first, if it isn't yet."
+		)
+		parser.add_argument(
+			"--ahead",
+			type=int,
+			default=settings.TRANSACTION_PARTITIONS_AHEAD,
+			help="Months to create partitions for after the current one.",
+		)
+		parser.add_argument(
+			"--detach-before",
+			type=month,
+			metavar="YYYY-MM",
+			help="Detach the partitions of the months before this one, they're kept as plain tables.",
+		)
+		parser.add_argument("--drop", action="store_true", help="Drop the detached partitions.")
+
+	def handle(self, *args, **options):
+		if not partitions.is_supported(connection):
+			raise CommandError("Partitioning needs PostgreSQL.")
+		if options["drop"] and not options["detach_before"]:
+			raise CommandError("--drop goes with --detach-before.")
+
+		with transaction.atomic():
+			if not partitions.is_partitioned(connection):
+				if not options["convert"]:
+					raise CommandError("The transaction table isn't partitioned, run with --convert.")
+				partitions.convert(connection, ahead=options["ahead"])
+				self.stdout.write("Partitioned the transaction table.")
+
+			for name in partitions.create_future_partitions(connection, ahead=options["ahead"]):
+				self.stdout.write(f"Created {name}")
+
+			if options["detach_before"]:
+				detached = partitions.detach_partitions(
+					connection, before=options["detach_before"], drop=options["drop"]
+				)
+				for name in detached:
+					self.stdout.write(f"{'Dropped' if options['drop'] else 'Detached'} {name}")
+
+		self.stdout.write(self.style.SUCCESS(f"Partitions: {', '.join(partitions.partitions(connection))}"))
+
+
+def month(value):
+	return datetime.strptime(value, "%Y-%m").replace(tzinfo=timezone.utc)
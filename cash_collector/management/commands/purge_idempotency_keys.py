@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cash_collector.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+	help = "Deletes the expired idempotency keys, meant to run periodically, e.g. from cron."
+
+	def add_arguments(self, parser):
+		parser.add_argument("--batch-size", type=int, default=10_000, help="Keys deleted per statement.")
+
+	def handle(self, *args, **options):
+		# small batches keep the locks short, the expiry index finds them
+		now = timezone.now()
+		deleted = 0
+		while True:
+			batch = list(
+				IdempotencyKey.objects.filter(expires_at__lte=now).values_list("id", flat=True)[
+					: options["batch_size"]
+				]
+			)
+			if not batch:
+				break
+			deleted += IdempotencyKey.objects.filter(id__in=batch).delete()[0]
+
+		self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} expired idempotency keys."))
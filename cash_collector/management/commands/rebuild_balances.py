@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cash_collector.models import CollectorBalance
+
+
+class Command(BaseCommand):
+	help = "Rebuilds the materialized collector balances from the transaction ledger."
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--verify",
+			action="store_true",
+			help="Only report the balances that don't match the ledger, without fixing them.",
+		)
+		parser.add_argument(
+			"--history",
+			action="store_true",
+			help="Also rewrite the balance history of every collector, e.g. after changing the thresholds.",
+		)
+
+	def handle(self, *args, **options):
+		if options["verify"]:
+			mismatches = CollectorBalance.find_mismatches()
+			for collector_id, stored, expected in mismatches:
+				self.stdout.write(f"collector {collector_id}: stored {stored}, ledger {expected}")
+			if mismatches:
+				raise CommandError(f"{len(mismatches)} balance(s) don't match the ledger.")
+			self.stdout.write(self.style.SUCCESS("All balances match the ledger."))
+			return
+
+		fixed = CollectorBalance.rebuild(history=options["history"])
+		self.stdout.write(self.style.SUCCESS(f"Rebuilt balances, {fixed} balance(s) fixed."))
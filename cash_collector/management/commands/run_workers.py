@@ -0,0 +1,54 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from cash_collector import jobs
+
+
+class Command(BaseCommand):
+	help = (
+		"Runs the queued jobs (see cash_collector.jobs) until interrupted or terminated, in --concurrency "
+		"threads. With --once, runs the jobs due and exits, e.g. from cron."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--concurrency", type=int, default=1, help="Jobs run at the same time.")
+		parser.add_argument(
+			"--batch-size", type=int, default=jobs.BATCH_SIZE, help="Jobs a worker claims at a time."
+		)
+		parser.add_argument(
+			"--poll-interval", type=float, default=1.0, help="Seconds between polls when no job is due."
+		)
+		parser.add_argument("--once", action="store_true", help="Run the jobs due, then exit.")
+
+	def handle(self, *args, **options):
+		if options["once"]:
+			recovered = jobs.recover()
+			count = 0
+			while claimed := jobs.run_pending(options["batch_size"]):
+				count += claimed
+			self.stdout.write(self.style.SUCCESS(f"Ran {count} job(s), {recovered} recovered."))
+			return
+
+		stop = threading.Event()
+		signal.signal(signal.SIGTERM, lambda *_: stop.set())
+		workers = [
+			threading.Thread(
+				target=jobs.work,
+				args=(stop, options["batch_size"], options["poll_interval"]),
+				name=f"worker-{i}",
+			)
+			for i in range(options["concurrency"])
+		]
+		for worker in workers:
+			worker.start()
+		self.stdout.write(f"Running {len(workers)} worker(s).")
+		try:
+			while not stop.wait(1):
+				pass
+		except KeyboardInterrupt:
+			stop.set()
+		for worker in workers:
+			worker.join()
+		self.stdout.write(self.style.SUCCESS("Stopped."))
@@ -0,0 +1,56 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from cash_collector import simulation
+from cash_collector.renderers import dumps
+
+
+class Command(BaseCommand):
+	help = (
+		"Replays the transaction ledger under other freeze thresholds, and tells how many collectors would "
+		"have been frozen and for how long. Every --usd threshold is paired with every --days threshold."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--usd",
+			type=Decimal,
+			action="append",
+			help="A USD threshold, can be repeated. Default: USD_THRESHOLD.",
+		)
+		parser.add_argument(
+			"--days",
+			type=int,
+			action="append",
+			help="A days threshold, can be repeated. Default: DAYS_THRESHOLD.",
+		)
+		parser.add_argument(
+			"--at",
+			type=instant,
+			help="Replay the ledger up to this ISO 8601 instant, in TIME_ZONE unless it has an offset.",
+		)
+		parser.add_argument(
+			"--chunk-size", type=int, default=simulation.CHUNK_SIZE, help="Transactions read at a time."
+		)
+
+	def handle(self, *args, **options):
+		results = simulation.simulate(
+			options["usd"] or [settings.USD_THRESHOLD],
+			options["days"] or [settings.DAYS_THRESHOLD],
+			at=options["at"],
+			chunk_size=options["chunk_size"],
+		)
+		for result in results:
+			self.stdout.write(dumps(result).decode())
+
+
+def instant(value):
+	"""An aware datetime, argparse reports the ValueError of an invalid one."""
+	at = parse_datetime(value)
+	if at is None:
+		raise ValueError(value)
+	return at if timezone.is_aware(at) else timezone.make_aware(at)
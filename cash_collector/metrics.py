@@ -0,0 +1,264 @@
+"""
+Per-request instrumentation: `RequestMetricsMiddleware` records the latency, SQL queries, SQL time and
+response size of every request by route, in histograms kept in memory by each process, and the `/metrics`
+view serves them in the Prometheus text format.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.db import connections
+from django.http import HttpResponse
+
+from .token_cache import token_cache
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+# name: (help, buckets)
+HISTOGRAMS = {
+	"http_request_duration_seconds": ("Time to serve the request, streaming included.", LATENCY_BUCKETS),
+	"http_request_sql_queries": ("SQL queries run by the request.", QUERY_BUCKETS),
+	"http_request_sql_duration_seconds": ("Time spent running the request's SQL queries.", LATENCY_BUCKETS),
+	"http_response_size_bytes": ("Size of the response body.", SIZE_BUCKETS),
+}
+
+
+class Histogram:
+	"""Cumulative buckets, sum and count of the observed values, like a Prometheus histogram."""
+
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def cumulative_counts(self):
+		total = 0
+		for count in self.counts:
+			total += count
+			yield total
+
+
+class Metrics:
+	"""The histograms of every (metric, route, method) and the request count by status code."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.clear()
+
+	def clear(self):
+		with self.lock:
+			self.histograms = {}
+			self.requests = {}
+
+	def observe(self, route, method, status_code, values):
+		"""`values` maps the names of `HISTOGRAMS` to the values observed by a request."""
+		with self.lock:
+			key = (route, method, str(status_code))
+			self.requests[key] = self.requests.get(key, 0) + 1
+			for name, value in values.items():
+				histogram = self.histograms.get((name, route, method))
+				if histogram is None:
+					histogram = self.histograms[name, route, method] = Histogram(HISTOGRAMS[name][1])
+				histogram.observe(value)
+
+	def render(self):
+		"""The metrics in the Prometheus text exposition format."""
+		lines = [
+			"# HELP http_requests_total Requests served, by route, method and status code.",
+			"# TYPE http_requests_total counter",
+		]
+		with self.lock:
+			for (route, method, status_code), count in sorted(self.requests.items()):
+				labels = format_labels(route=route, method=method, status=status_code)
+				lines.append(f"http_requests_total{labels} {count}")
+
+			for name, (help_text, buckets) in HISTOGRAMS.items():
+				lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+				for (histogram_name, route, method), histogram in sorted(self.histograms.items()):
+					if histogram_name != name:
+						continue
+					bounds = [*map(format_value, buckets), "+Inf"]
+					for bound, count in zip(bounds, histogram.cumulative_counts(), strict=True):
+						labels = format_labels(route=route, method=method, le=bound)
+						lines.append(f"{name}_bucket{labels} {count}")
+					labels = format_labels(route=route, method=method)
+					lines.append(f"{name}_sum{labels} {format_value(histogram.sum)}")
+					lines.append(f"{name}_count{labels} {histogram.count}")
+
+		stats = token_cache.stats()
+		lines += [
+			"# HELP auth_token_cache_hits_total Bearer tokens authenticated from the cache.",
+			"# TYPE auth_token_cache_hits_total counter",
+			f"auth_token_cache_hits_total {stats['hits']}",
+			"# HELP auth_token_cache_misses_total Bearer tokens looked up in the database.",
+			"# TYPE auth_token_cache_misses_total counter",
+			f"auth_token_cache_misses_total {stats['misses']}",
+			"# HELP auth_token_cache_size Users in the cache.",
+			"# TYPE auth_token_cache_size gauge",
+			f"auth_token_cache_size {stats['size']}",
+		]
+		return "\n".join(lines) + "\n"
+
+
+def format_labels(**labels):
+	escaped = (
+		(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+		for name, value in labels.items()
+	)
+	return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+
+
+class QueryRecorder:
+	"""A `connection.execute_wrapper` counting and timing the queries, and keeping their statements."""
+
+	def __init__(self):
+		self.count = 0
+		self.duration = 0
+		self.statements = []
+
+	def __call__(self, execute, sql, params, many, context):
+		started = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			duration = time.perf_counter() - started
+			self.count += 1
+			self.duration += duration
+			self.statements.append((sql, duration))
+
+
+class RequestMetricsMiddleware:
+	"""
+	Records the metrics of each request. The queries of a streaming response run while its content is
+	consumed, so they're recorded once the response is closed. Requests over `METRICS_QUERY_BUDGET` queries or
+	`METRICS_LATENCY_BUDGET` seconds are logged with their statements.
+
+	It's async capable, so the async API isn't switched to a thread and back around it. Under ASGI the ORM
+	runs in the request's thread (`sync_to_async`), the queries are recorded on that thread's connections.
+	"""
+
+	sync_capable = True
+	async_capable = True
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+		if iscoroutinefunction(get_response):
+			markcoroutinefunction(self)
+
+	def __call__(self, request):
+		if iscoroutinefunction(self):
+			return self.__acall__(request)
+		started = time.perf_counter()
+		recorder = QueryRecorder()
+		stack = self.wrap_connections(recorder)
+		try:
+			response = self.get_response(request)
+		except BaseException:
+			stack.close()
+			raise
+		return self.meter(request, response, started, recorder, stack)
+
+	async def __acall__(self, request):
+		started = time.perf_counter()
+		recorder = QueryRecorder()
+		stack = await sync_to_async(self.wrap_connections)(recorder)
+		try:
+			response = await self.get_response(request)
+		except BaseException:
+			stack.close()
+			raise
+		return self.meter(request, response, started, recorder, stack)
+
+	@staticmethod
+	def wrap_connections(recorder):
+		"""Records the queries on the current thread's connections until the returned stack is closed."""
+		stack = ExitStack()
+		for alias in connections:
+			stack.enter_context(connections[alias].execute_wrapper(recorder))
+		return stack
+
+	def meter(self, request, response, started, recorder, stack):
+		def finish(size):
+			stack.close()
+			self.record(request, response, started, recorder, size)
+
+		if response.streaming and not response.is_async:
+			response.streaming_content = MeteredContent(response.streaming_content, finish)
+		else:
+			finish(len(response.content) if not response.streaming else 0)
+		return response
+
+	def record(self, request, response, started, recorder, size):
+		duration = time.perf_counter() - started
+		match = request.resolver_match
+		route = match.route if match else "unmatched"
+		metrics.observe(
+			route,
+			request.method,
+			response.status_code,
+			{
+				"http_request_duration_seconds": duration,
+				"http_request_sql_queries": recorder.count,
+				"http_request_sql_duration_seconds": recorder.duration,
+				"http_response_size_bytes": size,
+			},
+		)
+		if recorder.count > settings.METRICS_QUERY_BUDGET or duration > settings.METRICS_LATENCY_BUDGET:
+			logger.warning(
+				"%s %s took %.3fs and %d queries (%.3fs):\n%s",
+				request.method,
+				request.path,
+				duration,
+				recorder.count,
+				recorder.duration,
+				"\n".join(f"{sql_duration:.4f}s {sql}" for sql, sql_duration in recorder.statements),
+			)
+
+
+class MeteredContent:
+	"""Streaming content counting its size, `on_close(size)` is called when the response is closed."""
+
+	def __init__(self, content, on_close):
+		self.content = content
+		self.on_close = on_close
+		self.size = 0
+
+	def __iter__(self):
+		for chunk in self.content:
+			self.size += len(chunk)
+			yield chunk
+
+	def close(self):
+		if self.on_close is not None:
+			on_close, self.on_close = self.on_close, None
+			on_close(self.size)
+
+
+def metrics_view(request):
+	"""The metrics of this process, for Prometheus to scrape."""
+	if request.META.get("REMOTE_ADDR") not in settings.METRICS_ALLOWED_IPS:
+		raise PermissionDenied
+	return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
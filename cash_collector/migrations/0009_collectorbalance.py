@@ -0,0 +1,41 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_balances(apps, schema_editor):
+	Transaction = apps.get_model("cash_collector", "Transaction")
+	CollectorBalance = apps.get_model("cash_collector", "CollectorBalance")
+	totals = Transaction.objects.values("collector_id").annotate(total=Sum("amount")).order_by()
+	CollectorBalance.objects.bulk_create(
+		[CollectorBalance(collector_id=row["collector_id"], amount=row["total"]) for row in totals]
+	)
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0008_remove_transaction_deleted_and_more"),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name="CollectorBalance",
+			fields=[
+				(
+					"collector",
+					models.OneToOneField(
+						on_delete=django.db.models.deletion.CASCADE,
+						primary_key=True,
+						related_name="balance",
+						serialize=False,
+						to="cash_collector.user",
+					),
+				),
+				("amount", models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+				("updated_at", models.DateTimeField(auto_now=True)),
+			],
+		),
+		migrations.RunPython(populate_balances, migrations.RunPython.noop),
+	]
@@ -0,0 +1,62 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:10
+
+from itertools import groupby
+from operator import itemgetter
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def populate_freeze_deadlines(apps, schema_editor):
+	# the rule is replayed by the app's own code so the migration can't drift from it
+	from cash_collector import freeze
+
+	Transaction = apps.get_model("cash_collector", "Transaction")
+	CollectorBalance = apps.get_model("cash_collector", "CollectorBalance")
+	rows = (
+		Transaction.objects.order_by("collector_id", "timestamp", "id")
+		.values_list("collector_id", "amount", "timestamp")
+		.iterator(chunk_size=10_000)
+	)
+	for collector_id, collector_rows in groupby(rows, key=itemgetter(0)):
+		state = freeze.replay((amount, timestamp) for _, amount, timestamp in collector_rows)
+		CollectorBalance.objects.filter(collector_id=collector_id).update(
+			amount=state.balance,
+			threshold_reached_at=state.threshold_reached_at,
+			frozen_at=state.frozen_at,
+			last_transaction_at=state.last_transaction_at,
+		)
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0009_collectorbalance"),
+	]
+
+	operations = [
+		migrations.RemoveField(
+			model_name="user",
+			name="is_frozen",
+		),
+		migrations.AddField(
+			model_name="collectorbalance",
+			name="frozen_at",
+			field=models.DateTimeField(blank=True, db_index=True, null=True),
+		),
+		migrations.AddField(
+			model_name="collectorbalance",
+			name="last_transaction_at",
+			field=models.DateTimeField(blank=True, null=True),
+		),
+		migrations.AddField(
+			model_name="collectorbalance",
+			name="threshold_reached_at",
+			field=models.DateTimeField(blank=True, null=True),
+		),
+		migrations.AlterField(
+			model_name="transaction",
+			name="timestamp",
+			field=models.DateTimeField(default=django.utils.timezone.now),
+		),
+		migrations.RunPython(populate_freeze_deadlines, migrations.RunPython.noop),
+	]
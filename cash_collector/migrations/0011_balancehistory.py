@@ -0,0 +1,71 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:11
+
+from itertools import groupby
+from operator import itemgetter
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_balance_history(apps, schema_editor):
+	from cash_collector import freeze
+
+	Transaction = apps.get_model("cash_collector", "Transaction")
+	BalanceHistory = apps.get_model("cash_collector", "BalanceHistory")
+	rows = (
+		Transaction.objects.order_by("collector_id", "timestamp", "id")
+		.values_list("collector_id", "amount", "timestamp")
+		.iterator(chunk_size=10_000)
+	)
+	for collector_id, collector_rows in groupby(rows, key=itemgetter(0)):
+		state = freeze.INITIAL_STATE
+		history = []
+		for _, amount, timestamp in collector_rows:
+			state = freeze.apply_transaction(state, amount, timestamp)
+			history.append(
+				BalanceHistory(
+					collector_id=collector_id,
+					timestamp=timestamp,
+					amount=state.balance,
+					threshold_reached_at=state.threshold_reached_at,
+					frozen_at=state.frozen_at,
+				)
+			)
+		BalanceHistory.objects.bulk_create(history, batch_size=1_000)
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0010_collector_freeze_deadline"),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name="BalanceHistory",
+			fields=[
+				(
+					"id",
+					models.BigAutoField(
+						auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+					),
+				),
+				("timestamp", models.DateTimeField()),
+				("amount", models.DecimalField(decimal_places=2, max_digits=12)),
+				("threshold_reached_at", models.DateTimeField(blank=True, null=True)),
+				("frozen_at", models.DateTimeField(blank=True, null=True)),
+				(
+					"collector",
+					models.ForeignKey(
+						on_delete=django.db.models.deletion.CASCADE,
+						related_name="balance_history",
+						to="cash_collector.user",
+					),
+				),
+			],
+			options={
+				"verbose_name_plural": "balance history",
+				"indexes": [models.Index(fields=["collector", "timestamp"], name="balance_history_at_idx")],
+			},
+		),
+		migrations.RunPython(populate_balance_history, migrations.RunPython.noop),
+	]
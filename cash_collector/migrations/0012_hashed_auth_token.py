@@ -0,0 +1,48 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:14
+
+import hashlib
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def hash_auth_tokens(apps, schema_editor):
+	User = apps.get_model("cash_collector", "User")
+	# a token shared by several users can't tell them apart, they'll have to get new ones
+	shared = (
+		User.objects.exclude(auth_token__isnull=True)
+		.exclude(auth_token="")
+		.values("auth_token")
+		.annotate(users=Count("id"))
+		.filter(users__gt=1)
+		.values_list("auth_token", flat=True)
+	)
+	for user in (
+		User.objects.exclude(auth_token__isnull=True).exclude(auth_token="").exclude(auth_token__in=shared)
+	):
+		user.auth_token_hash = hashlib.sha256(user.auth_token.encode()).hexdigest()
+		user.save(update_fields=["auth_token_hash"])
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0011_balancehistory"),
+	]
+
+	operations = [
+		migrations.AddField(
+			model_name="user",
+			name="auth_token_hash",
+			field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+		),
+		migrations.RunPython(hash_auth_tokens, migrations.RunPython.noop),
+		migrations.AlterField(
+			model_name="user",
+			name="auth_token_hash",
+			field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+		),
+		migrations.RemoveField(
+			model_name="user",
+			name="auth_token",
+		),
+	]
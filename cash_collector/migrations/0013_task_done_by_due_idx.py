@@ -0,0 +1,20 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0012_hashed_auth_token"),
+	]
+
+	operations = [
+		migrations.AddIndex(
+			model_name="task",
+			index=models.Index(
+				condition=models.Q(("is_collected", True)),
+				fields=["collector", "amount_due_at", "id"],
+				name="task_done_by_due_idx",
+			),
+		),
+	]
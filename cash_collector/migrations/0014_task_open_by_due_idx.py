@@ -0,0 +1,21 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0013_task_done_by_due_idx"),
+	]
+
+	operations = [
+		migrations.AddIndex(
+			model_name="task",
+			index=models.Index(
+				condition=models.Q(("is_collected", False)),
+				fields=["collector", "amount_due_at", "id"],
+				include=("customer", "amount_due"),
+				name="task_open_by_due_idx",
+			),
+		),
+	]
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0014_task_open_by_due_idx"),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name="IdempotencyKey",
+			fields=[
+				(
+					"id",
+					models.BigAutoField(
+						auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+					),
+				),
+				("key", models.CharField(max_length=255)),
+				("fingerprint", models.CharField(max_length=64)),
+				("response", models.JSONField(blank=True, null=True)),
+				("created_at", models.DateTimeField(auto_now_add=True)),
+				("expires_at", models.DateTimeField(db_index=True)),
+				(
+					"user",
+					models.ForeignKey(
+						on_delete=django.db.models.deletion.CASCADE,
+						related_name="idempotency_keys",
+						to="cash_collector.user",
+					),
+				),
+			],
+		),
+		migrations.AddConstraint(
+			model_name="idempotencykey",
+			constraint=models.UniqueConstraint(fields=("user", "key"), name="idempotency_key_user_key_uniq"),
+		),
+	]
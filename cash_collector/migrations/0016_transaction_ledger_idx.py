@@ -0,0 +1,16 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0015_idempotencykey"),
+	]
+
+	operations = [
+		migrations.AddIndex(
+			model_name="transaction",
+			index=models.Index(fields=["collector", "timestamp", "id"], name="transaction_ledger_idx"),
+		),
+	]
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.db import migrations
+
+
+def partition_transaction(apps, schema_editor):
+	from cash_collector import partitions
+
+	connection = schema_editor.connection
+	if settings.TRANSACTION_PARTITIONING and partitions.is_supported(connection):
+		partitions.convert(connection, ahead=settings.TRANSACTION_PARTITIONS_AHEAD)
+
+
+def unpartition_transaction(apps, schema_editor):
+	from cash_collector import partitions
+
+	connection = schema_editor.connection
+	if partitions.is_supported(connection) and partitions.is_partitioned(connection):
+		partitions.revert(connection)
+
+
+class Migration(migrations.Migration):
+	"""
+	Partitions the transaction table by month when TRANSACTION_PARTITIONING is set, on PostgreSQL. Otherwise
+	it does nothing, and the table can be converted later with `manage.py manage_partitions --convert`.
+	"""
+
+	dependencies = [
+		("cash_collector", "0016_transaction_ledger_idx"),
+	]
+
+	operations = [
+		migrations.RunPython(partition_transaction, unpartition_transaction, elidable=False),
+	]
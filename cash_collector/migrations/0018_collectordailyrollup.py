@@ -0,0 +1,85 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:33
+
+from decimal import Decimal
+from itertools import groupby
+from operator import itemgetter
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def populate_daily_rollups(apps, schema_editor):
+	Transaction = apps.get_model("cash_collector", "Transaction")
+	CollectorDailyRollup = apps.get_model("cash_collector", "CollectorDailyRollup")
+	rows = (
+		Transaction.objects.order_by("collector_id", "timestamp", "id")
+		.values_list("collector_id", "amount", "timestamp")
+		.iterator(chunk_size=10_000)
+	)
+	for collector_id, collector_rows in groupby(rows, key=itemgetter(0)):
+		balance = Decimal(0)
+		rollups = {}
+		for _, amount, timestamp in collector_rows:
+			day = timezone.localdate(timestamp)
+			rollup = rollups.get(day)
+			if rollup is None:
+				rollup = rollups[day] = CollectorDailyRollup(
+					collector_id=collector_id,
+					day=day,
+					collected=Decimal(0),
+					paid=Decimal(0),
+					transactions=0,
+					closing_balance=balance,
+					peak_balance=balance,
+				)
+			balance += amount
+			if amount > 0:
+				rollup.collected += amount
+			else:
+				rollup.paid -= amount
+			rollup.transactions += 1
+			rollup.closing_balance = balance
+			rollup.peak_balance = max(rollup.peak_balance, balance)
+		CollectorDailyRollup.objects.bulk_create(rollups.values(), batch_size=1_000)
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0017_partition_transaction"),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name="CollectorDailyRollup",
+			fields=[
+				(
+					"id",
+					models.BigAutoField(
+						auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+					),
+				),
+				("day", models.DateField()),
+				("collected", models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+				("paid", models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+				("transactions", models.PositiveIntegerField(default=0)),
+				("closing_balance", models.DecimalField(decimal_places=2, max_digits=12)),
+				("peak_balance", models.DecimalField(decimal_places=2, max_digits=12)),
+				(
+					"collector",
+					models.ForeignKey(
+						on_delete=django.db.models.deletion.CASCADE,
+						related_name="daily_rollups",
+						to="cash_collector.user",
+					),
+				),
+			],
+		),
+		migrations.AddConstraint(
+			model_name="collectordailyrollup",
+			constraint=models.UniqueConstraint(
+				fields=("collector", "day"), name="daily_rollup_collector_day_uniq"
+			),
+		),
+		migrations.RunPython(populate_daily_rollups, migrations.RunPython.noop),
+	]
@@ -0,0 +1,17 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0018_collectordailyrollup"),
+	]
+
+	operations = [
+		migrations.AddField(
+			model_name="collectorbalance",
+			name="version",
+			field=models.PositiveBigIntegerField(default=0),
+		),
+	]
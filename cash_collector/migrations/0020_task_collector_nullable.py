@@ -0,0 +1,24 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0019_collectorbalance_version"),
+	]
+
+	operations = [
+		migrations.AlterField(
+			model_name="task",
+			name="collector",
+			field=models.ForeignKey(
+				blank=True,
+				null=True,
+				on_delete=django.db.models.deletion.CASCADE,
+				related_name="tasks",
+				to="cash_collector.user",
+			),
+		),
+	]
@@ -0,0 +1,64 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:52
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class AddIndexWithoutLocking(AddIndexConcurrently):
+	"""
+	Adds the index with CREATE INDEX CONCURRENTLY on PostgreSQL, so the table stays writable while it's built,
+	and a plain CREATE INDEX on the other databases. On the partitioned transaction table, which CONCURRENTLY
+	doesn't support, the index is created on the parent table only, then concurrently on each partition and
+	attached (see `partitions.create_index_concurrently`), to the same effect.
+	"""
+
+	def database_forwards(self, app_label, schema_editor, from_state, to_state):
+		connection = schema_editor.connection
+		model = to_state.apps.get_model(app_label, self.model_name)
+		if connection.vendor != "postgresql":
+			return migrations.AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+		if not self.on_partitioned_table(model, connection):
+			return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+		from cash_collector import partitions
+
+		self._ensure_not_in_transaction(schema_editor)
+		columns = [model._meta.get_field(field).column for field in self.index.fields]
+		partitions.create_index_concurrently(connection, self.index.name, columns)
+
+	def database_backwards(self, app_label, schema_editor, from_state, to_state):
+		connection = schema_editor.connection
+		model = from_state.apps.get_model(app_label, self.model_name)
+		# DROP INDEX CONCURRENTLY doesn't work on a partitioned table either, the plain one drops the
+		# partitions' indexes along
+		if connection.vendor != "postgresql" or self.on_partitioned_table(model, connection):
+			return migrations.AddIndex.database_backwards(
+				self, app_label, schema_editor, from_state, to_state
+			)
+		return super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+	@staticmethod
+	def on_partitioned_table(model, connection):
+		from cash_collector import partitions
+
+		return model._meta.db_table == partitions.TABLE and partitions.is_partitioned(connection)
+
+
+class Migration(migrations.Migration):
+	# CREATE INDEX CONCURRENTLY can't run in a transaction
+	atomic = False
+
+	dependencies = [
+		("cash_collector", "0020_task_collector_nullable"),
+	]
+
+	operations = [
+		AddIndexWithoutLocking(
+			model_name="task",
+			index=models.Index(fields=["amount_due_at"], name="task_due_idx"),
+		),
+		AddIndexWithoutLocking(
+			model_name="transaction",
+			index=models.Index(fields=["timestamp"], name="transaction_timestamp_idx"),
+		),
+	]
@@ -0,0 +1,58 @@
+# Generated by Django 5.0.4 on 2026-10-18 13:54
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0021_admin_date_idx"),
+	]
+
+	operations = [
+		migrations.CreateModel(
+			name="Job",
+			fields=[
+				(
+					"id",
+					models.BigAutoField(
+						auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+					),
+				),
+				("kind", models.CharField(choices=[("rollups", "Rewrite the daily rollups")], max_length=32)),
+				("since", models.DateTimeField(blank=True, null=True)),
+				("run_after", models.DateTimeField(default=django.utils.timezone.now)),
+				("claimed_at", models.DateTimeField(blank=True, null=True)),
+				("attempts", models.PositiveIntegerField(default=0)),
+				("last_error", models.TextField(blank=True)),
+				("failed_at", models.DateTimeField(blank=True, null=True)),
+				("created_at", models.DateTimeField(auto_now_add=True)),
+				(
+					"collector",
+					models.ForeignKey(
+						on_delete=django.db.models.deletion.CASCADE,
+						related_name="jobs",
+						to="cash_collector.user",
+					),
+				),
+			],
+			options={
+				"indexes": [
+					models.Index(
+						condition=models.Q(("claimed_at__isnull", True)),
+						fields=["run_after", "id"],
+						name="job_pending_idx",
+					)
+				],
+			},
+		),
+		migrations.AddConstraint(
+			model_name="job",
+			constraint=models.UniqueConstraint(
+				condition=models.Q(("claimed_at__isnull", True)),
+				fields=("kind", "collector"),
+				name="job_pending_uniq",
+			),
+		),
+	]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.4 on 2026-10-18 14:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+	dependencies = [
+		("cash_collector", "0022_job"),
+	]
+
+	operations = [
+		migrations.AlterField(
+			model_name="transaction",
+			name="task",
+			field=models.ForeignKey(
+				on_delete=django.db.models.deletion.PROTECT,
+				related_name="transactions",
+				to="cash_collector.task",
+			),
+		),
+	]
@@ -1,17 +1,31 @@
+import hashlib
+import secrets
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
+
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Sum
+from django.db import connection, models, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from . import freeze
+from .token_cache import token_cache
+
 
 class User(AbstractUser):
 	is_manager = models.BooleanField(default=False)
 	manager = models.ForeignKey("self", on_delete=models.SET_NULL, null=True, blank=True)
-	is_frozen = models.BooleanField(default=False)
-	auth_token = models.CharField(max_length=100, blank=True, null=True)
+	# only the hash of the bearer token is stored, see `auth_token`
+	auth_token_hash = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
 	# Add related_name arguments to the groups and user_permissions fields
 	groups = models.ManyToManyField(
 		"auth.Group",
@@ -35,6 +49,39 @@ class User(AbstractUser):
 		if self.is_manager and self.manager is not None:
 			raise ValidationError({"manager": _("A manager cannot have a manager.")})
 
+	@property
+	def auth_token(self):
+		"""The bearer token, only known right after it was set on this instance."""
+		return getattr(self, "_auth_token", None)
+
+	@auth_token.setter
+	def auth_token(self, token):
+		self._auth_token = token
+		self.auth_token_hash = self.hash_auth_token(token) if token else None
+
+	@staticmethod
+	def hash_auth_token(token):
+		# tokens are random, so unlike passwords a fast unsalted hash is enough and keeps the lookup indexable
+		return hashlib.sha256(token.encode()).hexdigest()
+
+	def rotate_auth_token(self):
+		"""Replaces the bearer token of the user with a new random one, returns it."""
+		self.auth_token = secrets.token_urlsafe(32)
+		self.save(update_fields=["auth_token_hash"])
+		return self.auth_token
+
+	def save(self, *args, **kwargs):
+		super().save(*args, **kwargs)
+		# the token may have been rotated or the user deactivated
+		token_cache.invalidate(user_id=self.pk, token_hash=self.auth_token_hash)
+
+	@property
+	def is_frozen(self):
+		try:
+			return self.balance.is_frozen()
+		except CollectorBalance.DoesNotExist:
+			return False
+
 	def __str__(self):
 		return self.username
 
@@ -51,19 +98,60 @@ class Customer(models.Model):
 
 class Task(models.Model):
 	manager = models.ForeignKey(User, related_name="tasks_created", on_delete=models.CASCADE)
-	collector = models.ForeignKey(User, related_name="tasks", on_delete=models.CASCADE)
+	# null until the task is assigned, by hand or by `cash_collector.assignment`
+	collector = models.ForeignKey(User, related_name="tasks", on_delete=models.CASCADE, null=True, blank=True)
 	customer = models.ForeignKey(Customer, related_name="tasks", on_delete=models.CASCADE)
 
 	amount_due = models.DecimalField(max_digits=10, decimal_places=2)
 	amount_due_at = models.DateTimeField()
 	is_collected = models.BooleanField(default=False)
 
+	class Meta:
+		indexes = [
+			# /tasks pages through a collector's done tasks by (amount_due_at, id)
+			models.Index(
+				fields=["collector", "amount_due_at", "id"],
+				condition=models.Q(is_collected=True),
+				name="task_done_by_due_idx",
+			),
+			# /next_task reads the first open task of a collector by due date, the included columns let it
+			# skip the table on PostgreSQL
+			models.Index(
+				fields=["collector", "amount_due_at", "id"],
+				condition=models.Q(is_collected=False),
+				include=["customer", "amount_due"],
+				name="task_open_by_due_idx",
+			),
+			# the admin's date drill-down reads the first and last due dates, then a year or month of them
+			models.Index(fields=["amount_due_at"], name="task_due_idx"),
+		]
+
+	@classmethod
+	def from_db(cls, db, field_names, values):
+		task = super().from_db(db, field_names, values)
+		# the collector the task was read for, whose version is bumped too if it's reassigned
+		task._loaded_collector_id = task.__dict__.get("collector_id")
+		return task
+
 	def remaining_amount(self):
 		if self.is_collected:
 			return 0
 		total_collected = self.transactions.aggregate(Sum("amount"))["amount__sum"] or 0
 		return self.amount_due - total_collected
 
+	@staticmethod
+	def collected_amount():
+		"""Expression of the amount collected so far for the task, to annotate tasks with."""
+		return Coalesce(
+			Subquery(
+				Transaction.objects.filter(task=OuterRef("pk"))
+				.values("task")
+				.annotate(total=Sum("amount"))
+				.values("total")
+			),
+			Value(Decimal(0)),
+		)
+
 	def __str__(self):
 		return f"#Task {self.id}: customer ({self.customer.name}) - {self.amount_due}"
 
@@ -71,82 +159,789 @@ class Task(models.Model):
 class Transaction(models.Model):
 	collector = models.ForeignKey(User, related_name="transactions_collected", on_delete=models.CASCADE)
 
-	task = models.ForeignKey(Task, related_name="transactions", on_delete=models.CASCADE)
+	# the ledger is append-only, a task with money collected or paid for it stays
+	task = models.ForeignKey(Task, related_name="transactions", on_delete=models.PROTECT)
 	amount = models.DecimalField(max_digits=10, decimal_places=2)
-	timestamp = models.DateTimeField(auto_now_add=True)
+	# when the money changed hands, sent by the client which may be offline at that time
+	timestamp = models.DateTimeField(default=timezone.now)
 	created_at = models.DateTimeField(auto_now_add=True)
 	updated_at = models.DateTimeField(auto_now=True)
 
+	class Meta:
+		indexes = [
+			# the ledger is replayed collector by collector in timestamp order, e.g. by the status export
+			models.Index(fields=["collector", "timestamp", "id"], name="transaction_ledger_idx"),
+			# the admin's date drill-down reads the first and last timestamps, then a year or month of them
+			models.Index(fields=["timestamp"], name="transaction_timestamp_idx"),
+		]
+
 	def save(self, *args, **kwargs):
-		self.validate_transaction()
+		"""
+		Validates and writes the transaction, marks its task as collected and updates the collector's balance,
+		all in one database transaction. The balance and task rows are locked first (in the order `sync`
+		locks them), so concurrent writes for the same collector or task wait for this one and are then
+		validated against its outcome. A collect runs a fixed number of statements: the two locking reads,
+		the insert, an update of each of the task, the balance and its history, and the read and upsert of
+		the collector's daily rollup.
 
-		is_collect_transaction = self.amount > 0
-		if is_collect_transaction:
-			self.validate_collect_transaction()
-		else:
-			self.validate_pay_transaction()
+		The ledger is append-only: a saved transaction can't be changed, a mistake is corrected by recording
+		another one.
+		"""
+		if self.pk is not None:
+			raise ValueError("A transaction can't be changed, record another one to correct it.")
+		if self.task_id is None:
+			raise ValueError("Cannot create a transaction without a task.")
+		if self.collector.is_manager:
+			raise ValueError("A manager cannot collect/pay money.")
 
-		super().save(*args, **kwargs)
+		with transaction.atomic():
+			balance = CollectorBalance.lock(self.collector_id)
+			self.check_timestamp(self.timestamp, balance.last_transaction_at)
+			task = (
+				Task.objects.select_for_update()
+				.annotate(collected=Task.collected_amount())
+				.get(pk=self.task_id)
+			)
+			if self.collector_id != task.collector_id:
+				raise ValueError("The collector is not the collector of the task.")
 
-		# mark task as collected
-		self.task.is_collected = True
-		self.task.save()
+			if self.amount > 0:
+				self.check_collect(
+					self.amount,
+					task,
+					0 if task.is_collected else task.amount_due - task.collected,
+					# frozen now or when the money was collected, back-dating doesn't get past a freeze
+					lambda: balance.is_frozen() or balance.is_frozen(at=self.timestamp),
+				)
+			else:
+				self.check_pay(self.amount)
 
-		# Add a signal to check if the threshold is exceeded
-		if Transaction.is_threshold_exceeded(self.collector):
-			self.collector.is_frozen = True
-			self.collector.save()
-		else:
-			self.collector.is_frozen = False
-			self.collector.save()
+			super().save(*args, **kwargs)
 
-	def validate_transaction(self):
-		if self.task is None:
-			raise ValueError("Cannot create a transaction without a task.")
-		if self.collector.is_manager:
-			raise ValueError("A manager cannot collect/pay money.")
-		if self.collector != self.task.collector:
-			raise ValueError("The collector is not the collector of the task.")
+			# mark task as collected, the locked row replaces the instance it was given. The balance update
+			# bumps the collector's version, so the task is updated without `post_save` bumping it as well.
+			if not task.is_collected:
+				task.is_collected = True
+				Task.objects.filter(pk=task.pk).update(is_collected=True)
+			self.task = task
+
+			self.collector.balance = balance.apply_transactions([(self.amount, self.timestamp)])
+
+	def delete(self, *args, **kwargs):
+		raise ValueError("A transaction can't be deleted, record another one to correct it.")
 
-	def validate_collect_transaction(self):
-		if self.amount <= 0:
+	@staticmethod
+	def check_timestamp(timestamp, last_transaction_at, now=None):
+		"""
+		The bounds of a client's timestamp, shared by `save` and `sync`: not in the future, give or take
+		TRANSACTION_CLOCK_SKEW seconds, nor more than OFFLINE_SYNC_WINDOW seconds before the collector's last
+		transaction, which would replay his/her history from that far back.
+		"""
+		now = now or timezone.now()
+		if timestamp > now + timedelta(seconds=settings.TRANSACTION_CLOCK_SKEW):
+			raise ValueError("The timestamp is in the future.")
+		window = timedelta(seconds=settings.OFFLINE_SYNC_WINDOW)
+		if last_transaction_at is not None and timestamp < last_transaction_at - window:
+			raise ValueError("The timestamp is too far before the collector's last transaction.")
+
+	@staticmethod
+	def check_collect(amount, task, remaining_amount, is_frozen):
+		"""
+		The rules for collecting `amount` for `task`, shared by `save` and `sync`. `is_frozen` is a callable
+		since finding out may cost a query.
+		"""
+		if amount <= 0:
 			raise ValueError("The amount should be greater than zero.")
-		if self.task.remaining_amount() == 0:
+		if remaining_amount == 0:
 			raise ValueError("The task is already collected.")
-		if self.collector.is_frozen:
+		if is_frozen():
 			raise ValueError("The user is frozen.")
-		if self.amount < self.task.remaining_amount():
+		if amount < remaining_amount:
 			raise ValueError("The amount is less than the remaining amount of the task.")
-		if self.amount > self.task.remaining_amount():
+		if amount > remaining_amount:
 			raise ValueError("The amount is more than the remaining amount of the task.")
-		if self.task.is_collected:
+		if task.is_collected:
 			raise ValueError("The task is already collected.")
 
 		return True
 
-	def validate_pay_transaction(self):
-		if self.amount >= 0:
+	@staticmethod
+	def check_pay(amount):
+		if amount >= 0:
 			raise ValueError("The amount should be less than zero.")
 
 		return True
 
+	@classmethod
+	def sync(cls, collector, operations):
+		"""
+		Writes a batch of collect/pay operations, e.g. recorded by a collector while offline.
+
+		`operations` are (is_collect, task_id, amount, timestamp) tuples, `amount` being positive for both
+		kinds. They're validated in timestamp order (in their given order for equal timestamps) against one
+		locked snapshot of the collector's tasks and balance, the valid ones are inserted at once and the
+		balance and freeze state are updated once at the end. Returns, for each operation in the given order,
+		either the created Transaction or the error message.
+
+		The freeze state is carried forward in memory from the collector's last transaction, so each operation
+		is checked against the ones before it. An operation back-dated before the stored last transaction is
+		checked against the stored history instead, which doesn't include the earlier operations of the batch:
+		those are only replayed into the history once the batch is written.
+		"""
+		if collector.is_manager:
+			return ["A manager cannot collect/pay money."] * len(operations)
+
+		with transaction.atomic():
+			balance = CollectorBalance.lock(collector.id)
+			tasks = (
+				Task.objects.select_for_update()
+				.filter(collector=collector)
+				.annotate(collected=Task.collected_amount())
+				.in_bulk({task_id for _, task_id, _, _ in operations})
+			)
+			remaining = {
+				task.id: 0 if task.is_collected else task.amount_due - task.collected
+				for task in tasks.values()
+			}
+
+			state = balance.get_state()
+
+			now = timezone.now()
+
+			def is_frozen_at(timestamp):
+				# frozen now, as of the operations validated so far, like `save` checks it
+				if freeze.is_frozen(state.frozen_at, now):
+					return True
+				if state.last_transaction_at is None or timestamp >= state.last_transaction_at:
+					return freeze.is_frozen(state.frozen_at, timestamp)
+				return balance.is_frozen(at=timestamp)
+
+			results = [None] * len(operations)
+			created = []
+			# sorted is stable, operations at the same instant keep their order
+			for index in sorted(range(len(operations)), key=lambda index: operations[index][3]):
+				is_collect, task_id, amount, timestamp = operations[index]
+				task = tasks.get(task_id)
+				if task is None:
+					results[index] = "Task not found."
+					continue
+				try:
+					cls.check_timestamp(timestamp, balance.last_transaction_at, now)
+					if is_collect:
+						cls.check_collect(amount, task, remaining[task_id], partial(is_frozen_at, timestamp))
+					else:
+						amount = -amount
+						cls.check_pay(amount)
+				except ValueError as e:
+					results[index] = str(e)
+					continue
+
+				remaining[task_id] = 0
+				task.is_collected = True
+				if state.last_transaction_at is None or timestamp >= state.last_transaction_at:
+					state = freeze.apply_transaction(state, amount, timestamp)
+				results[index] = cls(collector=collector, task=task, amount=amount, timestamp=timestamp)
+				created.append(results[index])
+
+			if created:
+				cls.objects.bulk_create(created)
+				Task.objects.filter(id__in={t.task_id for t in created}).update(is_collected=True)
+				collector.balance = balance.apply_transactions([(t.amount, t.timestamp) for t in created])
+		return results
+
 	@classmethod
 	def is_threshold_exceeded(cls, collector):
 		"""
-		Checks if the threshold is exceeded for the collector.
+		Checks if the threshold is exceeded for the collector, he/she is frozen only after holding it for
+		DAYS_THRESHOLD days, see `CollectorBalance.is_frozen`.
 		"""
-		x_days_ago = timezone.now() - timezone.timedelta(days=settings.DAYS_THRESHOLD)
-		total_amount = (
-			cls.objects.filter(collector=collector, timestamp__gte=x_days_ago).aggregate(Sum("amount"))[
-				"amount__sum"
-			]
-			or 0
-		)
-		return total_amount > settings.USD_THRESHOLD
+		return CollectorBalance.for_collector(collector).is_threshold_exceeded()
 
 	@classmethod
 	def get_total_amount(cls, user):
-		return cls.objects.filter(collector=user).aggregate(Sum("amount"))["amount__sum"] or 0
+		return CollectorBalance.for_collector(user).amount
 
 	def __str__(self):
 		return f"Transaction {self.id} - {self.amount}"
+
+
+class CollectorBalance(models.Model):
+	"""
+	Running balance of a collector, i.e. the sum of all his/her transactions, and his/her freeze deadline.
+
+	It's maintained by `Transaction.save` in the same database transaction as the ledger row, so reading
+	the balance or checking whether the collector is frozen is a primary key lookup instead of a query over
+	the whole transaction history. `frozen_at` is precomputed from the instant the balance reached the
+	threshold, so the collector becomes frozen on time even if no transaction comes in after that.
+	Use the `rebuild_balances` management command to verify or rebuild it from the ledger, e.g. after
+	changing USD_THRESHOLD or DAYS_THRESHOLD.
+	"""
+
+	collector = models.OneToOneField(User, primary_key=True, related_name="balance", on_delete=models.CASCADE)
+	amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	threshold_reached_at = models.DateTimeField(null=True, blank=True)
+	frozen_at = models.DateTimeField(null=True, blank=True, db_index=True)
+	last_transaction_at = models.DateTimeField(null=True, blank=True)
+	updated_at = models.DateTimeField(auto_now=True)
+	# bumped whenever the collector's transactions or tasks change, the read endpoints' ETags derive from it
+	version = models.PositiveBigIntegerField(default=0)
+
+	@classmethod
+	def for_collector(cls, collector):
+		"""Returns the balance of the collector, an unsaved zero balance if he/she has no transactions yet."""
+		try:
+			return cls.objects.get(collector=collector)
+		except cls.DoesNotExist:
+			return cls(collector=collector)
+
+	@classmethod
+	async def afor_collector(cls, collector):
+		"""Async version of `for_collector`."""
+		try:
+			return await cls.objects.aget(collector=collector)
+		except cls.DoesNotExist:
+			return cls(collector=collector)
+
+	@classmethod
+	def lock(cls, collector_id):
+		"""
+		Returns the balance of the collector, created if needed, locked until the current transaction
+		commits so concurrent writes for the same collector are serialized.
+		"""
+		balance, _ = cls.objects.select_for_update().get_or_create(collector_id=collector_id)
+		return balance
+
+	def apply_transactions(self, transactions):
+		"""
+		Applies (amount, timestamp) pairs, in the order they were written, to this balance which must be
+		locked by the current transaction, see `lock`. Only the balance columns are updated.
+		"""
+		frozen_at = self.frozen_at
+		# sorting is stable, transactions at the same instant stay in ledger order
+		transactions = sorted(transactions, key=itemgetter(1))
+		if settings.DEFERRED_ROLLUPS:
+			# the lock held on the balance serializes the collector's jobs being queued
+			Job.enqueue(Job.ROLLUPS, self.collector_id, since=transactions[0][1])
+		if self.last_transaction_at is None or transactions[0][1] >= self.last_transaction_at:
+			if not settings.DEFERRED_ROLLUPS:
+				CollectorDailyRollup.record(self.collector_id, self.amount, transactions)
+			state = self.get_state()
+			history = []
+			for amount, timestamp in transactions:
+				state = freeze.apply_transaction(state, amount, timestamp)
+				history.append(BalanceHistory.from_state(self.collector_id, state))
+			BalanceHistory.objects.bulk_create(history, batch_size=1_000)
+			self.set_state(state)
+		else:
+			# a back-dated transaction changes everything after it, the collector's history is replayed
+			self.set_state(BalanceHistory.rewrite(self.collector_id, since=transactions[0][1]))
+			if not settings.DEFERRED_ROLLUPS:
+				CollectorDailyRollup.rewrite(self.collector_id, since=transactions[0][1])
+		if self.frozen_at != frozen_at:
+			token_cache.invalidate(user_id=self.collector_id)
+		self.version += 1
+		self.save(
+			update_fields=[
+				"amount",
+				"threshold_reached_at",
+				"frozen_at",
+				"last_transaction_at",
+				"updated_at",
+				"version",
+			]
+		)
+		return self
+
+	@classmethod
+	def bump_versions(cls, collector_ids, create=True):
+		"""
+		Bumps the `version` of the collectors (ids, None is skipped) in two statements however many they are,
+		creating their balance if needed unless `create` is false.
+
+		Saves and deletes of tasks and transactions bump it through `post_save`/`post_delete`, cascades and
+		queryset deletes included; queryset updates and bulk creates send no signal, their callers bump it.
+		"""
+		collector_ids = set(collector_ids) - {None}
+		if not collector_ids:
+			return
+		if create:
+			cls.objects.bulk_create(
+				[cls(collector_id=collector_id) for collector_id in collector_ids], ignore_conflicts=True
+			)
+		cls.objects.filter(collector_id__in=collector_ids).update(version=F("version") + 1)
+
+	@classmethod
+	def ledger_states(cls):
+		"""Returns {collector_id: FreezeState} replayed from the transaction ledger."""
+		rows = (
+			Transaction.objects.order_by("collector_id", "timestamp", "id")
+			.values_list("collector_id", "amount", "timestamp")
+			.iterator(chunk_size=10_000)
+		)
+		return {
+			collector_id: freeze.replay((amount, timestamp) for _, amount, timestamp in collector_rows)
+			for collector_id, collector_rows in groupby(rows, key=itemgetter(0))
+		}
+
+	@classmethod
+	def find_mismatches(cls):
+		"""Returns [(collector_id, stored, expected)] for every balance that doesn't match the ledger."""
+		expected = cls.ledger_states()
+		stored = {balance.collector_id: balance.get_state() for balance in cls.objects.all()}
+		return [
+			(
+				collector_id,
+				stored.get(collector_id, freeze.INITIAL_STATE),
+				expected.get(collector_id, freeze.INITIAL_STATE),
+			)
+			for collector_id in sorted(expected.keys() | stored.keys())
+			if stored.get(collector_id, freeze.INITIAL_STATE)
+			!= expected.get(collector_id, freeze.INITIAL_STATE)
+		]
+
+	@classmethod
+	def ledger_state(cls, collector_id):
+		"""The FreezeState of the collector replayed from his/her transactions."""
+		return freeze.replay(
+			Transaction.objects.filter(collector_id=collector_id)
+			.order_by("timestamp", "id")
+			.values_list("amount", "timestamp")
+			.iterator(chunk_size=10_000)
+		)
+
+	@classmethod
+	def rebuild(cls, history=False):
+		"""
+		Recomputes the balances that don't match the ledger, returns the number of balances that were fixed.
+		With `history`, the balance history and the daily rollups of every collector are rewritten as well.
+
+		Each collector is fixed in a transaction of its own, holding the lock on his/her balance: the state is
+		replayed again under the lock, so a write that came in since the mismatch was found isn't lost.
+		"""
+		fixed = 0
+		for collector_id, _stored, _expected in cls.find_mismatches():
+			with transaction.atomic():
+				balance = cls.lock(collector_id)
+				state = cls.ledger_state(collector_id)
+				if state == balance.get_state():
+					continue
+				frozen_at = balance.frozen_at
+				balance.set_state(state)
+				# the version carries on from the stored one, ETags clients hold must not come back
+				balance.version += 1
+				balance.save()
+				if balance.frozen_at != frozen_at:
+					token_cache.invalidate(user_id=collector_id)
+				fixed += 1
+		if history:
+			for collector_id in cls.objects.values_list("collector_id", flat=True).iterator():
+				with transaction.atomic():
+					cls.lock(collector_id)
+					BalanceHistory.rewrite(collector_id)
+					CollectorDailyRollup.backfill([collector_id])
+		return fixed
+
+	def get_state(self):
+		return freeze.FreezeState(self.amount, self.threshold_reached_at, self.last_transaction_at)
+
+	def set_state(self, state):
+		self.amount = state.balance
+		self.threshold_reached_at = state.threshold_reached_at
+		self.frozen_at = state.frozen_at
+		self.last_transaction_at = state.last_transaction_at
+
+	def is_threshold_exceeded(self):
+		return self.amount >= settings.USD_THRESHOLD
+
+	def get_status(self, at=None):
+		"""
+		Status of the collector at `at` (default: now), instants before his/her last transaction are looked
+		up in the balance history.
+		"""
+		at = at or timezone.now()
+		if self.last_transaction_at is not None and at < self.last_transaction_at:
+			return BalanceHistory.status_at(self.collector_id, at)
+		return self.get_current_status(at)
+
+	async def aget_status(self, at=None):
+		"""Async version of `get_status`."""
+		at = at or timezone.now()
+		if self.last_transaction_at is not None and at < self.last_transaction_at:
+			row = await BalanceHistory.before(self.collector_id, at).afirst()
+			return BalanceHistory.get_status(self.collector_id, at, row)
+		return self.get_current_status(at)
+
+	def get_current_status(self, at):
+		"""Status of the collector at `at`, which must be after his/her last transaction."""
+		return {
+			"collector": self.collector_id,
+			"at": at,
+			"balance": self.amount,
+			"is_frozen": freeze.is_frozen(self.frozen_at, at),
+			"frozen_at": self.frozen_at,
+		}
+
+	def is_frozen(self, at=None):
+		return self.get_status(at)["is_frozen"]
+
+	def __str__(self):
+		return f"Balance of collector {self.collector_id}: {self.amount}"
+
+
+@receiver(post_save, sender=Task)
+def task_saved(sender, instance, raw=False, **kwargs):
+	"""
+	Bumps the `CollectorBalance.version` of the task's collector, and of its previous one when it's
+	reassigned, so their cached task lists are refreshed.
+	"""
+	if raw:
+		return
+	CollectorBalance.bump_versions({instance.collector_id, getattr(instance, "_loaded_collector_id", None)})
+	instance._loaded_collector_id = instance.collector_id
+
+
+@receiver(post_delete, sender=Task)
+@receiver(post_delete, sender=Transaction)
+def collector_row_deleted(sender, instance, **kwargs):
+	# the balance isn't created: it's gone already when the collector is deleted along with its rows
+	CollectorBalance.bump_versions({instance.collector_id}, create=False)
+
+
+class BalanceHistory(models.Model):
+	"""
+	State of a collector's balance right after each of his/her transactions, written alongside the ledger by
+	`CollectorBalance.apply_transactions`.
+
+	The state holds until the collector's next transaction, so the status at any instant is read from the
+	latest row before it, an index seek on (collector, timestamp). The frozen intervals follow from the rows:
+	the collector is frozen from `frozen_at` until the next row that moves it.
+	"""
+
+	collector = models.ForeignKey(User, related_name="balance_history", on_delete=models.CASCADE)
+	timestamp = models.DateTimeField()
+	amount = models.DecimalField(max_digits=12, decimal_places=2)
+	threshold_reached_at = models.DateTimeField(null=True, blank=True)
+	frozen_at = models.DateTimeField(null=True, blank=True)
+
+	class Meta:
+		verbose_name_plural = "balance history"
+		indexes = [models.Index(fields=["collector", "timestamp"], name="balance_history_at_idx")]
+
+	@classmethod
+	def rewrite(cls, collector_id, since=None):
+		"""
+		Rewrites the history of the collector from `since` (default: the beginning) by replaying his/her
+		ledger, returns the resulting FreezeState.
+		"""
+		history = cls.objects.filter(collector_id=collector_id)
+		transactions = Transaction.objects.filter(collector_id=collector_id)
+		state = freeze.INITIAL_STATE
+		if since is not None:
+			history = history.filter(timestamp__gte=since)
+			transactions = transactions.filter(timestamp__gte=since)
+			previous = cls.latest_before(collector_id, since, inclusive=False)
+			if previous is not None:
+				state = freeze.FreezeState(previous.amount, previous.threshold_reached_at, previous.timestamp)
+		history.delete()
+
+		rows = []
+		for amount, timestamp in transactions.order_by("timestamp", "id").values_list("amount", "timestamp"):
+			state = freeze.apply_transaction(state, amount, timestamp)
+			rows.append(cls.from_state(collector_id, state))
+		cls.objects.bulk_create(rows, batch_size=1_000)
+		return state
+
+	@classmethod
+	def from_state(cls, collector_id, state):
+		"""History row for the FreezeState right after the transaction at `state.last_transaction_at`."""
+		return cls(
+			collector_id=collector_id,
+			timestamp=state.last_transaction_at,
+			amount=state.balance,
+			threshold_reached_at=state.threshold_reached_at,
+			frozen_at=state.frozen_at,
+		)
+
+	@classmethod
+	def before(cls, collector_id, at, inclusive=True):
+		"""The history of the collector up to `at`, latest first."""
+		lookup = "timestamp__lte" if inclusive else "timestamp__lt"
+		return cls.objects.filter(collector_id=collector_id, **{lookup: at}).order_by("-timestamp", "-id")
+
+	@classmethod
+	def latest_before(cls, collector_id, at, inclusive=True):
+		return cls.before(collector_id, at, inclusive).first()
+
+	@classmethod
+	def status_at(cls, collector_id, at):
+		"""Returns the status of the collector at `at`, see `BalanceHistory.get_status`."""
+		return cls.get_status(collector_id, at, cls.latest_before(collector_id, at))
+
+	@classmethod
+	def statuses_at(cls, queries):
+		"""
+		Returns the status for each (collector_id, at) pair, in the same order, in one statement: the distinct
+		pairs are sent as a VALUES list and each is joined to its latest history row, one index seek per pair.
+		"""
+		pairs = list(dict.fromkeys(queries))
+		if not pairs:
+			return []
+		qn = connection.ops.quote_name
+		table = qn(cls._meta.db_table)
+		collector = qn(cls._meta.get_field("collector").column)
+		timestamp = qn(cls._meta.get_field("timestamp").column)
+		values = ", ".join(f"({index}, %s, %s)" for index in range(len(pairs)))
+		params = []
+		for collector_id, at in pairs:
+			params += [collector_id, connection.ops.adapt_datetimefield_value(at)]
+		rows = cls.objects.raw(
+			f"WITH q (pair, collector_id, at) AS (VALUES {values}) "  # noqa: S608
+			f"SELECT h.*, q.pair FROM q JOIN {table} h ON h.id = ("
+			f"SELECT id FROM {table} WHERE {collector} = q.collector_id AND {timestamp} <= q.at "
+			f"ORDER BY {timestamp} DESC, id DESC LIMIT 1)",
+			params,
+		)
+		found = {pairs[row.pair]: row for row in rows}
+		return [
+			cls.get_status(collector_id, at, found.get((collector_id, at))) for collector_id, at in queries
+		]
+
+	@staticmethod
+	def get_status(collector_id, at, row):
+		"""Status of the collector at `at`, given the latest history row before it (None if there's none)."""
+		if row is None:
+			return {"collector": collector_id, "at": at, "balance": 0, "is_frozen": False, "frozen_at": None}
+		return {
+			"collector": collector_id,
+			"at": at,
+			"balance": row.amount,
+			"is_frozen": freeze.is_frozen(row.frozen_at, at),
+			"frozen_at": row.frozen_at,
+		}
+
+	def __str__(self):
+		return f"Balance of collector {self.collector_id} at {self.timestamp}: {self.amount}"
+
+
+class IdempotencyKey(models.Model):
+	"""
+	Response of a /collect or /pay request sent with an `Idempotency-Key` header, replayed when the client
+	retries with the same key until `expires_at`, see `cash_collector.idempotency`. Expired keys are deleted
+	by the `purge_idempotency_keys` management command.
+	"""
+
+	user = models.ForeignKey(User, related_name="idempotency_keys", on_delete=models.CASCADE)
+	key = models.CharField(max_length=255)
+	# hash of the endpoint and payload the key was first used with
+	fingerprint = models.CharField(max_length=64)
+	response = models.JSONField(null=True, blank=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+	expires_at = models.DateTimeField(db_index=True)
+
+	class Meta:
+		constraints = [models.UniqueConstraint(fields=["user", "key"], name="idempotency_key_user_key_uniq")]
+
+	def __str__(self):
+		return f"Idempotency key {self.key} of user {self.user_id}"
+
+
+class CollectorDailyRollup(models.Model):
+	"""
+	A collector's transactions totalled per day (in TIME_ZONE), with his/her balance at the end of the day and
+	the highest it was during the day. Maintained along with the balance by
+	`CollectorBalance.apply_transactions`, populated from the ledger with the `backfill_rollups` management
+	command.
+
+	Reports read a row per day instead of the transactions, and the balance at any instant is the closing
+	balance of the day before plus the transactions of that day up to the instant.
+	"""
+
+	collector = models.ForeignKey(User, related_name="daily_rollups", on_delete=models.CASCADE)
+	day = models.DateField()
+	collected = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	paid = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+	transactions = models.PositiveIntegerField(default=0)
+	closing_balance = models.DecimalField(max_digits=12, decimal_places=2)
+	peak_balance = models.DecimalField(max_digits=12, decimal_places=2)
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=["collector", "day"], name="daily_rollup_collector_day_uniq")
+		]
+
+	@classmethod
+	def roll_up(cls, collector_id, balance, transactions, rollups=None):
+		"""
+		Adds (amount, timestamp) pairs, in timestamp order, to the `rollups` {day: rollup} of the collector,
+		whose balance is `balance` before them. Returns the rollups, new days included.
+		"""
+		rollups = {} if rollups is None else rollups
+		for amount, timestamp in transactions:
+			day = timezone.localdate(timestamp)
+			rollup = rollups.get(day)
+			if rollup is None:
+				rollup = rollups[day] = cls(
+					collector_id=collector_id,
+					day=day,
+					collected=Decimal(0),
+					paid=Decimal(0),
+					closing_balance=balance,
+					peak_balance=balance,
+				)
+			balance += amount
+			if amount > 0:
+				rollup.collected += amount
+			else:
+				rollup.paid -= amount
+			rollup.transactions += 1
+			rollup.closing_balance = balance
+			rollup.peak_balance = max(rollup.peak_balance, balance)
+		return rollups
+
+	@classmethod
+	def record(cls, collector_id, balance, transactions):
+		"""
+		Adds (amount, timestamp) pairs, none of them before the collector's last transaction, to his/her
+		rollups. `balance` is the collector's balance before them, the caller holds the lock on it.
+		"""
+		days = {timezone.localdate(timestamp) for _, timestamp in transactions}
+		rollups = {
+			rollup.day: rollup for rollup in cls.objects.filter(collector_id=collector_id, day__in=days)
+		}
+		rollups = cls.roll_up(collector_id, balance, transactions, rollups)
+		cls.objects.bulk_create(
+			rollups.values(),
+			update_conflicts=True,
+			unique_fields=["collector", "day"],
+			update_fields=["collected", "paid", "transactions", "closing_balance", "peak_balance"],
+		)
+
+	@classmethod
+	def rewrite(cls, collector_id, since):
+		"""
+		Rewrites the rollups of the collector from the day of `since` by replaying his/her ledger, all of them
+		from the first transaction when `since` is None.
+		"""
+		if since is None:
+			cls.backfill([collector_id])
+			return
+		day = timezone.localdate(since)
+		start = timezone.make_aware(datetime.combine(day, time.min))
+		previous = BalanceHistory.latest_before(collector_id, start, inclusive=False)
+		cls.objects.filter(collector_id=collector_id, day__gte=day).delete()
+		transactions = (
+			Transaction.objects.filter(collector_id=collector_id, timestamp__gte=start)
+			.order_by("timestamp", "id")
+			.values_list("amount", "timestamp")
+		)
+		balance = previous.amount if previous is not None else Decimal(0)
+		cls.objects.bulk_create(cls.roll_up(collector_id, balance, transactions).values(), batch_size=1_000)
+
+	@classmethod
+	def backfill(cls, collector_ids=None):
+		"""
+		Rebuilds the rollups of the collectors (default: all of them) from the ledger, which is streamed.
+		Returns the number of rollups written.
+		"""
+		rollups = cls.objects.all()
+		transactions = Transaction.objects.order_by("collector_id", "timestamp", "id")
+		if collector_ids:
+			rollups = rollups.filter(collector_id__in=collector_ids)
+			transactions = transactions.filter(collector_id__in=collector_ids)
+		rollups.delete()
+
+		rows = transactions.values_list("collector_id", "amount", "timestamp").iterator(chunk_size=10_000)
+		written = 0
+		for collector_id, collector_rows in groupby(rows, key=itemgetter(0)):
+			collector_rollups = cls.roll_up(
+				collector_id, Decimal(0), ((amount, timestamp) for _, amount, timestamp in collector_rows)
+			)
+			cls.objects.bulk_create(collector_rollups.values(), batch_size=1_000)
+			written += len(collector_rollups)
+		return written
+
+	@classmethod
+	def balance_at(cls, collector_id, at):
+		"""
+		The balance of the collector at `at`: the closing balance of the last day before, plus the
+		transactions of the day of `at` up to it. Two queries, however long the ledger.
+		"""
+		day = timezone.localdate(at)
+		closing_balance = (
+			cls.objects.filter(collector_id=collector_id, day__lt=day)
+			.order_by("-day")
+			.values_list("closing_balance", flat=True)
+			.first()
+		)
+		today = Transaction.objects.filter(
+			collector_id=collector_id,
+			timestamp__gte=timezone.make_aware(datetime.combine(day, time.min)),
+			timestamp__lte=at,
+		).aggregate(total=Sum("amount"))["total"]
+		return (closing_balance or Decimal(0)) + (today or Decimal(0))
+
+	def __str__(self):
+		return f"Rollup of collector {self.collector_id} on {self.day}: {self.closing_balance}"
+
+
+class Job(models.Model):
+	"""
+	Work on a collector's data deferred out of the requests, run by the `run_workers` management command, see
+	`cash_collector.jobs`. A collector has at most one pending (unclaimed) job of a kind, queuing another one
+	widens it to the earliest `since` instead.
+	"""
+
+	ROLLUPS = "rollups"
+	KINDS = [(ROLLUPS, "Rewrite the daily rollups")]
+
+	kind = models.CharField(max_length=32, choices=KINDS)
+	collector = models.ForeignKey(User, related_name="jobs", on_delete=models.CASCADE)
+	# what the job covers starts at this instant, null for everything
+	since = models.DateTimeField(null=True, blank=True)
+	run_after = models.DateTimeField(default=timezone.now)
+	claimed_at = models.DateTimeField(null=True, blank=True)
+	attempts = models.PositiveIntegerField(default=0)
+	last_error = models.TextField(blank=True)
+	# set once the job failed JOBS_MAX_ATTEMPTS times, it's then left for someone to look at
+	failed_at = models.DateTimeField(null=True, blank=True)
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(
+				fields=["kind", "collector"], condition=Q(claimed_at__isnull=True), name="job_pending_uniq"
+			)
+		]
+		indexes = [
+			# workers claim the pending jobs by `run_after`
+			models.Index(
+				fields=["run_after", "id"], condition=Q(claimed_at__isnull=True), name="job_pending_idx"
+			),
+		]
+
+	@classmethod
+	def enqueue(cls, kind, collector_id, since=None):
+		"""
+		Queues a job of `kind` for the collector in the current transaction, unless one is pending, which is
+		widened to `since`. The caller serializes the collector's jobs being queued, e.g. by holding the lock
+		on his/her balance.
+		"""
+		if not cls.widen(kind, collector_id, since):
+			cls.objects.create(kind=kind, collector_id=collector_id, since=since)
+
+	@classmethod
+	def widen(cls, kind, collector_id, since, **changes):
+		"""
+		Widens the pending job of `kind` of the collector to `since`, with the other field `changes`, returns
+		whether there was one.
+		"""
+		if since is not None:
+			since = Case(
+				When(Q(since__isnull=True) | Q(since__lte=since), then=F("since")), default=Value(since)
+			)
+		return cls.objects.filter(kind=kind, collector_id=collector_id, claimed_at__isnull=True).update(
+			since=since, **changes
+		)
+
+	def __str__(self):
+		return f"Job {self.kind} of collector {self.collector_id}"
@@ -0,0 +1,118 @@
+"""
+Keyset pagination: a page ends with a cursor made of the ordering key of its last row, and the next page
+starts right after that key. Unlike OFFSET, fetching a page costs the same however deep it is.
+
+The admin pages with OFFSET, `EstimatedCountPaginator` at least spares it counting the large tables.
+"""
+
+import base64
+import binascii
+
+import orjson
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+from ninja.errors import HttpError
+
+from .renderers import dumps
+
+# querysets PostgreSQL estimates at fewer rows than this are counted exactly by `EstimatedCountPaginator`
+ESTIMATED_COUNT_THRESHOLD = 100_000
+
+
+def encode_cursor(at, pk):
+	return base64.urlsafe_b64encode(f"{at.isoformat()}|{pk}".encode()).decode()
+
+
+def decode_cursor(cursor):
+	"""Returns the (datetime, pk) key encoded in `cursor`, raises a 400 error if it's malformed."""
+	try:
+		at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+		key = parse_datetime(at), int(pk)
+	except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+		raise HttpError(400, "Invalid cursor.") from e
+	if key[0] is None:
+		raise HttpError(400, "Invalid cursor.")
+	return key
+
+
+def paginate(queryset, field, cursor, limit):
+	"""
+	Returns (page, next_cursor) for `queryset` ordered by (`field`, pk). `page` is a lazy queryset, and
+	`next_cursor` is None on the last page. Finding `next_cursor` only reads the ordering key of two rows.
+	"""
+	queryset = _after_cursor(queryset, field, cursor)
+	return queryset[:limit], _next_cursor(list(_boundary(queryset, field, limit)))
+
+
+async def apaginate(queryset, field, cursor, limit):
+	"""Async version of `paginate`."""
+	queryset = _after_cursor(queryset, field, cursor)
+	return queryset[:limit], _next_cursor([key async for key in _boundary(queryset, field, limit)])
+
+
+def _after_cursor(queryset, field, cursor):
+	queryset = queryset.order_by(field, "pk")
+	if cursor:
+		at, pk = decode_cursor(cursor)
+		queryset = queryset.filter(Q(**{f"{field}__gt": at}) | Q(**{field: at, "pk__gt": pk}))
+	return queryset
+
+
+def _boundary(queryset, field, limit):
+	"""The keys of the last row of the page and of the row after it."""
+	return queryset.values_list(field, "pk")[limit - 1 : limit + 1]
+
+
+def _next_cursor(boundary):
+	return encode_cursor(*boundary[0]) if len(boundary) == 2 else None
+
+
+def stream_json_list(rows, chunk_size=100):
+	"""Serializes the `rows` iterable as a JSON list, `chunk_size` rows at a time."""
+	yield b"["
+	chunk = []
+	for index, row in enumerate(rows):
+		chunk.append(b"," + dumps(row) if index else dumps(row))
+		if len(chunk) == chunk_size:
+			yield b"".join(chunk)
+			chunk = []
+	yield b"".join(chunk)
+	yield b"]"
+
+
+class EstimatedCountPaginator(Paginator):
+	"""
+	A paginator for the admin's changelists of large tables: on PostgreSQL, querysets the planner estimates at
+	`ESTIMATED_COUNT_THRESHOLD` rows or more aren't counted with COUNT(*), which reads every row, their count
+	is the estimate. The number of pages is then approximate, the last ones may be empty.
+	"""
+
+	@cached_property
+	def count(self):
+		estimate = estimated_count(self.object_list)
+		if estimate is None or estimate < ESTIMATED_COUNT_THRESHOLD:
+			return super().count
+		return estimate
+
+
+def estimated_count(queryset):
+	"""The rows of `queryset` according to PostgreSQL's planner, None on other databases."""
+	connection = connections[queryset.db]
+	if connection.vendor != "postgresql":
+		return None
+	try:
+		sql, params = queryset.order_by().query.sql_with_params()
+	except EmptyResultSet:
+		# e.g. `none()`, there's no query to run
+		return 0
+	with connection.cursor() as cursor:
+		cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+		plan = cursor.fetchone()[0]
+	# psycopg2 parses the json column, unless the type isn't registered
+	if isinstance(plan, str):
+		plan = orjson.loads(plan)
+	return plan[0]["Plan"]["Plan Rows"]
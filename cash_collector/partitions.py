@@ -0,0 +1,248 @@
+"""
+Optional monthly range partitioning of the transaction table on PostgreSQL, see TRANSACTION_PARTITIONING.
+
+The table is partitioned by `timestamp`, so queries bounded by time (e.g. replaying a collector's ledger
+from a back-dated transaction) only scan the partitions of that period, and old months can be detached
+from the ledger whole instead of deleted row by row. Each month is a `<table>_pYYYYMM` partition, and a
+`<table>_default` partition catches the rows outside of them.
+
+PostgreSQL needs the partition key in the primary key, so the partitioned table's primary key is
+(id, timestamp). Django still sees `id` as the primary key, ids stay unique as they come from one sequence.
+Nothing references transactions with a foreign key, which PostgreSQL wouldn't allow.
+"""
+
+from datetime import datetime, timezone
+
+from django.db import connection as default_connection
+
+# the SQL below is built from this table name and the partition names derived from it, never from user input
+TABLE = "cash_collector_transaction"
+
+
+def month_start(at):
+	"""The first instant of the month of `at`, in UTC."""
+	at = at.astimezone(timezone.utc)
+	return datetime(at.year, at.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(month, count):
+	index = month.year * 12 + month.month - 1 + count
+	return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def months_between(first, last):
+	"""The starts of the months from the one of `first` to the one of `last`, both included."""
+	month, last = month_start(first), month_start(last)
+	while month <= last:
+		yield month
+		month = add_months(month, 1)
+
+
+def partition_name(month):
+	return f"{TABLE}_p{month:%Y%m}"
+
+
+def is_supported(connection=default_connection):
+	return connection.vendor == "postgresql"
+
+
+def is_partitioned(connection=default_connection):
+	with connection.cursor() as cursor:
+		cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [TABLE])
+		row = cursor.fetchone()
+	return row is not None and row[0] == "p"
+
+
+def partitions(connection=default_connection):
+	"""Names of the partitions of the table, in order."""
+	with connection.cursor() as cursor:
+		cursor.execute(
+			"SELECT child.relname FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+			"WHERE pg_inherits.inhparent = to_regclass(%s) ORDER BY child.relname",
+			[TABLE],
+		)
+		return [name for (name,) in cursor.fetchall()]
+
+
+def convert(connection=default_connection, ahead=3, now=None):
+	"""
+	Converts the plain transaction table into a partitioned one, with a partition for every month from the
+	first transaction to `ahead` months after `now`. The rows are copied over, the table is locked meanwhile
+	so it must run in a transaction, as migrations do.
+	"""
+	qn = connection.ops.quote_name
+	table, old = qn(TABLE), qn(f"{TABLE}_unpartitioned")
+	# a table with deferred foreign key checks pending, e.g. rows inserted earlier in the transaction, can't
+	# be altered: they're run now
+	connection.check_constraints()
+	with connection.cursor() as cursor:
+		cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+		cursor.execute(f'SELECT min("timestamp"), coalesce(max(id), 0) FROM {table}')  # noqa: S608
+		first, max_id = cursor.fetchone()
+		indexes, foreign_keys = table_definitions(cursor, TABLE)
+
+		cursor.execute(f"ALTER TABLE {table} RENAME TO {old}")
+		# the id sequence is recreated for the new table, ids carry on from where they were. The column is an
+		# identity as created by Django, or takes its default from a sequence once `revert` ran.
+		cursor.execute(f"ALTER TABLE {old} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+		cursor.execute(f"ALTER TABLE {old} ALTER COLUMN id DROP DEFAULT")
+		cursor.execute(f"DROP SEQUENCE IF EXISTS {qn(TABLE + '_id_seq')}")
+		cursor.execute(
+			f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) "
+			'PARTITION BY RANGE ("timestamp")'
+		)
+		create_id_sequence(cursor, qn, max_id)
+
+		now = now or datetime.now(timezone.utc)
+		for month in months_between(first or now, add_months(month_start(now), ahead)):
+			create_partition(connection, month)
+		cursor.execute(f"CREATE TABLE {qn(TABLE + '_default')} PARTITION OF {table} DEFAULT")
+
+		cursor.execute(f"INSERT INTO {table} SELECT * FROM {old}")  # noqa: S608
+		cursor.execute(f"DROP TABLE {old}")
+
+		cursor.execute(
+			f'ALTER TABLE {table} ADD CONSTRAINT {qn(TABLE + "_pkey")} PRIMARY KEY (id, "timestamp")'
+		)
+		restore_definitions(cursor, qn, indexes, foreign_keys)
+
+
+def revert(connection=default_connection):
+	"""Converts the partitioned transaction table back into a plain one, rows included."""
+	qn = connection.ops.quote_name
+	table, old = qn(TABLE), qn(f"{TABLE}_partitioned")
+	connection.check_constraints()
+	with connection.cursor() as cursor:
+		cursor.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+		cursor.execute(f"SELECT coalesce(max(id), 0) FROM {table}")  # noqa: S608
+		(max_id,) = cursor.fetchone()
+		indexes, foreign_keys = table_definitions(cursor, TABLE)
+
+		cursor.execute(f"ALTER TABLE {table} RENAME TO {old}")
+		cursor.execute(f"ALTER TABLE {old} ALTER COLUMN id DROP DEFAULT")
+		cursor.execute(f"DROP SEQUENCE IF EXISTS {qn(TABLE + '_id_seq')}")
+		cursor.execute(
+			f"CREATE TABLE {table} (LIKE {old} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE)"
+		)
+		create_id_sequence(cursor, qn, max_id)
+		cursor.execute(f"INSERT INTO {table} SELECT * FROM {old}")  # noqa: S608
+		cursor.execute(f"DROP TABLE {old}")
+
+		cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {qn(TABLE + '_pkey')} PRIMARY KEY (id)")
+		restore_definitions(cursor, qn, indexes, foreign_keys)
+
+
+def table_definitions(cursor, table):
+	"""The (name, definition) of the table's indexes, primary key aside, and of its foreign keys."""
+	cursor.execute(
+		"SELECT indexname, indexdef FROM pg_indexes WHERE tablename = %s AND indexname != %s",
+		[table, f"{table}_pkey"],
+	)
+	indexes = cursor.fetchall()
+	cursor.execute(
+		"SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+		"WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+		[table],
+	)
+	return indexes, cursor.fetchall()
+
+
+def restore_definitions(cursor, qn, indexes, foreign_keys):
+	"""
+	Creates the `table_definitions` read from the old table on the new one, once the old one is dropped
+	and their names are free again. An index of a partitioned table is created on every partition.
+	"""
+	for _, definition in indexes:
+		cursor.execute(definition)
+	for name, definition in foreign_keys:
+		cursor.execute(f"ALTER TABLE {qn(TABLE)} ADD CONSTRAINT {qn(name)} {definition}")
+
+
+def create_id_sequence(cursor, qn, max_id):
+	sequence = qn(f"{TABLE}_id_seq")
+	cursor.execute(f"CREATE SEQUENCE {sequence} OWNED BY {qn(TABLE)}.id")
+	cursor.execute("SELECT setval(%s, %s, %s)", [f"{TABLE}_id_seq", max(max_id, 1), max_id > 0])
+	cursor.execute(f"ALTER TABLE {qn(TABLE)} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+
+
+def create_partition(connection, month):
+	"""
+	Creates the partition of the month starting at `month`, unless it exists. Rows of that month that went
+	to the default partition meanwhile are moved into it.
+	"""
+	qn = connection.ops.quote_name
+	# the bounds are passed as text, older PostgreSQL versions only take literals there
+	name, start, end = partition_name(month), month.isoformat(), add_months(month, 1).isoformat()
+	with connection.cursor() as cursor:
+		cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [name])
+		if cursor.fetchone()[0]:
+			return False
+
+		cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [f"{TABLE}_default"])
+		if not cursor.fetchone()[0]:
+			cursor.execute(
+				f"CREATE TABLE {qn(name)} PARTITION OF {qn(TABLE)} FOR VALUES FROM (%s) TO (%s)", [start, end]
+			)
+			return True
+
+		# attaching checks the default partition holds no row of the month, so they're moved out first
+		default = qn(f"{TABLE}_default")
+		in_month = 'WHERE "timestamp" >= %s AND "timestamp" < %s'
+		cursor.execute(f"CREATE TABLE {qn(name)} (LIKE {qn(TABLE)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+		cursor.execute(f"INSERT INTO {qn(name)} SELECT * FROM {default} {in_month}", [start, end])  # noqa: S608
+		cursor.execute(f"DELETE FROM {default} {in_month}", [start, end])  # noqa: S608
+		cursor.execute(
+			f"ALTER TABLE {qn(TABLE)} ATTACH PARTITION {qn(name)} FOR VALUES FROM (%s) TO (%s)", [start, end]
+		)
+	return True
+
+
+def create_index_concurrently(connection, name, columns):
+	"""
+	Creates the index `name` on the `columns` of the partitioned table without blocking writes. CREATE INDEX
+	CONCURRENTLY doesn't work on a partitioned table, so the index is created on the parent table only, where
+	it's invalid until every partition has its own, then concurrently on each partition and attached to it.
+	It must run outside of a transaction, and can be run again if it was interrupted.
+	"""
+	qn = connection.ops.quote_name
+	columns = ", ".join(qn(column) for column in columns)
+	with connection.cursor() as cursor:
+		cursor.execute(f"CREATE INDEX IF NOT EXISTS {qn(name)} ON ONLY {qn(TABLE)} ({columns})")
+		for partition in partitions(connection):
+			index = qn(f"{partition}_{name}")
+			cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} ON {qn(partition)} ({columns})")
+			cursor.execute(f"ALTER INDEX {qn(name)} ATTACH PARTITION {index}")
+
+
+def create_future_partitions(connection=default_connection, ahead=3, now=None):
+	"""Creates the partitions of the current month and the `ahead` next ones, returns the created names."""
+	now = now or datetime.now(timezone.utc)
+	return [
+		partition_name(month)
+		for month in months_between(now, add_months(month_start(now), ahead))
+		if create_partition(connection, month)
+	]
+
+
+def detach_partitions(connection=default_connection, before=None, drop=False):
+	"""
+	Detaches the monthly partitions ending on or before `before` from the table, they're left as plain
+	tables for archiving, or dropped if `drop`. Returns their names.
+	"""
+	qn = connection.ops.quote_name
+	detached = []
+	for name in partitions(connection):
+		if name == f"{TABLE}_default":
+			continue
+		month = datetime.strptime(name.rsplit("_p", 1)[1], "%Y%m").replace(tzinfo=timezone.utc)
+		if add_months(month, 1) > before:
+			continue
+		with connection.cursor() as cursor:
+			cursor.execute(f"ALTER TABLE {qn(TABLE)} DETACH PARTITION {qn(name)}")
+			if drop:
+				cursor.execute(f"DROP TABLE {qn(name)}")
+			else:
+				# an archive takes no new rows, and mustn't hold on to the table's id sequence
+				cursor.execute(f"ALTER TABLE {qn(name)} ALTER COLUMN id DROP DEFAULT")
+		detached.append(name)
+	return detached
@@ -0,0 +1,44 @@
+"""
+JSON rendering and parsing of the APIs with orjson, several times faster than the standard library's `json`
+on large responses like the pages of /tasks.
+
+Money is a `Decimal` from the request to the database and back: amounts are rendered as strings with two
+decimal places ("20000.00", "0.00" for a balance computed as 0) so they stay exact, and are parsed from
+strings or numbers. A JSON number is read as a float first, which
+gives back the same digits for amounts of up to 15 significant digits, more than the columns hold.
+Datetimes are rendered in ISO 8601, with a "Z" for UTC.
+"""
+
+from decimal import Decimal
+
+import orjson
+from ninja.parser import Parser
+from ninja.renderers import BaseRenderer
+
+OPTIONS = orjson.OPT_UTC_Z
+
+CENT = Decimal("0.01")
+
+
+def default(value):
+	"""What orjson can't serialize by itself."""
+	if isinstance(value, Decimal):
+		return str(value.quantize(CENT))
+	raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value):
+	"""`value` serialized as JSON bytes."""
+	return orjson.dumps(value, default=default, option=OPTIONS)
+
+
+class ORJSONRenderer(BaseRenderer):
+	media_type = "application/json"
+
+	def render(self, request, data, *, response_status):
+		return dumps(data)
+
+
+class ORJSONParser(Parser):
+	def parse_body(self, request):
+		return orjson.loads(request.body)
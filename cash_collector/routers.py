@@ -0,0 +1,176 @@
+"""
+Read replica routing: the reads of GET and HEAD requests (the API's read endpoints, the admin's list views) go
+to the `DATABASE_REPLICA` database when it's set, everything else to the default one.
+
+A replica lags behind, so an authenticated client that just wrote sticks to the default database for
+`DATABASE_REPLICA_STICKY_SECONDS`, and reads its own writes. Clients are told apart by their bearer token, or
+their session cookie in the admin; they're remembered in Django's default cache, shared by the worker
+processes (a table of the default database unless CACHE_URL is set) so the stickiness holds across them. The
+cache mustn't evict the entries before they expire, see CACHE_MAX_ENTRIES in the settings.
+"""
+
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .models import User
+
+CACHE_PREFIX = "replica-sticky"
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# set by `ReplicaRoutingMiddleware` for the requests reading from the replica
+use_replica = ContextVar("use_replica", default=False)
+# the models a request other than a read wrote, or locked rows of, collected by `ReplicaRouter`
+primary_writes = ContextVar("primary_writes", default=None)
+
+
+def replica():
+	"""The alias of the replica database, None when there's none."""
+	return settings.DATABASE_REPLICA
+
+
+class ReplicaRouter:
+	"""
+	Reads go to the replica while `use_replica` is set, to the default database otherwise. Writes, and the
+	reads locking rows (`select_for_update`), always go to the default database, even for instances read
+	from the replica; they're noted in `primary_writes` while it's set.
+	"""
+
+	def db_for_read(self, model, **hints):
+		# the database cache holds the sticky clients, it's read where it's written
+		if model._meta.app_label == "django_cache":
+			return DEFAULT_DB_ALIAS
+		return replica() if use_replica.get() else DEFAULT_DB_ALIAS
+
+	def db_for_write(self, model, **hints):
+		writes = primary_writes.get()
+		# the sticky clients themselves aren't a write of the request
+		if writes is not None and model._meta.app_label != "django_cache":
+			writes.add(model._meta.label)
+		return DEFAULT_DB_ALIAS
+
+	def allow_relation(self, obj1, obj2, **hints):
+		# both databases hold the same rows
+		if {obj1._state.db, obj2._state.db} <= {DEFAULT_DB_ALIAS, replica()}:
+			return True
+		return None
+
+
+def client_keys(request, response=None):
+	"""
+	What identifies the client of `request`: its bearer token hash, or its session cookie, and the session
+	cookie `response` sets (e.g. when logging in to the admin).
+	"""
+	keys = set()
+	scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+	if scheme.lower() == "bearer" and token:
+		keys.add(f"{CACHE_PREFIX}:token:{User.hash_auth_token(token)}")
+	sessions = [request.COOKIES.get(settings.SESSION_COOKIE_NAME)]
+	if response is not None and settings.SESSION_COOKIE_NAME in response.cookies:
+		sessions.append(response.cookies[settings.SESSION_COOKIE_NAME].value)
+	keys.update(f"{CACHE_PREFIX}:session:{session}" for session in sessions if session)
+	return keys
+
+
+def authenticated(request):
+	"""Whether the client of `request` is known: the user of an API bearer token or of an admin session."""
+	if getattr(request, "auth", None) is not None:
+		return True
+	user = getattr(request, "user", None)
+	return user is not None and user.is_authenticated
+
+
+class ReplicaRoutingMiddleware:
+	"""
+	Routes the reads of safe requests to the replica, unless their client wrote in the last
+	`DATABASE_REPLICA_STICKY_SECONDS`. The client of any other request sticks to the default database once
+	it's authenticated and the request wrote to it: failed or rejected requests don't fill the cache.
+	"""
+
+	sync_capable = True
+	async_capable = True
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+		if iscoroutinefunction(get_response):
+			markcoroutinefunction(self)
+
+	def __call__(self, request):
+		if iscoroutinefunction(self):
+			return self.__acall__(request)
+		if not replica():
+			return self.get_response(request)
+
+		if request.method not in SAFE_METHODS:
+			writes = set()
+			token = primary_writes.set(writes)
+			try:
+				response = self.get_response(request)
+			finally:
+				primary_writes.reset(token)
+			keys = client_keys(request, response) if writes and authenticated(request) else None
+			if keys:
+				cache.set_many(dict.fromkeys(keys, True), settings.DATABASE_REPLICA_STICKY_SECONDS)
+			return response
+
+		keys = client_keys(request)
+		# anonymous clients can't be told apart, they read from the replica
+		on_replica = not (keys and cache.get_many(keys))
+		token = use_replica.set(on_replica)
+		try:
+			response = self.get_response(request)
+		finally:
+			use_replica.reset(token)
+		return self.stream(response, on_replica)
+
+	async def __acall__(self, request):
+		if not replica():
+			return await self.get_response(request)
+
+		if request.method not in SAFE_METHODS:
+			writes = set()
+			# shared with the threads running the ORM, which get a copy of the context
+			token = primary_writes.set(writes)
+			try:
+				response = await self.get_response(request)
+			finally:
+				primary_writes.reset(token)
+			keys = client_keys(request, response) if writes and authenticated(request) else None
+			if keys:
+				await cache.aset_many(dict.fromkeys(keys, True), settings.DATABASE_REPLICA_STICKY_SECONDS)
+			return response
+
+		keys = client_keys(request)
+		on_replica = not (keys and await cache.aget_many(keys))
+		# the threads running the ORM for the view copy the context, the flag included
+		token = use_replica.set(on_replica)
+		try:
+			response = await self.get_response(request)
+		finally:
+			use_replica.reset(token)
+		return self.stream(response, on_replica)
+
+	@staticmethod
+	def stream(response, on_replica):
+		"""The rows of a streaming response read from the replica are queried as it's consumed."""
+		if on_replica and response.streaming and not response.is_async:
+			response.streaming_content = read_from_replica(response.streaming_content)
+		return response
+
+
+def read_from_replica(content):
+	"""Streaming content querying the replica, its rows are read as it's consumed, once the view returned."""
+	iterator = iter(content)
+	while True:
+		token = use_replica.set(True)
+		try:
+			chunk = next(iterator)
+		except StopIteration:
+			return
+		finally:
+			use_replica.reset(token)
+		yield chunk
@@ -0,0 +1,205 @@
+"""
+What-if replays of the freeze rule (see `cash_collector.freeze`) over the whole transaction ledger: how many
+collectors other values of USD_THRESHOLD and DAYS_THRESHOLD would have frozen, and for how long, see the
+`simulate_freeze` management command.
+
+The ledger is read in chunks, ordered by collector and timestamp like `CollectorBalance.ledger_states`, into
+NumPy arrays of amounts in cents and timestamps in microseconds, so the arithmetic stays exact. For each chunk
+the running balances, the runs of transactions at or above every USD threshold, and the instants they start
+and end are computed with array operations, for all the thresholds at once, then the freezes of every days
+threshold follow from those runs. Only the state of the last collector of a chunk is carried to the next one,
+so memory use depends on the chunk size, not on the size of the ledger.
+
+Like the ledger it replays, the simulation can't tell which collections a freeze would have refused.
+"""
+
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+from typing import NamedTuple
+
+import numpy as np
+from django.utils import timezone
+
+from .models import Transaction
+
+CHUNK_SIZE = 500_000
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+MICROSECOND = timedelta(microseconds=1)
+
+DAY = timedelta(days=1) // MICROSECOND
+
+# the threshold_reached_at of a balance under the threshold
+NEVER = np.iinfo(np.int64).min
+
+
+def to_cents(amount):
+	return int(amount * 100)
+
+
+def to_microseconds(timestamp):
+	return (timestamp - EPOCH) // MICROSECOND
+
+
+def read_ledger(at, chunk_size=CHUNK_SIZE):
+	"""
+	Yields the ledger up to `at` in (collector ids, amounts in cents, timestamps in microseconds) arrays of
+	`chunk_size`.
+	"""
+	rows = (
+		Transaction.objects.filter(timestamp__lte=at)
+		.order_by("collector_id", "timestamp", "id")
+		.values_list("collector_id", "amount", "timestamp")
+		.iterator(chunk_size=10_000)
+	)
+	while chunk := list(islice(rows, chunk_size)):
+		yield (
+			np.fromiter((row[0] for row in chunk), dtype=np.int64, count=len(chunk)),
+			np.fromiter((to_cents(row[1]) for row in chunk), dtype=np.int64, count=len(chunk)),
+			np.fromiter((to_microseconds(row[2]) for row in chunk), dtype=np.int64, count=len(chunk)),
+		)
+
+
+class Carry(NamedTuple):
+	"""The state of the last collector of a chunk: his/her balance, and when it reached each USD threshold."""
+
+	collector_id: int
+	balance: int
+	reached: np.ndarray
+
+
+class Simulation:
+	"""
+	Replays the ledger under every (USD threshold, days threshold) pair of `usd_thresholds` x
+	`days_thresholds`, up to `at`. Feed it the chunks of `read_ledger` in order with `replay`, then `finish`.
+	"""
+
+	def __init__(self, usd_thresholds, days_thresholds, at):
+		self.usd_thresholds = list(usd_thresholds)
+		self.days_thresholds = list(days_thresholds)
+		self.usd = np.array([to_cents(usd) for usd in self.usd_thresholds], dtype=np.int64)
+		self.days = np.array([days * DAY for days in self.days_thresholds], dtype=np.int64)
+		self.at = to_microseconds(at)
+		self.carry = None
+
+		shape = (len(self.usd), len(self.days))
+		self.freezes = np.zeros(shape, dtype=np.int64)
+		self.frozen_now = np.zeros(shape, dtype=np.int64)
+		self.frozen_us = np.zeros(shape, dtype=np.int64)
+		self.longest_us = np.zeros(shape, dtype=np.int64)
+		# per days threshold, the (collector id, USD threshold index) pairs of the freezes, as keys
+		self.frozen_keys = [[] for _ in self.days]
+
+	def replay(self, collector_ids, amounts, timestamps):
+		"""Replays a chunk of the ledger, the chunks must follow each other in the ledger's order."""
+		n = len(collector_ids)
+		if not n:
+			return
+		starts = np.empty(n, dtype=bool)
+		starts[0] = True
+		starts[1:] = collector_ids[1:] != collector_ids[:-1]
+		carry = self.carry
+		continued = carry is not None and carry.collector_id == collector_ids[0]
+		if carry is not None and not continued:
+			self.close_carry()
+		carried_reached = carry.reached if continued else np.full(len(self.usd), NEVER)
+
+		# running balances, restarting at every collector
+		totals = np.cumsum(amounts)
+		first = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+		balances = totals - (totals - amounts)[first]
+		if continued:
+			balances[first == 0] += carry.balance
+
+		# whether the balance is at or above each threshold after, and before, each transaction
+		above = balances >= self.usd[:, None]
+		before = np.zeros_like(above)
+		before[:, 1:] = above[:, :-1]
+		before[:, starts] = False
+		if continued:
+			before[:, 0] = carry.balance >= self.usd
+
+		# when the balance reached the threshold, for the transactions leaving it at or above
+		run_start = np.where(above & ~before, np.arange(n), -1)
+		np.maximum.accumulate(run_start, axis=1, out=run_start)
+		reached = np.where(run_start >= 0, timestamps[run_start], carried_reached[:, None])
+		reached_before = np.empty_like(reached)
+		reached_before[:, 0] = carried_reached
+		reached_before[:, 1:] = reached[:, :-1]
+
+		# the runs a transaction ended by bringing the balance under the threshold
+		usd_index, index = np.nonzero(before & ~above)
+		self.tally(
+			usd_index, collector_ids[index], reached_before[usd_index, index], timestamps[index], False
+		)
+
+		# the runs still going at the last transaction of a collector, but the last one, which the next chunk
+		# may continue
+		last = np.zeros(n, dtype=bool)
+		last[:-1] = starts[1:]
+		usd_index, index = np.nonzero(above & last)
+		self.tally(usd_index, collector_ids[index], reached[usd_index, index], self.at, True)
+
+		self.carry = Carry(
+			int(collector_ids[-1]), int(balances[-1]), np.where(above[:, -1], reached[:, -1], NEVER)
+		)
+
+	def close_carry(self):
+		"""Tallies the run still going for the carried collector, his/her ledger is over."""
+		usd_index = np.nonzero(self.carry.reached != NEVER)[0]
+		collector_ids = np.full(len(usd_index), self.carry.collector_id, dtype=np.int64)
+		self.tally(usd_index, collector_ids, self.carry.reached[usd_index], self.at, True)
+		self.carry = None
+
+	def tally(self, usd_index, collector_ids, reached, ended, is_open):
+		"""
+		Counts the freezes of the runs at or above the USD thresholds of `usd_index`, from `reached` until
+		`ended`, for every days threshold. A run still going (`is_open`) ends at `at`.
+		"""
+		for days_index, days in enumerate(self.days):
+			duration = ended - (reached + days)
+			# the collector is frozen from the deadline until the run ends, or until `at` included
+			frozen = duration >= 0 if is_open else duration > 0
+			frozen_usd = usd_index[frozen]
+			np.add.at(self.freezes[:, days_index], frozen_usd, 1)
+			np.add.at(self.frozen_us[:, days_index], frozen_usd, duration[frozen])
+			np.maximum.at(self.longest_us[:, days_index], frozen_usd, duration[frozen])
+			if is_open:
+				np.add.at(self.frozen_now[:, days_index], frozen_usd, 1)
+			self.frozen_keys[days_index].append(collector_ids[frozen] * len(self.usd) + frozen_usd)
+
+	def finish(self):
+		"""Returns a dict per threshold pair, ordered by USD threshold then days threshold."""
+		if self.carry is not None:
+			self.close_carry()
+		frozen_collectors = np.zeros_like(self.freezes)
+		for days_index, keys in enumerate(self.frozen_keys):
+			keys = np.unique(np.concatenate(keys)) if keys else np.empty(0, dtype=np.int64)
+			frozen_collectors[:, days_index] = np.bincount(keys % len(self.usd), minlength=len(self.usd))
+		return [
+			{
+				"usd_threshold": usd,
+				"days_threshold": days,
+				"frozen_collectors": int(frozen_collectors[usd_index, days_index]),
+				"frozen_now": int(self.frozen_now[usd_index, days_index]),
+				"freezes": int(self.freezes[usd_index, days_index]),
+				"frozen_days": round(int(self.frozen_us[usd_index, days_index]) / DAY, 2),
+				"longest_frozen_days": round(int(self.longest_us[usd_index, days_index]) / DAY, 2),
+			}
+			for usd_index, usd in enumerate(self.usd_thresholds)
+			for days_index, days in enumerate(self.days_thresholds)
+		]
+
+
+def simulate(usd_thresholds, days_thresholds, at=None, chunk_size=CHUNK_SIZE):
+	"""
+	Replays the ledger up to `at` (default: now) under every pair of the thresholds, in one pass. Returns, for
+	each pair, how many collectors would have been frozen, are frozen at `at`, how many times they got frozen,
+	and for how many days in total and at most in a row.
+	"""
+	at = at or timezone.now()
+	simulation = Simulation(usd_thresholds, days_thresholds, at)
+	for chunk in read_ledger(at, chunk_size):
+		simulation.replay(*chunk)
+	return simulation.finish()
@@ -0,0 +1,23 @@
+import os
+
+from django.conf import settings
+from django.db import connections
+
+
+def pytest_configure(config):
+	"""
+	Adds a "replica" database for the read replica routing tests, separate from the default one (not a mirror)
+	so they can tell which one a query went to. Routing stays off unless a test sets DATABASE_REPLICA.
+	"""
+	default = settings.DATABASES["default"]
+	# created from the models, as a replica gets its schema and rows from the default database
+	test = {"MIGRATE": False}
+	if default["NAME"] != ":memory:":
+		test["NAME"] = f"test_{default['NAME']}_replica"
+	settings.DATABASES["replica"] = {**default, "TEST": test}
+	settings.DATABASE_REPLICA = None
+	# the connections may have read the settings already
+	connections.settings = connections.configure_settings(settings.DATABASES)
+	# the project's URLconf includes the APIs the ninja TestClients also mount, ninja would refuse the second
+	# registration
+	os.environ["NINJA_SKIP_REGISTRY"] = "1"
@@ -1,9 +1,46 @@
+import csv
+import json
+import random
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from importlib import import_module
+from itertools import groupby
+from urllib.parse import urlencode
+
 import pytest
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.apps import apps
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models import ProtectedError
+from django.http import HttpResponse
+from django.test import Client, RequestFactory
 from django.utils import timezone
-from ninja.testing import TestClient
+from ninja.testing import TestAsyncClient, TestClient
 
+from cash_collector import export, freeze, jobs, partitions, renderers, simulation
 from cash_collector.api import api as router
-from cash_collector.models import Customer, Task, User
+from cash_collector.async_api import api as async_api
+from cash_collector.auth import BearerAuth
+from cash_collector.metrics import RequestMetricsMiddleware, metrics
+from cash_collector.models import (
+	BalanceHistory,
+	CollectorBalance,
+	CollectorDailyRollup,
+	Customer,
+	IdempotencyKey,
+	Job,
+	Task,
+	Transaction,
+	User,
+)
+from cash_collector.pagination import EstimatedCountPaginator
+from cash_collector.routers import ReplicaRoutingMiddleware, client_keys
+from cash_collector.token_cache import TokenCache, token_cache
+
+UTC = dt_timezone.utc
 
 
 @pytest.fixture(scope="function")
@@ -90,3 +127,1386 @@ def test_collect_threshold_exceeded(client, manager, user, task):
 	)
 	assert response.status_code == 200
 	assert User.objects.get(id=user.id).is_frozen is False
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_collector_balance(client, manager, user, task):
+	response = client.post(
+		"collect",
+		json={"task_id": task.id, "amount": 20_000.0, "timestamp": timezone.now().isoformat()},
+		headers={"Authorization": f"Bearer {user.auth_token}"},
+	)
+	assert response.status_code == 200
+	assert CollectorBalance.objects.get(collector=user).amount == 20_000
+	assert Transaction.get_total_amount(user) == 20_000
+
+	response = client.post(
+		"pay",
+		json={"task_id": task.id, "amount": 15_000.0, "timestamp": timezone.now().isoformat()},
+		headers={"Authorization": f"Bearer {user.auth_token}"},
+	)
+	assert response.status_code == 200
+	assert Transaction.get_total_amount(user) == 5_000
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_rebuild_balances(client, manager, user, task, monkeypatch):
+	client.post(
+		"collect",
+		json={"task_id": task.id, "amount": 20_000.0, "timestamp": timezone.now().isoformat()},
+		headers={"Authorization": f"Bearer {user.auth_token}"},
+	)
+	call_command("rebuild_balances", "--verify")
+
+	CollectorBalance.objects.filter(collector=user).update(amount=0)
+	with pytest.raises(CommandError):
+		call_command("rebuild_balances", "--verify")
+
+	call_command("rebuild_balances")
+	assert CollectorBalance.objects.get(collector=user).amount == 20_000
+
+	# the mismatches are found without locking, a balance is replayed again under its lock before it's fixed
+	CollectorBalance.objects.filter(collector=user).update(amount=0)
+	stale = freeze.FreezeState(Decimal(10), None, None)
+	monkeypatch.setattr(CollectorBalance, "find_mismatches", lambda: [(user.id, stale, stale)])
+	assert CollectorBalance.rebuild() == 1
+	assert CollectorBalance.objects.get(collector=user).amount == 20_000
+	assert CollectorBalance.rebuild() == 0
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_append_only_ledger(admin_client, manager, user, task):
+	row = Transaction(collector=user, task=task, amount=20_000, timestamp=timezone.now())
+	row.save()
+	row.amount = 10_000
+	with pytest.raises(ValueError, match="can't be changed"):
+		row.save()
+	with pytest.raises(ValueError, match="can't be deleted"):
+		row.delete()
+	with pytest.raises(ProtectedError):
+		task.delete()
+	assert CollectorBalance.objects.get(collector=user).amount == 20_000
+
+	# the admin shows the ledger, read-only
+	path = f"/admin/cash_collector/transaction/{row.id}/change/"
+	assert admin_client.get(path).status_code == 200
+	assert admin_client.post(path, {"amount": 10_000}).status_code == 403
+	assert admin_client.get(f"/admin/cash_collector/transaction/{row.id}/delete/").status_code == 403
+	assert admin_client.get("/admin/cash_collector/transaction/add/").status_code == 403
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_frozen_after_days_threshold(client, manager, user, customer):
+	# the example in REQUIREMENTS.md, from 06:00 yesterday until now, 08:00 today
+	start = timezone.now() - timedelta(days=1, hours=2)
+	for amount, timestamp in [
+		(1000, start),
+		(6000, start + timedelta(hours=1)),
+		(2000, start + timedelta(days=1, hours=2)),
+	]:
+		task = Task.objects.create(
+			collector=user, manager=manager, customer=customer, amount_due=amount, amount_due_at=timestamp
+		)
+		response = client.post(
+			"collect",
+			json={"task_id": task.id, "amount": amount, "timestamp": timestamp.isoformat()},
+			headers={"Authorization": f"Bearer {user.auth_token}"},
+		)
+		assert response.status_code == 200
+
+	balance = CollectorBalance.objects.get(collector=user)
+	assert balance.threshold_reached_at == start + timedelta(hours=1)
+	assert balance.is_frozen(at=start + timedelta(days=2)) is False
+	assert balance.is_frozen(at=start + timedelta(days=2, minutes=59)) is False
+	assert balance.is_frozen(at=start + timedelta(days=2, hours=1)) is True
+
+	# no transaction is needed for the collector to become frozen
+	at = urlencode({"at": (start + timedelta(days=2, hours=1)).isoformat()})
+	response = client.get(f"status?{at}", headers={"Authorization": f"Bearer {user.auth_token}"})
+	assert response.json()["is_frozen"] is True
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_back_dated_transaction(client, manager, user, task):
+	response = client.post(
+		"pay",
+		json={"task_id": task.id, "amount": 6000, "timestamp": datetime(2000, 1, 2, tzinfo=UTC).isoformat()},
+		headers={"Authorization": f"Bearer {user.auth_token}"},
+	)
+	assert response.status_code == 200
+	assert CollectorBalance.objects.get(collector=user).threshold_reached_at is None
+
+	# the collection happened before the payment, the collector held the money for a day only
+	task = Task.objects.create(
+		collector=user, manager=manager, customer=task.customer, amount_due=6000, amount_due_at=timezone.now()
+	)
+	response = client.post(
+		"collect",
+		json={"task_id": task.id, "amount": 6000, "timestamp": datetime(2000, 1, 1, tzinfo=UTC).isoformat()},
+		headers={"Authorization": f"Bearer {user.auth_token}"},
+	)
+	assert response.status_code == 200
+	balance = CollectorBalance.objects.get(collector=user)
+	assert balance.amount == 0
+	assert balance.threshold_reached_at is None
+	assert balance.is_frozen() is False
+	assert list(BalanceHistory.objects.order_by("timestamp").values_list("amount", flat=True)) == [6000, 0]
+	call_command("rebuild_balances", "--verify")
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_transaction_timestamps(client, manager, user, customer):
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+	tasks = [
+		Task.objects.create(
+			collector=user,
+			manager=manager,
+			customer=customer,
+			amount_due=amount,
+			amount_due_at=timezone.now(),
+		)
+		for amount in (6_000, 10, 10, 10)
+	]
+	now = timezone.now()
+	response = client.post(
+		"collect",
+		json={"task_id": tasks[0].id, "amount": 6_000, "timestamp": (now - timedelta(days=3)).isoformat()},
+		headers=headers,
+	)
+	assert response.status_code == 200
+	assert User.objects.get(id=user.id).is_frozen is True
+
+	# the collector wasn't frozen 4 days ago, but is now
+	for message, timestamp in [
+		("The user is frozen.", now - timedelta(days=4)),
+		("The timestamp is in the future.", now + timedelta(hours=1)),
+		("The timestamp is too far before the collector's last transaction.", now - timedelta(days=7)),
+	]:
+		with pytest.raises(ValueError, match=message):
+			client.post(
+				"collect",
+				json={"task_id": tasks[1].id, "amount": 10, "timestamp": timestamp.isoformat()},
+				headers=headers,
+			)
+
+	# the same rules hold for a synced batch
+	operations = [
+		{"type": "collect", "task_id": task.id, "amount": 10, "timestamp": timestamp.isoformat()}
+		for task, timestamp in zip(
+			tasks[1:],
+			[now - timedelta(days=4), now + timedelta(hours=1), now - timedelta(days=7)],
+			strict=True,
+		)
+	]
+	response = client.post("sync", json=operations, headers=headers)
+	assert [result["error"] for result in response.json()] == [
+		"The user is frozen.",
+		"The timestamp is in the future.",
+		"The timestamp is too far before the collector's last transaction.",
+	]
+	assert CollectorBalance.objects.get(collector=user).amount == 6_000
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_status_at(client, manager, user, task, django_assert_num_queries):
+	client.post(
+		"collect",
+		json={
+			"task_id": task.id,
+			"amount": 20_000,
+			"timestamp": datetime(2000, 1, 1, tzinfo=UTC).isoformat(),
+		},
+		headers={"Authorization": f"Bearer {user.auth_token}"},
+	)
+	client.post(
+		"pay",
+		json={
+			"task_id": task.id,
+			"amount": 20_000,
+			"timestamp": datetime(2000, 1, 5, tzinfo=UTC).isoformat(),
+		},
+		headers={"Authorization": f"Bearer {user.auth_token}"},
+	)
+
+	def get_status(at):
+		return client.get(
+			f"status?{urlencode({'at': at.isoformat()})}",
+			headers={"Authorization": f"Bearer {user.auth_token}"},
+		).json()
+
+	# money is rendered as exact decimal strings
+	assert get_status(datetime(1999, 12, 31, tzinfo=UTC))["balance"] == "0.00"
+	assert get_status(datetime(2000, 1, 2, tzinfo=UTC))["is_frozen"] is False
+	assert get_status(datetime(2000, 1, 3, tzinfo=UTC))["is_frozen"] is True
+	assert get_status(datetime(2000, 1, 4, tzinfo=UTC))["balance"] == "20000.00"
+	assert get_status(datetime(2000, 1, 5, tzinfo=UTC))["is_frozen"] is False
+
+	queries = [
+		{"collector": user.id, "at": datetime(2000, 1, 4, tzinfo=UTC).isoformat()},
+		{"collector": user.id, "at": datetime(2000, 1, 6, tzinfo=UTC).isoformat()},
+		{"collector": manager.id, "at": datetime(2000, 1, 4, tzinfo=UTC).isoformat()},
+	]
+	response = client.post(
+		"manager/status", json=queries, headers={"Authorization": f"Bearer {user.auth_token}"}
+	)
+	assert response.status_code == 401
+
+	response = client.post(
+		"manager/status", json=queries, headers={"Authorization": f"Bearer {manager.auth_token}"}
+	)
+	assert response.status_code == 200
+	assert [(status["collector"], status["is_frozen"]) for status in response.json()] == [
+		(user.id, True),
+		(user.id, False),
+		(manager.id, False),
+	]
+
+	# any number of pairs, repeated or not, is one statement
+	at = datetime(2000, 1, 4, tzinfo=UTC)
+	with django_assert_num_queries(1):
+		statuses = BalanceHistory.statuses_at([(user.id, at), (manager.id, at), (user.id, at)])
+	assert [(status["balance"], status["is_frozen"]) for status in statuses] == [
+		(20_000, True),
+		(0, False),
+		(20_000, True),
+	]
+	assert BalanceHistory.statuses_at([]) == []
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_sync(client, manager, user, task):
+	other_task = Task.objects.create(
+		collector=user,
+		manager=manager,
+		customer=task.customer,
+		amount_due=1_000,
+		amount_due_at=timezone.now(),
+	)
+	operations = [
+		{"type": "collect", "task_id": task.id, "amount": 20_000, "timestamp": "2000-01-01T00:00:00Z"},
+		{"type": "collect", "task_id": task.id, "amount": 20_000, "timestamp": "2000-01-01T01:00:00Z"},
+		{"type": "collect", "task_id": 0, "amount": 1_000, "timestamp": "2000-01-01T02:00:00Z"},
+		# the collector has held 20,000 for more than two days
+		{"type": "collect", "task_id": other_task.id, "amount": 1_000, "timestamp": "2000-01-04T00:00:00Z"},
+		{"type": "pay", "task_id": task.id, "amount": 20_000, "timestamp": "2000-01-05T00:00:00Z"},
+		{"type": "collect", "task_id": other_task.id, "amount": 1_000, "timestamp": "2000-01-06T00:00:00Z"},
+	]
+	response = client.post("sync", json=operations, headers={"Authorization": f"Bearer {user.auth_token}"})
+	assert response.status_code == 200
+	assert [(result["success"], result["error"]) for result in response.json()] == [
+		(True, None),
+		(False, "The task is already collected."),
+		(False, "Task not found."),
+		(False, "The user is frozen."),
+		(True, None),
+		(True, None),
+	]
+	assert Transaction.objects.filter(collector=user).count() == 3
+	assert Task.objects.get(id=other_task.id).is_collected is True
+	assert CollectorBalance.objects.get(collector=user).amount == 1_000
+	call_command("rebuild_balances", "--verify")
+
+	# a retried batch gets its results back instead of paying again
+	headers = {"Authorization": f"Bearer {user.auth_token}", "Idempotency-Key": "sync-1"}
+	payments = [{"type": "pay", "task_id": task.id, "amount": 500, "timestamp": "2000-01-07T00:00:00Z"}]
+	first = client.post("sync", json=payments, headers=headers).json()
+	retry = client.post("sync", json=payments, headers=headers)
+	assert retry["Idempotent-Replayed"] == "true"
+	assert retry.json() == first
+	assert first[0]["success"] is True
+	assert CollectorBalance.objects.get(collector=user).amount == 500
+	assert client.post("sync", json=payments * 2, headers=headers).status_code == 422
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_sync_out_of_order(client, manager, user, customer):
+	now = timezone.now()
+	tasks = [
+		Task.objects.create(
+			collector=user, manager=manager, customer=customer, amount_due=amount, amount_due_at=now
+		)
+		for amount in (100, 6_000, 100, 100)
+	]
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+
+	def sync(*operations):
+		response = client.post(
+			"sync",
+			json=[
+				{
+					"type": "collect",
+					"task_id": task.id,
+					"amount": task.amount_due,
+					"timestamp": at.isoformat(),
+				}
+				for task, at in operations
+			],
+			headers=headers,
+		)
+		return [(result["success"], result["error"]) for result in response.json()]
+
+	# validated in timestamp order: the earlier collection froze the collector before the later one
+	assert sync((tasks[0], now), (tasks[1], now - timedelta(days=2, hours=1))) == [
+		(False, "The user is frozen."),
+		(True, None),
+	]
+
+	# the known limitation: back-dated before the stored last transaction, each operation is checked against
+	# the stored history, without the batch's earlier operations, which would have frozen the collector
+	Transaction.objects.filter(collector=user).delete()
+	call_command("rebuild_balances")
+	Task.objects.update(is_collected=False)
+	assert sync((tasks[2], now - timedelta(hours=1))) == [(True, None)]
+	assert sync(
+		(tasks[1], now - timedelta(days=2, hours=23)),
+		(tasks[3], now - timedelta(hours=12)),
+	) == [(True, None), (True, None)]
+	balance = CollectorBalance.objects.get(collector=user)
+	assert balance.is_frozen(at=now - timedelta(hours=12)) is True
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_auth_token_cache(client, user):
+	assert User.objects.get(id=user.id).auth_token_hash == User.hash_auth_token("testtoken2")
+	token_cache.clear()
+	stats = token_cache.stats()
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+
+	assert client.get("status", headers=headers).status_code == 200
+	assert client.get("status", headers=headers).status_code == 200
+	assert token_cache.stats()["misses"] == stats["misses"] + 1
+	assert token_cache.stats()["hits"] == stats["hits"] + 1
+
+	# what a request caches on its user, e.g. the balance a transaction leaves, stays with the request
+	token_cache.clear()
+	authenticated = BearerAuth().authenticate(None, user.auth_token)
+	authenticated.balance = CollectorBalance(collector=authenticated, amount=1)
+	assert not CollectorBalance.objects.filter(collector=user).exists()
+	with pytest.raises(User.balance.RelatedObjectDoesNotExist):
+		BearerAuth().authenticate(None, user.auth_token).balance  # noqa: B018
+
+	old_token = user.auth_token
+	new_token = user.rotate_auth_token()
+	assert client.get("status", headers={"Authorization": f"Bearer {old_token}"}).status_code == 401
+	assert client.get("status", headers={"Authorization": f"Bearer {new_token}"}).status_code == 200
+
+	user.is_active = False
+	user.save()
+	assert client.get("status", headers={"Authorization": f"Bearer {new_token}"}).status_code == 401
+
+
+@pytest.mark.cashcollector()
+def test_token_cache_expiry_and_eviction():
+	cache = TokenCache(maxsize=2, ttl=60)
+	first, second, third = User(pk=1), User(pk=2), User(pk=3)
+	cache.set("a", first)
+	cache.set("b", second)
+	assert cache.get("a").pk == 1
+	cache.set("c", third)
+	# "b" is the least recently used
+	assert cache.get("b") is None
+	assert cache.get("a") is not None
+
+	cache.invalidate(user_id=1)
+	assert cache.get("a") is None
+
+	expired = TokenCache(maxsize=2, ttl=-1)
+	expired.set("a", first)
+	assert expired.get("a") is None
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_tasks_pagination(client, manager, user, customer, django_assert_max_num_queries):
+	for day in range(1, 6):
+		task = Task.objects.create(
+			collector=user,
+			manager=manager,
+			customer=customer,
+			amount_due=100,
+			amount_due_at=datetime(2000, 1, day, tzinfo=UTC),
+		)
+		client.post(
+			"collect",
+			json={"task_id": task.id, "amount": 100, "timestamp": timezone.now().isoformat()},
+			headers={"Authorization": f"Bearer {user.auth_token}"},
+		)
+	# not done yet
+	Task.objects.create(
+		collector=user, manager=manager, customer=customer, amount_due=100, amount_due_at=timezone.now()
+	)
+
+	tasks, cursor = [], ""
+	for _ in range(3):
+		with django_assert_max_num_queries(3):
+			response = client.get(
+				f"tasks?limit=2&cursor={cursor}", headers={"Authorization": f"Bearer {user.auth_token}"}
+			)
+		assert response.status_code == 200
+		tasks += response.json()
+		cursor = response.get("X-Next-Cursor")
+	assert cursor is None
+	assert [task["amount_due_at"][:10] for task in tasks] == [f"2000-01-0{day}" for day in range(1, 6)]
+	assert all(task["related_transaction"] is not None for task in tasks)
+
+	response = client.get("tasks?cursor=nonsense", headers={"Authorization": f"Bearer {user.auth_token}"})
+	assert response.status_code == 400
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_next_task(client, manager, user, customer, django_assert_num_queries):
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+	assert client.get("next_task", headers=headers).json() is None
+
+	later = Task.objects.create(
+		collector=user,
+		manager=manager,
+		customer=customer,
+		amount_due=200,
+		amount_due_at=datetime(2000, 1, 2, tzinfo=UTC),
+	)
+	first = Task.objects.create(
+		collector=user,
+		manager=manager,
+		customer=customer,
+		amount_due=100,
+		amount_due_at=datetime(2000, 1, 1, tzinfo=UTC),
+	)
+	# the collector's version for the ETag, then the task
+	with django_assert_num_queries(2):
+		task = client.get("next_task", headers=headers).json()
+	assert (task["id"], task["amount_due"], task["related_transaction"]) == (first.id, "100.00", None)
+
+	client.post(
+		"collect",
+		json={"task_id": first.id, "amount": 100, "timestamp": timezone.now().isoformat()},
+		headers=headers,
+	)
+	assert client.get("next_task", headers=headers).json()["id"] == later.id
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_async_api(manager, user, task):
+	client = TestAsyncClient(async_api)
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+
+	async def run():
+		response = await client.get("next_task", headers=headers)
+		assert response.json()["id"] == task.id
+
+		response = await client.post(
+			"collect",
+			json={"task_id": task.id, "amount": 20_000.0, "timestamp": "2000-01-01T00:00:00Z"},
+			headers=headers,
+		)
+		assert response.status_code == 200
+		assert (await client.get("next_task", headers=headers)).json() is None
+		assert [t["id"] for t in (await client.get("tasks", headers=headers)).json()] == [task.id]
+		assert (await client.get("status", headers=headers)).json()["is_frozen"] is True
+		response = await client.get("status?at=2000-01-02T00:00:00Z", headers=headers)
+		assert response.json()["is_frozen"] is False
+
+		response = await client.post(
+			"pay",
+			json={"task_id": task.id, "amount": 20_000.0, "timestamp": "2000-01-02T00:00:00Z"},
+			headers=headers,
+		)
+		assert response.status_code == 200
+		assert (await client.get("status", headers=headers)).json()["is_frozen"] is False
+		assert (await client.get("status", headers={"Authorization": "Bearer nonsense"})).status_code == 401
+
+	async_to_sync(run)()
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_generate_data_and_benchmark(tmp_path):
+	call_command(
+		"generate_data",
+		managers=2,
+		collectors=3,
+		customers=5,
+		tasks_per_collector=10,
+		pay_probability=0.5,
+		stdout=None,
+	)
+	assert Task.objects.filter(collector__username__startswith="bench-collector-").count() == 30
+	call_command("rebuild_balances", "--verify")
+
+	output = tmp_path / "results.json"
+	call_command("benchmark", requests=6, output=str(output))
+	results = json.loads(output.read_text())
+	assert set(results["endpoints"]) == {"tasks", "next_task", "status", "collect"}
+	assert results["endpoints"]["collect"]["requests"] == 6
+	assert results["endpoints"]["next_task"]["queries_per_request"] <= 2
+
+	assert results["serialization"]["rows"] > 0
+	assert results["serialization"]["orjson_ms"] > 0
+
+	call_command("benchmark", requests=2, endpoint=["status"], compare=str(output), serialization_rows=0)
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_request_metrics(manager, user, task, settings, caplog):
+	# requests go through the project's URLconf and middleware, like in production
+	metrics.clear()
+	http = Client(headers={"Authorization": f"Bearer {user.auth_token}"})
+	assert http.get("/api/status").status_code == 200
+	assert b"".join(http.get("/api/tasks").streaming_content) == b"[]"
+	assert http.get("/api/next_task").status_code == 200
+
+	text = http.get("/metrics").content.decode()
+	assert 'http_requests_total{route="api/status",method="GET",status="200"} 1' in text
+	assert 'http_request_sql_queries_count{route="api/tasks",method="GET"} 1' in text
+	assert 'http_response_size_bytes_sum{route="api/tasks",method="GET"} 2' in text
+	assert 'http_request_duration_seconds_bucket{route="api/next_task",method="GET",le="+Inf"} 1' in text
+	assert "auth_token_cache_hits_total" in text
+	# the streamed rows are queried after the view returned
+	assert 'http_request_sql_queries_bucket{route="api/tasks",method="GET",le="0"} 0' in text
+
+	settings.METRICS_QUERY_BUDGET = 0
+	with caplog.at_level("WARNING", logger="cash_collector.metrics"):
+		http.get("/api/next_task")
+	assert "GET /api/next_task took" in caplog.text
+	assert "SELECT" in caplog.text
+
+	settings.METRICS_ALLOWED_IPS = ["10.0.0.1"]
+	assert http.get("/metrics").status_code == 403
+	settings.METRICS_ALLOWED_IPS = []
+	assert http.get("/metrics").status_code == 403
+
+	# under ASGI, the async views run through the middleware without leaving the event loop
+	async def view(request):
+		return HttpResponse(str(await Task.objects.acount()))
+
+	metrics.clear()
+	middleware = RequestMetricsMiddleware(view)
+	assert iscoroutinefunction(middleware)
+	assert async_to_sync(middleware)(RequestFactory().get("/api/async/status")).content == b"1"
+	assert 'http_request_sql_queries_sum{route="unmatched",method="GET"} 1' in metrics.render()
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_transaction_write_path(manager, user, customer, django_assert_num_queries):
+	tasks = [
+		Task.objects.create(
+			collector=user, manager=manager, customer=customer, amount_due=100, amount_due_at=timezone.now()
+		)
+		for _ in range(2)
+	]
+	Transaction.objects.create(collector=user, task=tasks[0], amount=100, timestamp=timezone.now())
+
+	# lock the balance, lock the task with its collected amount, insert, then update the task, the daily
+	# rollup (read and upsert), the balance history and the balance; inside the test's transaction, atomic()
+	# adds a savepoint and its release
+	with django_assert_num_queries(10) as queries:
+		Transaction.objects.create(collector=user, task=tasks[1], amount=100, timestamp=timezone.now())
+	assert 'UPDATE "cash_collector_task" SET "is_collected"' in queries.captured_queries[4]["sql"]
+	assert CollectorBalance.objects.get(collector=user).amount == 200
+	assert Task.objects.filter(is_collected=True).count() == 2
+
+	with django_assert_num_queries(9):
+		Transaction.objects.create(collector=user, task=tasks[1], amount=-200, timestamp=timezone.now())
+	assert CollectorBalance.objects.get(collector=user).amount == 0
+
+	other = User.objects.create(username="other", auth_token="othertoken")
+	for collector, task_id, amount, message in [
+		(user, tasks[1].id, 100, "The task is already collected."),
+		(other, tasks[1].id, 100, "The collector is not the collector of the task."),
+		(manager, tasks[1].id, 100, "A manager cannot collect/pay money."),
+		(user, None, 100, "Cannot create a transaction without a task."),
+	]:
+		with pytest.raises(ValueError, match=message):
+			Transaction.objects.create(collector=collector, task_id=task_id, amount=amount)
+	assert Transaction.objects.count() == 3
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_idempotency_key(client, manager, user, task, django_assert_max_num_queries):
+	payload = {"task_id": task.id, "amount": 20_000.0, "timestamp": timezone.now().isoformat()}
+	headers = {"Authorization": f"Bearer {user.auth_token}", "Idempotency-Key": "collect-1"}
+	response = client.post("collect", json=payload, headers=headers)
+	assert response.status_code == 200
+	assert not response.has_header("Idempotent-Replayed")
+
+	# the retry gets the same response without touching the tasks or the ledger
+	with django_assert_max_num_queries(5) as queries:
+		retry = client.post("collect", json=payload, headers=headers)
+	assert retry.status_code == 200
+	assert retry.json() == response.json()
+	assert retry["Idempotent-Replayed"] == "true"
+	assert not any("cash_collector_task" in query["sql"] for query in queries.captured_queries)
+	assert Transaction.objects.count() == 1
+
+	response = client.post("collect", json={**payload, "amount": 1.0}, headers=headers)
+	assert response.status_code == 422
+
+	# a failed write doesn't use the key up
+	pay = {"task_id": task.id, "amount": 30_000.0, "timestamp": timezone.now().isoformat()}
+	headers["Idempotency-Key"] = "pay-1"
+	with pytest.raises(ValueError, match="The amount should be less than zero."):
+		client.post("pay", json={**pay, "amount": 0}, headers=headers)
+	assert not IdempotencyKey.objects.filter(key="pay-1").exists()
+	assert client.post("pay", json=pay, headers=headers).status_code == 200
+
+	headers["Idempotency-Key"] = "x" * 256
+	assert client.post("pay", json=pay, headers=headers).status_code == 400
+
+	IdempotencyKey.objects.filter(key="collect-1").update(expires_at=timezone.now())
+	call_command("purge_idempotency_keys", batch_size=1, stdout=None)
+	assert list(IdempotencyKey.objects.values_list("key", flat=True)) == ["pay-1"]
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_manager_dashboard(client, manager, user, customer, settings, django_assert_num_queries):
+	settings.MANAGER_DASHBOARD_CACHE_TTL = 60
+	# the queries of the dashboard are counted, not those of the database cache
+	settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+	cache.clear()
+	other = User.objects.create(username="other", auth_token="othertoken", manager=manager)
+	now = timezone.now()
+	tasks = [
+		Task.objects.create(
+			collector=collector, manager=manager, customer=customer, amount_due=amount, amount_due_at=due_at
+		)
+		for collector, amount, due_at in [
+			(user, 6_000, now - timezone.timedelta(days=5)),
+			(user, 100, now - timezone.timedelta(days=1)),
+			(user, 200, now + timezone.timedelta(days=1)),
+			(other, 300, now + timezone.timedelta(days=1)),
+		]
+	]
+	Transaction.objects.create(
+		collector=user, task=tasks[0], amount=6_000, timestamp=now - timezone.timedelta(days=3)
+	)
+	headers = {"Authorization": f"Bearer {manager.auth_token}"}
+	assert (
+		client.get("manager/collectors", headers={"Authorization": f"Bearer {user.auth_token}"}).status_code
+		== 401
+	)
+
+	# authentication, the collectors with their balance, then their open tasks grouped by collector
+	with django_assert_num_queries(3):
+		response = client.get("manager/collectors?limit=1", headers=headers)
+	assert response.status_code == 200
+	[row] = response.json()
+	assert row["id"] == user.id
+	assert row["balance"] == "6000.00"
+	assert row["is_frozen"] is True
+	assert (row["open_tasks"], row["overdue_tasks"], Decimal(row["overdue_amount"])) == (2, 1, 100)
+
+	response = client.get(f"manager/collectors?cursor={response['X-Next-Cursor']}", headers=headers)
+	[row] = response.json()
+	assert (row["id"], row["balance"], row["is_frozen"], row["open_tasks"]) == (other.id, "0.00", False, 1)
+	assert not response.has_header("X-Next-Cursor")
+
+	summary = client.get("manager/summary", headers=headers).json()
+	assert summary["collectors"] == 2
+	assert summary["frozen_collectors"] == summary["collectors_over_threshold"] == 1
+	assert Decimal(summary["total_balance"]) == 6_000
+	assert (summary["open_tasks"], Decimal(summary["overdue_amount"])) == (3, 100)
+
+	# served from the cache until it expires
+	Task.objects.filter(is_collected=False).delete()
+	with django_assert_num_queries(0):
+		assert client.get("manager/summary", headers=headers).json() == summary
+	cache.clear()
+	assert client.get("manager/summary", headers=headers).json()["open_tasks"] == 0
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_export_status(client, manager, user, customer, tmp_path):
+	start = datetime(2000, 1, 1, tzinfo=UTC)
+	tasks = [
+		Task.objects.create(
+			collector=user, manager=manager, customer=customer, amount_due=6_000, amount_due_at=start
+		)
+		for _ in range(2)
+	]
+	for task, amount, days in [(tasks[0], 6_000, 0), (tasks[0], -6_000, 3), (tasks[1], 6_000, 4)]:
+		Transaction.objects.create(
+			collector=user, task=task, amount=amount, timestamp=start + timezone.timedelta(days=days)
+		)
+
+	output = tmp_path / "status.csv"
+	call_command("export_status", output=str(output), chunk_size=1, stderr=None)
+	with output.open() as file:
+		rows = list(csv.DictReader(file))
+	assert [(row["event"], row["timestamp"][:10], row["balance"], row["is_frozen"]) for row in rows] == [
+		("transaction", "2000-01-01", "6000.00", "False"),
+		("frozen", "2000-01-03", "6000.00", "True"),
+		("transaction", "2000-01-04", "0.00", "False"),
+		("unfrozen", "2000-01-04", "0.00", "False"),
+		("transaction", "2000-01-05", "6000.00", "False"),
+		("frozen", "2000-01-07", "6000.00", "True"),
+	]
+	assert rows[0]["task"] == str(tasks[0].id)
+	assert rows[1]["transaction"] == ""
+
+	headers = {"Authorization": f"Bearer {manager.auth_token}"}
+	response = client.get(f"manager/status/export?collector={user.id}", headers=headers)
+	assert response.status_code == 200
+	assert response["Content-Type"] == "text/csv"
+	assert response.content == output.read_bytes()
+	response = client.get(f"manager/status/export?collector={manager.id}", headers=headers)
+	assert response.content.decode().splitlines() == [",".join(export.COLUMNS)]
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_transaction_partitions():
+	months = list(
+		partitions.months_between(datetime(2023, 11, 30, 23, tzinfo=UTC), datetime(2024, 2, 1, tzinfo=UTC))
+	)
+	assert [partitions.partition_name(month) for month in months] == [
+		"cash_collector_transaction_p202311",
+		"cash_collector_transaction_p202312",
+		"cash_collector_transaction_p202401",
+		"cash_collector_transaction_p202402",
+	]
+	assert partitions.add_months(datetime(2024, 12, 1, tzinfo=UTC), -13) == datetime(2023, 11, 1, tzinfo=UTC)
+
+	if not partitions.is_supported():
+		with pytest.raises(CommandError, match="Partitioning needs PostgreSQL."):
+			call_command("manage_partitions")
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_partitioned_ledger(manager, user, customer, settings):
+	if not partitions.is_supported():
+		pytest.skip("Partitioning needs PostgreSQL.")
+
+	def count(table):
+		with connection.cursor() as cursor:
+			cursor.execute(f'SELECT count(*) FROM "{table}"')  # noqa: S608
+			return cursor.fetchone()[0]
+
+	def collect(amount, timestamp):
+		task = Task.objects.create(
+			collector=user, manager=manager, customer=customer, amount_due=amount, amount_due_at=timestamp
+		)
+		row = Transaction(collector=user, task=task, amount=amount, timestamp=timestamp)
+		row.save()
+		return row
+
+	now = timezone.now()
+	first = collect(10, now - timedelta(days=1))
+	partitions.convert(ahead=1, now=now)
+	assert partitions.is_partitioned()
+	this_month = partitions.month_start(now)
+	assert {partitions.partition_name(this_month), f"{partitions.TABLE}_default"} <= set(
+		partitions.partitions()
+	)
+
+	# the write path inserts into the partitions, ids carry on from the plain table's
+	second = collect(10, now)
+	assert second.id > first.id
+	assert Transaction.objects.filter(timestamp__gte=this_month).count() == count(
+		partitions.partition_name(this_month)
+	)
+
+	# a month without a partition goes to the default one, creating its partition moves its rows there
+	old_month = partitions.add_months(this_month, -13)
+	Transaction.objects.bulk_create(
+		[Transaction(collector=user, task=first.task, amount=0, timestamp=old_month + timedelta(days=1))]
+	)
+	assert count(f"{partitions.TABLE}_default") == 1
+	assert partitions.create_partition(connection, old_month) is True
+	assert count(f"{partitions.TABLE}_default") == 0
+	assert count(partitions.partition_name(old_month)) == 1
+
+	# detached months leave the ledger, but are kept as tables
+	before = partitions.add_months(old_month, 1)
+	assert partitions.detach_partitions(before=before) == [partitions.partition_name(old_month)]
+	assert count(partitions.partition_name(old_month)) == 1
+	assert Transaction.objects.count() == 2
+
+	partitions.revert()
+	assert not partitions.is_partitioned()
+	assert sorted(Transaction.objects.values_list("id", flat=True)) == [first.id, second.id]
+	assert collect(10, now).id > second.id
+
+	# the migration, both ways
+	migration = import_module("cash_collector.migrations.0017_partition_transaction")
+	settings.TRANSACTION_PARTITIONING = True
+	with connection.schema_editor() as schema_editor:
+		migration.partition_transaction(apps, schema_editor)
+	assert partitions.is_partitioned()
+	assert Transaction.objects.count() == 3
+	with connection.schema_editor() as schema_editor:
+		migration.unpartition_transaction(apps, schema_editor)
+	assert not partitions.is_partitioned()
+	assert Transaction.objects.count() == 3
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_daily_rollups(client, manager, user, customer, django_assert_num_queries):
+	day = timezone.timedelta(days=1)
+	start = datetime(2000, 1, 1, 8, tzinfo=UTC)
+	tasks = [
+		Task.objects.create(
+			collector=user, manager=manager, customer=customer, amount_due=100, amount_due_at=start
+		)
+		for _ in range(3)
+	]
+	for task, amount, at in [
+		(tasks[0], 100, start),
+		(tasks[1], 100, start + timezone.timedelta(hours=1)),
+		(tasks[1], -150, start + timezone.timedelta(hours=2)),
+		(tasks[2], 100, start + 2 * day),
+	]:
+		Transaction.objects.create(collector=user, task=task, amount=amount, timestamp=at)
+
+	def rollups():
+		return list(
+			CollectorDailyRollup.objects.filter(collector=user)
+			.order_by("day")
+			.values_list("day", "collected", "paid", "transactions", "closing_balance", "peak_balance")
+		)
+
+	expected = [
+		(start.date(), 200, 150, 3, 50, 200),
+		((start + 2 * day).date(), 100, 0, 1, 150, 150),
+	]
+	assert rollups() == expected
+
+	# a back-dated transaction rewrites the rollups from its day
+	Transaction.objects.create(collector=user, task=tasks[0], amount=-50, timestamp=start + day)
+	assert rollups() == [
+		expected[0],
+		((start + day).date(), 0, 50, 1, 0, 50),
+		(expected[1][0], 100, 0, 1, 100, 100),
+	]
+	rebuilt = rollups()
+	call_command("backfill_rollups", stdout=None)
+	assert rollups() == rebuilt
+	# a rewrite since None replays the whole ledger, not today only
+	CollectorDailyRollup.objects.filter(collector=user).update(closing_balance=0)
+	CollectorDailyRollup.rewrite(user.id, since=None)
+	assert rollups() == rebuilt
+
+	# the closing balance of the day before, then the transactions of the day up to the instant
+	with django_assert_num_queries(2):
+		assert (
+			CollectorDailyRollup.balance_at(user.id, start + timezone.timedelta(hours=1, minutes=30)) == 200
+		)
+	assert CollectorDailyRollup.balance_at(user.id, start + day + day) == 100
+	assert CollectorDailyRollup.balance_at(user.id, start - day) == 0
+
+	headers = {"Authorization": f"Bearer {manager.auth_token}"}
+	response = client.get(
+		f"manager/daily?since=2000-01-02&until=2000-01-03&collector={user.id}", headers=headers
+	)
+	assert [(row["day"], row["paid"], row["closing_balance"]) for row in response.json()] == [
+		("2000-01-02", "50.00", "0.00"),
+		("2000-01-03", "0.00", "100.00"),
+	]
+	assert client.get("manager/daily?since=2000-01-03&until=2000-01-02", headers=headers).status_code == 400
+
+
+@pytest.mark.django_db(databases=["default", "replica"])
+@pytest.mark.cashcollector()
+def test_replica_routing(manager, user, task, settings):
+	settings.DATABASE_REPLICA = "replica"
+	cache.clear()
+	token_cache.clear()
+	# the replica lags behind: it has the users but not the task yet
+	User.objects.using("replica").bulk_create([manager, user])
+	http = Client(headers={"Authorization": f"Bearer {user.auth_token}"})
+
+	assert http.get("/api/next_task").json() is None
+
+	# the user authenticated on the replica is cached, the write still goes to the default database
+	response = http.post(
+		"/api/collect",
+		{"task_id": task.id, "amount": 20_000.0, "timestamp": timezone.now().isoformat()},
+		content_type="application/json",
+	)
+	assert response.status_code == 200
+	assert not Transaction.objects.using("replica").exists()
+
+	# the collector reads its own writes for DATABASE_REPLICA_STICKY_SECONDS
+	assert [row["id"] for row in json.loads(b"".join(http.get("/api/tasks").streaming_content))] == [task.id]
+	cache.clear()
+	assert b"".join(http.get("/api/tasks").streaming_content) == b"[]"
+
+	# a request that failed to authenticate, or wrote nothing, doesn't stick
+	cache.clear()
+	http.post("/api/collect", {}, content_type="application/json")
+	Client(headers={"Authorization": "Bearer wrongtoken"}).post(
+		"/api/pay", {"task_id": task.id, "amount": 1.0}, content_type="application/json"
+	)
+	assert not cache.get_many(
+		client_keys(RequestFactory().get("/", headers={"Authorization": "Bearer wrongtoken"}))
+	)
+	assert b"".join(http.get("/api/tasks").streaming_content) == b"[]"
+
+	# and under ASGI
+	async def view(request):
+		if request.method == "POST":
+			request.auth = user
+			if request.GET.get("write"):
+				await Task.objects.filter(id=task.id).aupdate(amount_due=task.amount_due)
+		return HttpResponse(str(await Task.objects.filter(id=task.id).aexists()))
+
+	middleware = ReplicaRoutingMiddleware(view)
+	assert iscoroutinefunction(middleware)
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+	assert async_to_sync(middleware)(RequestFactory().get("/", headers=headers)).content == b"False"
+	async_to_sync(middleware)(RequestFactory().post("/", headers=headers))
+	assert async_to_sync(middleware)(RequestFactory().get("/", headers=headers)).content == b"False"
+	async_to_sync(middleware)(RequestFactory().post("/?write=1", headers=headers))
+	assert async_to_sync(middleware)(RequestFactory().get("/", headers=headers)).content == b"True"
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_replica_sticky_clients_kept(user, settings):
+	settings.DATABASE_REPLICA = "replica"
+	cache.clear()
+
+	def view(request):
+		request.auth = user
+		User.objects.filter(pk=user.pk).update(last_login=timezone.now())
+		return HttpResponse()
+
+	# the database cache culls entries past MAX_ENTRIES, expired or not, in the order of their keys: the
+	# session's sorts before the tokens'
+	middleware = ReplicaRoutingMiddleware(view)
+	sticky = RequestFactory().get("/")
+	sticky.COOKIES[settings.SESSION_COOKIE_NAME] = "0" * 32
+	middleware(RequestFactory().post("/", headers={"Cookie": f"{settings.SESSION_COOKIE_NAME}={'0' * 32}"}))
+	for writer in range(400):
+		middleware(RequestFactory().post("/", headers={"Authorization": f"Bearer writer{writer}"}))
+	assert cache.get_many(client_keys(sticky))
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_conditional_get(client, manager, user, task, django_assert_num_queries):
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+	etags = {path: client.get(path, headers=headers)["ETag"] for path in ("status", "tasks", "next_task")}
+	assert etags["status"].startswith('W/"')
+
+	# a poll with the current ETag is answered by the version lookup alone
+	for path, etag in etags.items():
+		with django_assert_num_queries(1):
+			response = client.get(path, headers={**headers, "If-None-Match": etag})
+		assert response.status_code == 304
+		assert response["ETag"] == etag
+
+	# a transaction bumps the version
+	client.post(
+		"collect",
+		json={"task_id": task.id, "amount": 20_000.0, "timestamp": timezone.now().isoformat()},
+		headers=headers,
+	)
+	for path, etag in etags.items():
+		response = client.get(path, headers={**headers, "If-None-Match": etag})
+		assert response.status_code == 200
+		etags[path] = response["ETag"]
+
+	# so does a change of the collector's tasks, and reassigning one bumps its previous collector's version
+	other = User.objects.create(username="othercollector", auth_token="testtoken3", manager=manager)
+	Task.objects.create(
+		collector=user, manager=manager, customer=task.customer, amount_due=10, amount_due_at=timezone.now()
+	)
+	assert (
+		client.get("next_task", headers={**headers, "If-None-Match": etags["next_task"]}).status_code == 200
+	)
+	version = CollectorBalance.objects.get(collector=user).version
+	task = Task.objects.get(pk=task.pk)
+	task.collector = other
+	task.save()
+	assert CollectorBalance.objects.get(collector=user).version == version + 1
+	assert CollectorBalance.objects.get(collector=other).version == 1
+
+	# as do queryset deletes, and the cascades of a customer's
+	Task.objects.filter(collector=user, is_collected=False).delete()
+	assert CollectorBalance.objects.get(collector=user).version == version + 2
+	customer = Customer.objects.create(name="othercustomer")
+	Task.objects.create(
+		collector=other, manager=manager, customer=customer, amount_due=10, amount_due_at=timezone.now()
+	)
+	customer.delete()
+	assert CollectorBalance.objects.get(collector=other).version == 3
+	assert not Task.objects.filter(customer__name="othercustomer").exists()
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_decimal_money(client, manager, user, customer):
+	headers = {"Authorization": f"Bearer {user.auth_token}"}
+	tasks = [
+		Task.objects.create(
+			collector=user,
+			manager=manager,
+			customer=customer,
+			amount_due=Decimal("0.10"),
+			amount_due_at=datetime(2000, 1, day, tzinfo=UTC),
+		)
+		for day in (1, 2)
+	]
+	task = client.get("next_task", headers=headers).json()
+	assert (task["amount_due"], task["amount_due_at"]) == ("0.10", "2000-01-01T00:00:00Z")
+
+	# amounts are exact, as strings or numbers, and at most to the cent
+	at = datetime(2000, 1, 1, tzinfo=UTC).isoformat()
+	response = client.post(
+		"collect", json={"task_id": tasks[0].id, "amount": 0.001, "timestamp": at}, headers=headers
+	)
+	assert response.status_code == 422
+	for task, amount in zip(tasks, ("0.10", 0.1), strict=True):
+		response = client.post(
+			"collect", json={"task_id": task.id, "amount": amount, "timestamp": at}, headers=headers
+		)
+		assert response.status_code == 200
+	assert CollectorBalance.objects.get(collector=user).amount == Decimal("0.20")
+	assert client.get("status", headers=headers).json()["balance"] == "0.20"
+	# with two decimal places, whatever the Decimal's exponent
+	assert renderers.dumps([Decimal(0), Decimal("5"), Decimal("1.5")]) == b'["0.00","5.00","1.50"]'
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_import_tasks(client, manager, user, customer, tmp_path, capsys):
+	version = CollectorBalance.objects.filter(collector=user).values_list("version", flat=True).first() or 0
+	path = tmp_path / "tasks.csv"
+	path.write_text(
+		"collector,manager,customer,amount_due,amount_due_at\n"
+		f"{user.id},{manager.id},{customer.id},100.50,2000-01-01T08:00:00Z\n"
+		f"{user.id},,{customer.id},100,2000-01-02T08:00:00Z\n"
+		f"{user.id},{manager.id},{customer.id},-1,2000-01-02T08:00:00Z\n"
+		f"{manager.id},{manager.id},{customer.id},100,2000-01-03T08:00:00Z\n"
+		f"{user.id},{manager.id},{customer.id},100,2000-01-04\n"
+		f"{user.id},{manager.id},{customer.id},200,2000-01-05T08:00:00+02:00\n"
+	)
+	call_command("import_tasks", str(path), batch_size=2)
+	output = capsys.readouterr()
+	assert json.loads(output.out) == {"created": 2, "failed": 4}
+	errors = output.err.splitlines()
+	assert errors[0] == "Line 3: Missing manager."
+	assert errors[1].startswith("Line 4: amount_due: Input should be greater than 0")
+	assert errors[2] == f"Line 5: Unknown collector {manager.id}."
+	assert errors[3].startswith("Line 6: amount_due_at:")
+	assert sorted(Task.objects.values_list("amount_due", flat=True)) == [Decimal("100.50"), Decimal("200")]
+	# the collector's ETags change
+	assert CollectorBalance.objects.get(collector=user).version > version
+
+	# the same rows as JSONL through the API, the tasks without a manager are the importing manager's
+	lines = [
+		json.dumps(
+			{
+				"collector": user.id,
+				"customer": customer.id,
+				"amount_due": "10",
+				"amount_due_at": "2000-01-01T08:00:00Z",
+			}
+		),
+		"{not json",
+		json.dumps(
+			{"collector": 0, "customer": 0, "amount_due": 10, "amount_due_at": "2000-01-01T08:00:00Z"}
+		),
+	]
+	response = client.post(
+		"manager/tasks/import",
+		FILES={"file": SimpleUploadedFile("tasks.jsonl", "\n".join(lines).encode())},
+		headers={"Authorization": f"Bearer {manager.auth_token}"},
+	)
+	assert response.status_code == 200
+	report = response.json()
+	assert (report["created"], report["failed"]) == (1, 2)
+	assert report["errors"][0]["line"] == 2
+	assert report["errors"][1] == {"line": 3, "error": "Unknown collector 0. Unknown customer 0."}
+	assert Task.objects.get(amount_due=10).manager == manager
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_assign_tasks(client, manager, user, customer, capsys):
+	busy = User.objects.create(username="busy", auth_token="testtoken3", manager=manager)
+	frozen = User.objects.create(username="frozen", auth_token="testtoken4", manager=manager)
+	CollectorBalance.objects.create(collector=frozen, frozen_at=datetime(2000, 1, 1, tzinfo=UTC))
+	other_manager = User.objects.create(username="othermanager", auth_token="testtoken5", is_manager=True)
+	other = User.objects.create(username="other", auth_token="testtoken6", manager=other_manager)
+	Task.objects.create(
+		collector=busy, manager=manager, customer=customer, amount_due=10, amount_due_at=timezone.now()
+	)
+
+	def unassigned(manager, count):
+		for day in range(1, count + 1):
+			Task.objects.create(
+				manager=manager,
+				customer=customer,
+				amount_due=10,
+				amount_due_at=datetime(2000, 1, day, tzinfo=UTC),
+			)
+
+	unassigned(manager, 5)
+	unassigned(other_manager, 1)
+	version = CollectorBalance.objects.filter(collector=busy).values_list("version", flat=True).first()
+
+	# the least loaded collector gets the task due first, the frozen one gets nothing
+	call_command("assign_tasks", manager=[manager.id], capacity=3)
+	assert json.loads(capsys.readouterr().out) == {"assigned": 5, "skipped": 0}
+	assert Task.objects.get(manager=manager, amount_due_at=datetime(2000, 1, 1, tzinfo=UTC)).collector == user
+	counts = {
+		collector: Task.objects.filter(collector=collector, is_collected=False).count()
+		for collector in (user, busy, frozen)
+	}
+	assert counts == {user: 3, busy: 3, frozen: 0}
+	assert CollectorBalance.objects.get(collector=busy).version > version
+	# other managers' tasks are left alone
+	assert Task.objects.get(manager=other_manager).collector is None
+
+	# the collectors are full
+	unassigned(manager, 1)
+	headers = {"Authorization": f"Bearer {manager.auth_token}"}
+	response = client.post("manager/tasks/assign?capacity=3", headers=headers)
+	assert response.status_code == 200
+	assert response.json() == {"assigned": 0, "skipped": 1}
+	response = client.post("manager/tasks/assign", headers=headers)
+	assert response.json() == {"assigned": 1, "skipped": 0}
+	assert not other.tasks.exists()
+	response = client.post("manager/tasks/assign", headers={"Authorization": f"Bearer {user.auth_token}"})
+	assert response.status_code == 401
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_simulate_freeze(manager, user, customer, settings, capsys):
+	collectors = [user] + [
+		User.objects.create(username=f"collector{i}", auth_token=f"simtoken{i}", manager=manager)
+		for i in range(3)
+	]
+	rng = random.Random(0)
+	transactions = []
+	for collector in collectors:
+		task = Task.objects.create(
+			collector=collector,
+			manager=manager,
+			customer=customer,
+			amount_due=1,
+			amount_due_at=timezone.now(),
+		)
+		timestamp = datetime(2000, 1, 1, tzinfo=UTC)
+		for _ in range(rng.randint(5, 30)):
+			timestamp += timedelta(hours=rng.randint(1, 60))
+			amount = Decimal(rng.randint(-5000_00, 5000_00)) / 100
+			transactions.append(
+				Transaction(collector=collector, task=task, amount=amount, timestamp=timestamp)
+			)
+	Transaction.objects.bulk_create(transactions)
+	at = datetime(2000, 3, 1, tzinfo=UTC)
+
+	def expected(usd, days):
+		"""The freezes of the ledger, replayed one transaction at a time with the rule itself."""
+		settings.USD_THRESHOLD, settings.DAYS_THRESHOLD = usd, days
+		frozen, freezes, now, total, longest = set(), 0, 0, timedelta(0), timedelta(0)
+		for collector, rows in groupby(
+			sorted(transactions, key=lambda t: (t.collector_id, t.timestamp)), key=lambda t: t.collector_id
+		):
+			state = freeze.INITIAL_STATE
+			for row in rows:
+				new_state = freeze.apply_transaction(state, row.amount, row.timestamp)
+				if (
+					state.frozen_at is not None
+					and new_state.frozen_at is None
+					and row.timestamp > state.frozen_at
+				):
+					frozen.add(collector)
+					freezes += 1
+					total += row.timestamp - state.frozen_at
+					longest = max(longest, row.timestamp - state.frozen_at)
+				state = new_state
+			if freeze.is_frozen(state.frozen_at, at):
+				frozen.add(collector)
+				freezes, now = freezes + 1, now + 1
+				total += at - state.frozen_at
+				longest = max(longest, at - state.frozen_at)
+		return {
+			"usd_threshold": usd,
+			"days_threshold": days,
+			"frozen_collectors": len(frozen),
+			"frozen_now": now,
+			"freezes": freezes,
+			"frozen_days": round(total / timedelta(days=1), 2),
+			"longest_frozen_days": round(longest / timedelta(days=1), 2),
+		}
+
+	thresholds = [(usd, days) for usd in (1000, 5000, 9000) for days in (0, 1, 2)]
+	# small chunks, so collectors span several of them
+	results = simulation.simulate([1000, 5000, 9000], [0, 1, 2], at=at, chunk_size=7)
+	assert results == [expected(usd, days) for usd, days in thresholds]
+	assert any(result["freezes"] for result in results)
+
+	call_command("simulate_freeze", usd=[Decimal(5000)], days=[2], at=at)
+	assert json.loads(capsys.readouterr().out)["freezes"] == expected(5000, 2)["freezes"]
+
+	# a naive --at is in TIME_ZONE, an invalid one is an error rather than now
+	naive = timezone.make_naive(at).isoformat()
+	call_command("simulate_freeze", "--usd", "5000", "--days", "2", "--at", naive)
+	assert json.loads(capsys.readouterr().out)["freezes"] == expected(5000, 2)["freezes"]
+	for value in ("yesterday", "2000-02-30T00:00:00"):
+		with pytest.raises(CommandError, match="invalid instant value"):
+			call_command("simulate_freeze", "--at", value)
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_admin_changelists(admin_client, manager, user, customer, django_assert_max_num_queries):
+	for day in range(1, 21):
+		task = Task.objects.create(
+			collector=user,
+			manager=manager,
+			customer=customer,
+			amount_due=10,
+			amount_due_at=datetime(2000, 1, day, tzinfo=UTC),
+		)
+		Transaction(collector=user, task=task, amount=10, timestamp=datetime(2000, 1, day, tzinfo=UTC)).save()
+
+	# the related rows and the collector's balance are joined, however many rows there are. PostgreSQL runs
+	# an EXPLAIN more, for the estimated count
+	for path in ("/admin/cash_collector/transaction/", "/admin/cash_collector/task/"):
+		with django_assert_max_num_queries(7 if connection.vendor == "postgresql" else 6):
+			response = admin_client.get(path)
+		assert response.status_code == 200
+		assert "200.00" in response.content.decode()
+	response = admin_client.get("/admin/cash_collector/transaction/?timestamp__year=2000&timestamp__month=1")
+	assert response.context["cl"].result_count == 20
+
+	# collectors are picked with an autocomplete offering collectors only
+	response = admin_client.get(
+		"/admin/autocomplete/?"
+		+ urlencode(
+			{"app_label": "cash_collector", "model_name": "task", "field_name": "collector", "term": "test"}
+		)
+	)
+	assert [result["text"] for result in response.json()["results"]] == [user.username]
+
+	# tasks are searched by primary key, anything else finds none
+	response = admin_client.get(f"/admin/cash_collector/task/?q={task.id}")
+	assert list(response.context["cl"].result_list) == [task]
+	assert "UPPER" not in str(response.context["cl"].queryset.query)
+	assert not admin_client.get("/admin/cash_collector/task/?q=abc").context["cl"].result_list
+
+	# SQLite has no estimates, the count is exact
+	assert EstimatedCountPaginator(Transaction.objects.all(), 5).count == 20
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.cashcollector()
+def test_date_index_migration():
+	def indexes(model):
+		with connection.cursor() as cursor:
+			return connection.introspection.get_constraints(cursor, model._meta.db_table)
+
+	# built without locking the tables on PostgreSQL, outside of a transaction
+	call_command("migrate", "cash_collector", "0020", verbosity=0)
+	assert "task_due_idx" not in indexes(Task)
+	assert "transaction_timestamp_idx" not in indexes(Transaction)
+	call_command("migrate", "cash_collector", verbosity=0)
+	assert "task_due_idx" in indexes(Task)
+	assert "transaction_timestamp_idx" in indexes(Transaction)
+	if not partitions.is_supported():
+		return
+
+	# on the partitioned ledger, the parent's index is valid once every partition has its own attached
+	with transaction.atomic():
+		partitions.convert(ahead=1)
+	try:
+		call_command("migrate", "cash_collector", "0020", verbosity=0)
+		assert "transaction_timestamp_idx" not in indexes(Transaction)
+		call_command("migrate", "cash_collector", verbosity=0)
+		with connection.cursor() as cursor:
+			cursor.execute(
+				"SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass('transaction_timestamp_idx')"
+			)
+			assert cursor.fetchone() == (True,)
+			cursor.execute(
+				"SELECT count(*) FROM pg_inherits WHERE inhparent = to_regclass('transaction_timestamp_idx')"
+			)
+			assert cursor.fetchone() == (len(partitions.partitions()),)
+	finally:
+		with transaction.atomic():
+			partitions.revert()
+
+
+@pytest.mark.django_db()
+@pytest.mark.cashcollector()
+def test_job_queue(manager, user, customer, settings, monkeypatch):
+	settings.DEFERRED_ROLLUPS = True
+	start = datetime(2000, 1, 1, 8, tzinfo=UTC)
+	tasks = [
+		Task.objects.create(
+			collector=user, manager=manager, customer=customer, amount_due=100, amount_due_at=start
+		)
+		for _ in range(3)
+	]
+	Transaction.objects.create(collector=user, task=tasks[0], amount=100, timestamp=start + timedelta(days=1))
+	Transaction.objects.create(collector=user, task=tasks[1], amount=100, timestamp=start + timedelta(days=2))
+	# the rollups are left to the workers, the collector's transactions are coalesced in one job
+	assert not CollectorDailyRollup.objects.exists()
+	assert Job.objects.get().since == start + timedelta(days=1)
+	# a back-dated transaction widens it
+	Transaction.objects.create(collector=user, task=tasks[2], amount=100, timestamp=start)
+	job = Job.objects.get()
+	assert job.since == start
+
+	call_command("run_workers", once=True, stdout=None)
+	assert not Job.objects.exists()
+	rollups = list(CollectorDailyRollup.objects.order_by("day").values_list("day", "closing_balance"))
+	assert rollups == [
+		(start.date(), 100),
+		(start.date() + timedelta(days=1), 200),
+		(start.date() + timedelta(days=2), 300),
+	]
+
+	# a failing job is retried later, merged into the pending job queued meanwhile if any
+	def fail(job):
+		raise ValueError("Nope")
+
+	monkeypatch.setitem(jobs.HANDLERS, Job.ROLLUPS, fail)
+	Job.enqueue(Job.ROLLUPS, user.id, since=start)
+	assert jobs.run_pending() == 1
+	job = Job.objects.get()
+	assert (job.claimed_at, job.attempts, job.last_error) == (None, 1, "ValueError: Nope")
+	assert job.run_after > timezone.now()
+	assert jobs.run_pending() == 0
+
+	[job] = jobs.claim(at=job.run_after)
+	Job.enqueue(Job.ROLLUPS, user.id, since=start + timedelta(days=1))
+	jobs.retry(job, "Nope")
+	merged = Job.objects.get()
+	assert (merged.claimed_at, merged.since, merged.attempts, merged.last_error) == (None, start, 2, "Nope")
+	# backing off from the second attempt
+	assert merged.run_after >= timezone.now() + timedelta(seconds=jobs.RETRY_DELAY * 2 - 1)
+	job = merged
+
+	# the jobs of workers that died are retried, and given up after JOBS_MAX_ATTEMPTS attempts
+	settings.JOBS_MAX_ATTEMPTS = 1
+	[job] = jobs.claim(at=job.run_after)
+	assert jobs.recover() == 0
+	assert jobs.recover(at=job.run_after + timedelta(seconds=settings.JOBS_CLAIM_TIMEOUT + 1)) == 1
+	job = Job.objects.get()
+	assert job.failed_at is not None
+	assert job.last_error == "Claimed by a worker that stopped."
@@ -0,0 +1,77 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class TokenCache:
+	"""
+	Per-process LRU cache of authenticated users keyed by the hash of their bearer token, entries expire
+	after `ttl` seconds. Other processes only see an invalidation once their own entry expires, so `ttl`
+	bounds how long a rotated token or a deactivated user may still be accepted there.
+	"""
+
+	def __init__(self, maxsize, ttl):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()  # token hash -> (expires at, user)
+		self._hashes_by_user = {}  # user id -> token hashes
+		self._lock = threading.Lock()
+
+	def get(self, token_hash):
+		"""Returns a copy of the cached user, None on a miss."""
+		with self._lock:
+			entry = self._entries.get(token_hash)
+			if entry is None or entry[0] < time.monotonic():
+				if entry is not None:
+					self._remove(token_hash)
+				self.misses += 1
+				return None
+			self._entries.move_to_end(token_hash)
+			self.hits += 1
+			# every request gets its own instance, so whatever it caches on the user stays with the request
+			return copy.copy(entry[1])
+
+	def set(self, token_hash, user):
+		"""Caches a copy of `user`, the instance given goes on with the request that authenticated it."""
+		if self.maxsize <= 0:
+			return
+		user = copy.copy(user)
+		with self._lock:
+			self._remove(token_hash)
+			self._entries[token_hash] = (time.monotonic() + self.ttl, user)
+			self._hashes_by_user.setdefault(user.pk, set()).add(token_hash)
+			while len(self._entries) > self.maxsize:
+				self._remove(next(iter(self._entries)))
+
+	def invalidate(self, user_id=None, token_hash=None):
+		with self._lock:
+			if token_hash is not None:
+				self._remove(token_hash)
+			for cached_hash in self._hashes_by_user.get(user_id, set()).copy():
+				self._remove(cached_hash)
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._hashes_by_user.clear()
+
+	def stats(self):
+		return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+	def _remove(self, token_hash):
+		entry = self._entries.pop(token_hash, None)
+		if entry is None:
+			return
+		user_hashes = self._hashes_by_user.get(entry[1].pk)
+		if user_hashes is not None:
+			user_hashes.discard(token_hash)
+			if not user_hashes:
+				del self._hashes_by_user[entry[1].pk]
+
+
+token_cache = TokenCache(maxsize=settings.AUTH_TOKEN_CACHE_SIZE, ttl=settings.AUTH_TOKEN_CACHE_TTL)
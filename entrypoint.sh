@@ -11,7 +11,7 @@ then
     echo "PostgreSQL started"
 fi
 
-python manage.py flush --no-input
-python manage.py migrate
+python manage.py migrate --no-input
+python manage.py createcachetable
 
 exec "$@"
\ No newline at end of file
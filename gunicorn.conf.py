@@ -0,0 +1,34 @@
+"""
+Gunicorn settings for the production server, run it with `gunicorn -c gunicorn.conf.py`.
+
+Every setting can be tuned with the environment variables below, e.g. GUNICORN_WORKER_CLASS=uvicorn to serve
+the ASGI application (and the async API) with uvicorn workers.
+"""
+
+import multiprocessing
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+
+# processes, each with its own database connections
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# threads per process, only used by the gthread worker
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
+
+if os.environ.get("GUNICORN_WORKER_CLASS", "gthread") == "uvicorn":
+	worker_class = "uvicorn.workers.UvicornWorker"
+	wsgi_app = "insta_cash.asgi:application"
+else:
+	worker_class = "gthread"
+	wsgi_app = "insta_cash.wsgi:application"
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# restart workers now and then, so a slow leak can't build up
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10_000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 1_000))
+
+accesslog = "-"
+errorlog = "-"
@@ -26,6 +26,44 @@ try:
 except ValueError:
 	raise ValueError("USD_THRESHOLD and DAYS_THRESHOLD must be set in the .env file")
 
+# Authenticated users are cached per process, for at most AUTH_TOKEN_CACHE_TTL seconds
+AUTH_TOKEN_CACHE_SIZE = env.int("AUTH_TOKEN_CACHE_SIZE", default=10_000)
+AUTH_TOKEN_CACHE_TTL = env.int("AUTH_TOKEN_CACHE_TTL", default=60)
+
+# Responses of /collect and /pay requests sent with an Idempotency-Key are replayed for this many seconds
+IDEMPOTENCY_KEY_TTL = env.int("IDEMPOTENCY_KEY_TTL", default=24 * 60 * 60)
+
+# Transactions carry the instant the client recorded them, maybe offline: it can be at most
+# TRANSACTION_CLOCK_SKEW seconds ahead of the server's clock, and at most OFFLINE_SYNC_WINDOW seconds before
+# the collector's last transaction
+TRANSACTION_CLOCK_SKEW = env.int("TRANSACTION_CLOCK_SKEW", default=60)
+OFFLINE_SYNC_WINDOW = env.int("OFFLINE_SYNC_WINDOW", default=3 * 24 * 60 * 60)
+
+# The figures of the manager dashboard (/manager/collectors and /manager/summary) are cached for this many
+# seconds, in the default cache
+MANAGER_DASHBOARD_CACHE_TTL = env.int("MANAGER_DASHBOARD_CACHE_TTL", default=10)
+
+# Partition the transaction table by month (PostgreSQL only), applied by migration 0017 or later with
+# `manage.py manage_partitions --convert`. `manage_partitions` keeps TRANSACTION_PARTITIONS_AHEAD months
+# ahead.
+TRANSACTION_PARTITIONING = env.bool("TRANSACTION_PARTITIONING", default=False)
+TRANSACTION_PARTITIONS_AHEAD = env.int("TRANSACTION_PARTITIONS_AHEAD", default=3)
+
+# Work deferred out of the requests is queued in the database and run by `manage.py run_workers` (see
+# cash_collector.jobs). With DEFERRED_ROLLUPS the daily rollups are written by the workers, once per collector
+# however many transactions came in meanwhile, instead of by every /collect, /pay and /sync. A job failing, or
+# claimed for more than JOBS_CLAIM_TIMEOUT seconds by a worker that died, is retried up to JOBS_MAX_ATTEMPTS
+# times.
+DEFERRED_ROLLUPS = env.bool("DEFERRED_ROLLUPS", default=False)
+JOBS_CLAIM_TIMEOUT = env.int("JOBS_CLAIM_TIMEOUT", default=5 * 60)
+JOBS_MAX_ATTEMPTS = env.int("JOBS_MAX_ATTEMPTS", default=5)
+
+# Requests running more SQL queries, or taking more seconds, are logged with their statements. /metrics only
+# answers the METRICS_ALLOWED_IPS, the loopback addresses unless set, no one when set empty.
+METRICS_QUERY_BUDGET = env.int("METRICS_QUERY_BUDGET", default=20)
+METRICS_LATENCY_BUDGET = env.float("METRICS_LATENCY_BUDGET", default=0.5)
+METRICS_ALLOWED_IPS = env.list("METRICS_ALLOWED_IPS", default=["127.0.0.1", "::1"])
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.0/howto/deployment/checklist/
 
@@ -33,9 +71,9 @@ except ValueError:
 SECRET_KEY = "django-insecure-3u^p3lj(m@g!^&ifynj86xl6)nc%hr&)7!b9e3nj4d4u2tgfzu"
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = env.bool("DEBUG", default=True)
 
-ALLOWED_HOSTS = []
+ALLOWED_HOSTS = env.list("ALLOWED_HOSTS", default=[])
 
 
 # Application definition
@@ -51,6 +89,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+	"cash_collector.metrics.RequestMetricsMiddleware",
+	"cash_collector.routers.ReplicaRoutingMiddleware",
 	"django.middleware.security.SecurityMiddleware",
 	"django.contrib.sessions.middleware.SessionMiddleware",
 	"django.middleware.common.CommonMiddleware",
@@ -84,6 +124,10 @@ WSGI_APPLICATION = "insta_cash.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Served by uvicorn workers, picked like gunicorn.conf.py does. Connections aren't kept open by default then:
+# the async views run their queries in threads that don't outlive the request, leaving their connections open.
+UVICORN_WORKERS = env("GUNICORN_WORKER_CLASS", default="gthread") == "uvicorn"
+
 DATABASES = {
 	"default": {
 		"ENGINE": "django.db.backends.postgresql",
@@ -92,9 +136,46 @@ DATABASES = {
 		"PASSWORD": env("POSTGRESQL_PASSWORD"),
 		"HOST": env("POSTGRESQL_HOST"),
 		"PORT": env("POSTGRESQL_PORT"),
+		# keep connections open between requests (seconds, None for no limit), and check they're still
+		# usable before reusing them
+		"CONN_MAX_AGE": env.int("POSTGRESQL_CONN_MAX_AGE", default=0 if UVICORN_WORKERS else 60),
+		"CONN_HEALTH_CHECKS": env.bool("POSTGRESQL_CONN_HEALTH_CHECKS", default=True),
+		# server-side cursors don't survive PgBouncer's transaction pooling mode
+		"DISABLE_SERVER_SIDE_CURSORS": env.bool("POSTGRESQL_DISABLE_SERVER_SIDE_CURSORS", default=False),
+		"OPTIONS": {},
 	}
 }
 
+# A read replica of the default database, same credentials unless set: GET requests read from it, except for
+# the clients that wrote in the last DATABASE_REPLICA_STICKY_SECONDS (see cash_collector.routers). Django's
+# test runner points it at the default database.
+if env("POSTGRESQL_REPLICA_HOST", default=""):
+	DATABASES["replica"] = {
+		**DATABASES["default"],
+		"NAME": env("POSTGRESQL_REPLICA_NAME", default=DATABASES["default"]["NAME"]),
+		"USER": env("POSTGRESQL_REPLICA_USER", default=DATABASES["default"]["USER"]),
+		"PASSWORD": env("POSTGRESQL_REPLICA_PASSWORD", default=DATABASES["default"]["PASSWORD"]),
+		"HOST": env("POSTGRESQL_REPLICA_HOST"),
+		"PORT": env("POSTGRESQL_REPLICA_PORT", default=DATABASES["default"]["PORT"]),
+		"OPTIONS": {**DATABASES["default"]["OPTIONS"]},
+		"TEST": {"MIRROR": "default"},
+	}
+DATABASE_REPLICA = "replica" if "replica" in DATABASES else None
+DATABASE_ROUTERS = ["cash_collector.routers.ReplicaRouter"]
+DATABASE_REPLICA_STICKY_SECONDS = env.int("DATABASE_REPLICA_STICKY_SECONDS", default=10)
+
+# The default cache holds the manager dashboard's figures and the clients sticking to the primary database,
+# so it must be shared by the worker processes: a table of the default database, created by
+# `manage.py createcachetable`, unless CACHE_URL points elsewhere (e.g. redis://host:6379/0)
+CACHES = {"default": env.cache("CACHE_URL", default="dbcache://cash_collector_cache")}
+# the database, file and memory caches evict entries past MAX_ENTRIES (300 by default), expired or not:
+# they'd forget the sticky clients before DATABASE_REPLICA_STICKY_SECONDS. The bound is kept above the
+# writers of that window, expired entries are culled first. Redis and Memcached evict under memory pressure.
+if CACHES["default"]["BACKEND"].endswith(("DatabaseCache", "FileBasedCache", "LocMemCache")):
+	CACHES["default"].setdefault("OPTIONS", {}).update(
+		MAX_ENTRIES=env.int("CACHE_MAX_ENTRIES", default=100_000),
+		CULL_FREQUENCY=env.int("CACHE_CULL_FREQUENCY", default=10),
+	)
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -18,9 +18,15 @@ from django.contrib import admin
 from django.urls import path
 
 from cash_collector.api import api
+from cash_collector.async_api import api as async_api
+from cash_collector.metrics import metrics_view
 
 urlpatterns = [
 	path("admin/", admin.site.urls),
 	# API
 	path("api/", api.urls),
+	# the same endpoints served by async views, for ASGI deployments
+	path("api/async/", async_api.urls),
+	# Prometheus metrics of the serving process
+	path("metrics", metrics_view),
 ]